@@ -119,36 +119,23 @@ class AnsibleInventory(InventoryBase):
 
         # Add in all the children from the service expansion pieces
         # These are the groups that you want to logically club
-        # together
-        # FIXME: Yuck - an O(n^3) algorithm. Look for efficiency
+        # together. Every group and host is visited once, the hosts
+        # are added to a group as a whole, so the cost is linear in
+        # hosts x groups.
         for group, hlist in groups_and_hosts.items():
-            if group in group_expansion:
-                # A whole bunch of processing
-
-                group_list = group_expansion[group]
+            # Add the parent group
+            self.add_group(group)
+            self.add_child_to_group(dep_name, group)
 
-                # Add the parent group
-                self.add_group(group)
-                self.add_child_to_group(dep_name, group)
-
-                # Add the group_list
-                for l_group in group_list:
+            if group in group_expansion:
+                # Add the group_list with all the hosts of the group
+                for l_group in group_expansion[group]:
                     self.add_group(l_group)
                     self.add_child_to_group(group, l_group)
-
-                    # Add all the hosts to l_group
-                    for l_host in hlist:
-                        self.add_host_to_group(l_group, l_host)
+                    self.add_hosts_to_group(l_group, hlist)
             else:
-                # A standalong group with a bunch of hosts
-
-                # Add in the group
-                self.add_group(group)
-                self.add_child_to_group(dep_name, group)
-
-                # Then add the hosts
-                for host in hlist:
-                    self.add_host_to_group(group, host)
+                # A standalone group with a bunch of hosts
+                self.add_hosts_to_group(group, hlist)
 
     def _add_hosts_to_inventory(self, deployment_map):
         """
@@ -173,10 +160,7 @@ class AnsibleInventory(InventoryBase):
 
             # Then keep a track of the groups and hosts
             for group in node['groups']:
-                if group in groups_and_hosts:
-                    groups_and_hosts[group].append(hostname)
-                else:
-                    groups_and_hosts[group] = list([hostname, ])
+                groups_and_hosts.setdefault(group, []).append(hostname)
 
             # Then add in the ansible ssh variables
             # ip maps to ansible_host
@@ -104,6 +104,27 @@ class InventoryBase(object):
             raise ValueError('Group %s and Host %s should be present' %
                              (group_name, host_name))
 
+    def add_hosts_to_group(self, group_name, host_names):
+        """
+        Add several hosts to a group at once. Cheaper than calling
+        add_host_to_group for each host when building large inventories.
+        :param group_name: Group name where the hosts are to be added
+        :param host_names: The host names to be added into the group
+        :type group_name: str
+        :type host_names: iterable
+        :returns: None
+        :raises ValueError: If the group_name or any of the host_names \
+                do not exist
+        """
+
+        host_names = set(host_names)
+        missing = host_names.difference(self.inventory['_meta']['hostvars'])
+        if self.group_exists(group_name) is True and not missing:
+            self.inventory[group_name]['hosts'].update(host_names)
+        else:
+            raise ValueError('Group %s and Hosts %s should be present' %
+                             (group_name, ', '.join(sorted(missing))))
+
     def add_var_to_host(self, host_name, var, val=''):
         """
         Add a variable to the list/set of host variables
@@ -184,11 +205,10 @@ class InventoryBase(object):
                 else:
                     return super(InventoryEncoder, self).default(obj)
 
+        # Compact output, the inventory is read by Ansible and not by humans
         return json.dumps(self.inventory,
                           cls=InventoryEncoder,
-                          indent=4,
-                          sort_keys=True,
-                          separators=(',', ': '))
+                          separators=(',', ':'))
 
     def create_inventory(self):
         """
@@ -50,12 +50,21 @@
 #
 # Also it is possible to pass the correct user by setting an ansible_user: $myuser
 # metadata attribute.
+#
+# Every cloud (and region) is listed concurrently and cached in its own shard
+# which expires independently. A stale shard is refreshed incrementally, only
+# the servers changed since its last sync are fetched (changes-since), and
+# a full listing is done every FULL_SYNC_INTERVAL seconds to catch servers
+# purged from the database.
 
 import argparse
 import collections
 import os
 import sys
 import time
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 from distutils.version import StrictVersion
 from io import StringIO
 
@@ -63,9 +72,15 @@ import json
 
 import openstack as sdk
 from openstack.cloud import inventory as sdk_inventory
+from openstack.cloud import meta as sdk_meta
 from openstack.config import loader as cloud_config
 
 CONFIG_FILES = ['/etc/ansible/openstack.yaml', '/etc/ansible/openstack.yml']
+MAX_WORKERS = 8
+FULL_SYNC_INTERVAL = 3600
+# changes-since is compared with the cloud's clock, overlap the syncs a bit
+SYNC_MARGIN = 60
+DELETED_STATUSES = ('DELETED', 'SOFT_DELETED')
 
 
 def get_groups_from_server(server_vars, namegroup=True):
@@ -115,14 +130,9 @@ def get_groups_from_server(server_vars, namegroup=True):
 
 def get_host_groups(inventory, refresh=False, cloud=None):
     (cache_file, cache_expiration_time) = get_cache_settings(cloud)
-    if is_cache_stale(cache_file, cache_expiration_time, refresh=refresh):
-        groups = to_json(get_host_groups_from_cloud(inventory))
-        with open(cache_file, 'w') as f:
-            f.write(groups)
-    else:
-        with open(cache_file, 'r') as f:
-            groups = f.read()
-    return groups
+    servers = get_servers(inventory, os.path.dirname(cache_file),
+                          cache_expiration_time, refresh=refresh)
+    return to_json(get_host_groups_from_servers(inventory, servers))
 
 
 def append_hostvars(hostvars, groups, key, server, namegroup=False):
@@ -139,10 +149,7 @@ def append_hostvars(hostvars, groups, key, server, namegroup=False):
         groups[group].append(key)
 
 
-def get_host_groups_from_cloud(inventory):
-    groups = collections.defaultdict(list)
-    firstpass = collections.defaultdict(list)
-    hostvars = {}
+def get_list_args(inventory):
     list_args = {}
     if hasattr(inventory, 'extra_config'):
         use_hostnames = inventory.extra_config['use_hostnames']
@@ -152,8 +159,22 @@ def get_host_groups_from_cloud(inventory):
                 inventory.extra_config['fail_on_errors']
     else:
         use_hostnames = False
+    return (use_hostnames, list_args)
+
 
-    for server in inventory.list_hosts(**list_args):
+def get_host_groups_from_cloud(inventory):
+    (_, list_args) = get_list_args(inventory)
+    return get_host_groups_from_servers(inventory,
+                                        inventory.list_hosts(**list_args))
+
+
+def get_host_groups_from_servers(inventory, server_list):
+    groups = collections.defaultdict(list)
+    firstpass = collections.defaultdict(list)
+    hostvars = {}
+    (use_hostnames, _) = get_list_args(inventory)
+
+    for server in server_list:
 
         if 'interface_ip' not in server:
             continue
@@ -177,6 +198,110 @@ def get_host_groups_from_cloud(inventory):
     return groups
 
 
+def get_servers(inventory, cache_path, cache_expiration_time, refresh=False):
+    ''' Servers of all the clouds, each cloud synced in its own thread '''
+    (_, list_args) = get_list_args(inventory)
+    expand = list_args.get('expand', True)
+    fail_on_errors = list_args.get('fail_on_cloud_config', True)
+
+    def sync(cloud):
+        try:
+            return sync_shard(cloud, cache_path, cache_expiration_time,
+                              expand=expand, refresh=refresh)
+        except sdk.exceptions.OpenStackCloudException as e:
+            # Don't fail on one particular cloud as others may work
+            if fail_on_errors:
+                raise
+            sys.stderr.write('%s: %s\n' % (get_shard_name(cloud), e))
+            shard = read_shard(get_shard_file(cache_path, cloud))
+            return list(shard['servers'].values()) if shard else []
+
+    clouds = inventory.clouds
+    servers = []
+    with ThreadPoolExecutor(max_workers=max(1, min(MAX_WORKERS, len(clouds)))) as pool:
+        for cloud_servers in pool.map(sync, clouds):
+            servers.extend(cloud_servers)
+    return servers
+
+
+def get_shard_name(cloud):
+    name = getattr(cloud, 'name', None) or 'default'
+    region = getattr(getattr(cloud, 'config', None), 'region_name', None)
+    if region:
+        name = '%s_%s' % (name, region)
+    return name.replace(os.sep, '_')
+
+
+def get_shard_file(cache_path, cloud):
+    return os.path.join(cache_path,
+                        'ansible-inventory-%s.cache' % get_shard_name(cloud))
+
+
+def read_shard(shard_file):
+    if not os.path.isfile(shard_file) or os.path.getsize(shard_file) == 0:
+        return None
+    with open(shard_file, 'r') as f:
+        try:
+            return json.load(f)
+        except ValueError:
+            return None
+
+
+def write_shard(shard_file, shard):
+    # write to a temporary file first so readers never see a partial shard
+    fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(shard_file))
+    with os.fdopen(fd, 'w') as f:
+        json.dump(shard, f)
+    os.replace(tmp_file, shard_file)
+
+
+def list_cloud_servers(cloud, expand=True, since=None):
+    ''' Servers of one cloud, only the ones changed after since if given '''
+    if since is None:
+        return cloud.list_servers(detailed=expand)
+    changes_since = datetime.utcfromtimestamp(since).strftime('%Y-%m-%dT%H:%M:%SZ')
+    # list_servers applies filters locally when its server list cache is
+    # enabled, the compute proxy always sends them to the API. Its servers
+    # get the same extra variables list_servers adds.
+    add_vars = sdk_meta.get_hostvars_from_server if expand else sdk_meta.add_server_interfaces
+    servers = []
+    for server in cloud.compute.servers(changes_since=changes_since, all_projects=False):
+        if server.get('status') in DELETED_STATUSES:
+            # only its id is needed to drop it from the shard
+            servers.append(server)
+        else:
+            servers.append(add_vars(cloud, server))
+    return servers
+
+
+def sync_shard(cloud, cache_path, cache_expiration_time, expand=True,
+               refresh=False):
+    ''' Servers of one cloud from its cache shard, refreshed if stale '''
+    shard_file = get_shard_file(cache_path, cloud)
+    shard = read_shard(shard_file)
+    if shard is not None and not is_cache_stale(
+            shard_file, cache_expiration_time, refresh=refresh):
+        return list(shard['servers'].values())
+
+    now = time.time()
+    if (refresh or shard is None or
+            now - shard['full_sync_at'] > FULL_SYNC_INTERVAL):
+        servers = list_cloud_servers(cloud, expand=expand)
+        shard = dict(full_sync_at=now,
+                     servers=dict((server['id'], server) for server in servers))
+    else:
+        changed = list_cloud_servers(cloud, expand=expand,
+                                     since=shard['synced_at'] - SYNC_MARGIN)
+        for server in changed:
+            if server.get('status') in DELETED_STATUSES:
+                shard['servers'].pop(server['id'], None)
+            else:
+                shard['servers'][server['id']] = server
+    shard['synced_at'] = now
+    write_shard(shard_file, shard)
+    return list(shard['servers'].values())
+
+
 def is_cache_stale(cache_file, cache_expiration_time, refresh=False):
     ''' Determines if cache file has expired, or if it is still valid '''
     if refresh:
@@ -0,0 +1,4 @@
+'''
+    Benchmarks of Enyo's own overhead, run against a fake cluster of local
+    processes so they don't need OpenStack. See enyo.cli.bench.
+'''
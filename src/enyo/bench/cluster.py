@@ -0,0 +1,175 @@
+'''
+    A fake cluster on localhost. Every service is a local process kept
+    alive by a supervisor which restarts it a fixed time after it dies, so
+    the real downtime of every outage is known and can be compared with
+    what the monitors measured.
+'''
+import os
+import subprocess
+import sys
+import time
+from threading import Thread, Event, Lock
+
+from enyo.workloaders import BaseLoader
+
+SERVICE_COMMAND = [sys.executable, '-c', 'import time\nwhile True: time.sleep(3600)']
+INVENTORY_GROUP = 'services'
+
+
+class FakeService(object):
+    '''
+        A process standing in for a service. Its pid file only exists while
+        the process is alive, so the check command fails as soon as the
+        process is reaped.
+    '''
+
+    def __init__(self, name, run_dir, restart_delay):
+        self.name = name
+        self.restart_delay = restart_delay
+        self.pid_file = os.path.join(run_dir, name + '.pid')
+        self.process = None
+        # epoch times (down, up) of every outage
+        self.outages = []
+
+    @property
+    def check_command(self):
+        return 'kill -0 "$(cat %s)"' % self.pid_file
+
+    @property
+    def kill_command(self):
+        return 'kill -9 "$(cat %s)"' % self.pid_file
+
+    def start(self):
+        self.process = subprocess.Popen(SERVICE_COMMAND, stdin=subprocess.DEVNULL,
+                                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        temp_file = self.pid_file + '.tmp'
+        with open(temp_file, 'w') as f:
+            f.write(str(self.process.pid))
+        os.replace(temp_file, self.pid_file)
+
+    def _remove_pid_file(self):
+        try:
+            os.remove(self.pid_file)
+        except FileNotFoundError:
+            pass
+
+    def wait(self):
+        '''
+            Block until the process dies, returns the time it was reaped
+        '''
+        self.process.wait()
+        died = time.time()
+        self._remove_pid_file()
+        return died
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            self.process.wait()
+        self._remove_pid_file()
+
+
+class ProcessSupervisor(object):
+    '''
+        Keeps the services running, one thread per service waiting on its
+        process
+    '''
+
+    def __init__(self, services):
+        self.services = services
+        self.stopped = Event()
+        self.lock = Lock()
+        self.threads = [Thread(target=self._supervise, args=(service,), name=service.name,
+                               daemon=True)
+                        for service in services]
+
+    def start(self):
+        for service in self.services:
+            service.start()
+        for thread in self.threads:
+            thread.start()
+
+    def _supervise(self, service):
+        while not self.stopped.is_set():
+            died = service.wait()
+            if self.stopped.wait(service.restart_delay):
+                return
+            service.start()
+            with self.lock:
+                service.outages.append((died, time.time()))
+
+    def stop(self):
+        self.stopped.set()
+        for service in self.services:
+            service.stop()
+        for thread in self.threads:
+            thread.join()
+
+    def get_outages(self):
+        with self.lock:
+            return dict((service.name, list(service.outages)) for service in self.services)
+
+
+def build_inventory(services):
+    '''
+        Inventory in the --list format with one local host per service
+    '''
+    hostvars = dict((service.name, {'ansible_connection': 'local',
+                                    'ansible_python_interpreter': sys.executable})
+                    for service in services)
+    return {
+             '_meta': {'hostvars': hostvars},
+             'all': {'children': [INVENTORY_GROUP]},
+             INVENTORY_GROUP: {'hosts': [service.name for service in services]}
+           }
+
+
+class FakeLoader(BaseLoader):
+    '''
+        Work loader doing nothing for duration seconds. It reports running
+        after init_delay seconds like a workload task finishing its setup.
+    '''
+
+    def __init__(self, duration, init_delay=1, task_init_timeout=60):
+        self.duration = duration
+        self.init_delay = init_delay
+        self.task_init_timeout = task_init_timeout
+        self.started = None
+        self.stopped = Event()
+        self.task_thread = Thread(target=self.run)
+
+    def start(self):
+        self.started = time.monotonic()
+        self.task_thread.start()
+
+    def run(self):
+        self.stopped.wait(self.init_delay + self.duration)
+
+    def stop(self):
+        self.stopped.set()
+
+    def status(self):
+        return self.task_status()
+
+    def task_status(self):
+        if self.started is None:
+            return "init"
+        if not self.task_thread.is_alive():
+            return "finished"
+        if time.monotonic() - self.started < self.init_delay:
+            return "init"
+        return "running"
+
+    def wait_for_running(self, timeout):
+        remaining = self.started + self.init_delay - time.monotonic()
+        self.stopped.wait(max(0, min(timeout, remaining)))
+        return self.task_status()
+
+    def deployment_status(self):
+        return "deploy->finished"
+
+    def wait_to_finish(self):
+        self.task_thread.join()
+
+    def generate_report(self, output_file, injection_times=None):
+        pass
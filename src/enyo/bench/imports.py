@@ -0,0 +1,60 @@
+'''
+    Import time of the Enyo entry points, measured with python -X importtime
+    in a fresh interpreter without ENYO_CONFIG_FILE, so importing enyo as a
+    library keeps working and stays fast.
+'''
+import os
+import subprocess
+import sys
+
+MODULES = ('enyo.cli.runner', 'enyo.cli.query', 'enyo.reporters.recovery')
+# number of the slowest packages reported for every module
+TOP_PACKAGES = 10
+
+
+def parse_importtime(output):
+    '''
+        (name, depth, self seconds, cumulative seconds) of every line of the
+        -X importtime output
+    '''
+    imports = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_time, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip(' ')) - 1) // 2
+        imports.append((name.strip(), depth, int(self_time) / 1e6, int(cumulative) / 1e6))
+    return imports
+
+
+def measure_module(module, rounds):
+    env = dict(os.environ)
+    env.pop('ENYO_CONFIG_FILE', None)
+    # import the same enyo as the bench itself
+    env['PYTHONPATH'] = os.pathsep.join(path for path in sys.path if path)
+    best = None
+    for _ in range(rounds):
+        process = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                                 env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                 universal_newlines=True)
+        if process.returncode != 0:
+            return dict(error=process.stderr.strip().splitlines()[-1])
+        imports = parse_importtime(process.stderr)
+        total = sum(cumulative for _, depth, _, cumulative in imports if depth == 0)
+        if best is None or total < best[0]:
+            best = (total, imports)
+
+    total, imports = best
+    packages = {}
+    for name, _, self_time, _ in imports:
+        package = name.split('.')[0]
+        packages[package] = packages.get(package, 0.0) + self_time
+    slowest = sorted(packages.items(), key=lambda entry: entry[1], reverse=True)
+    return dict(seconds=total, modules=len(imports), packages=dict(slowest[:TOP_PACKAGES]))
+
+
+def measure_import_time(modules=MODULES, rounds=5):
+    '''
+        Fastest of rounds imports of every module
+    '''
+    return dict((module, measure_module(module, rounds)) for module in modules)
@@ -0,0 +1,164 @@
+'''
+    The benchmarks run against the fake cluster. Importing this module reads
+    the Enyo config, so enyo.cli.bench puts the bench config in place first.
+'''
+import json
+import os
+import time
+
+import yaml
+
+from enyo.bench.cluster import FakeLoader, INVENTORY_GROUP
+from enyo.cli.runner import ScenarioRunner
+from enyo.config import Config
+from enyo.monitors.async_runner import AsyncProbeRunner
+from enyo.utils.ansible_api import AnsibleRunner
+from enyo.utils.task import Task
+from enyo.utils.custom_logger import CustomLogger
+
+config = Config()
+PROBE_COMMAND = 'true'
+
+
+class BenchRunner(ScenarioRunner):
+    '''
+        ScenarioRunner using the fake loader and timing the reports
+    '''
+
+    def __init__(self, scenario_file):
+        ScenarioRunner.__init__(self, scenario_file)
+        self.report_time = None
+
+    def create_loader(self, loader_config):
+        if loader_config['type'] == 'fake':
+            return FakeLoader(loader_config['duration'], loader_config['init_delay'])
+        return ScenarioRunner.create_loader(self, loader_config)
+
+    def generate_reports(self):
+        started = time.monotonic()
+        ScenarioRunner.generate_reports(self)
+        self.report_time = time.monotonic() - started
+
+
+def _summary(values):
+    values = list(values)
+    if len(values) == 0:
+        return dict(count=0)
+    return dict(count=len(values), mean=sum(values) / len(values),
+                min=min(values), max=max(values))
+
+
+def write_scenario(scenario_file, services, duration, interval, inject_at, backend):
+    output_dir = os.path.join(config.get_value('log_dir'), 'monitors')
+    os.makedirs(output_dir, exist_ok=True)
+    scenario = {
+        'loader': {'type': 'fake', 'duration': duration, 'init_delay': 1,
+                   'report_file': os.path.join(config.get_value('log_dir'), 'fake-report')},
+        'injectors': [{'name': 'kill-' + service.name, 'type': 'software',
+                       'host': service.name, 'command': service.kill_command,
+                       'time': inject_at}
+                      for service in services],
+        'monitors': [{'name': service.name + '-monitor', 'host': service.name,
+                      'command': service.check_command, 'interval': interval,
+                      'output': os.path.join(output_dir, service.name + '-monitor'),
+                      'backend': backend}
+                     for service in services]
+    }
+    with open(scenario_file, 'w') as f:
+        yaml.safe_dump(scenario, f)
+    return scenario
+
+
+def _measured_outages(scenario):
+    outages = {}
+    for monitor in scenario['monitors']:
+        report_file = monitor['output'] + '.out'
+        if not os.path.exists(report_file):
+            continue
+        with open(report_file, 'r') as f:
+            for outage in json.load(f)['outages']:
+                outages.setdefault(outage['host'], []).append((outage['down'], outage['up']))
+    return outages
+
+
+def run_scenario(scenario_file, services, supervisor, duration, interval, inject_at, backend):
+    '''
+        Run a scenario killing every service once and compare the outages
+        the monitors found with the real ones
+    '''
+    scenario = write_scenario(scenario_file, services, duration, interval, inject_at, backend)
+    runner = BenchRunner(scenario_file)
+    started = time.monotonic()
+    runner.run()
+    wall_time = time.monotonic() - started
+
+    ticks = list(runner.scheduler.get_stats().values())
+    tick_count = sum(stats['ticks'] for stats in ticks)
+
+    measured = _measured_outages(scenario)
+    detection_lag = []
+    recovery_lag = []
+    overhead = []
+    for host, actual in supervisor.get_outages().items():
+        for (down, up), (measured_down, measured_up) in zip(actual, sorted(measured.get(host, []))):
+            detection_lag.append(measured_down - down)
+            recovery_lag.append(measured_up - up)
+            overhead.append((measured_up - measured_down) - (up - down))
+
+    # a benchmark whose faults didn't land or weren't all found measures
+    # nothing, it has to fail instead of reporting numbers
+    errors = ['Injection %s failed: %s' % (injector.job_name, injector.error or 'not run')
+              for injector in runner.injectors if not injector.succeeded]
+    actual_count = sum(len(outages) for outages in supervisor.get_outages().values())
+    measured_count = sum(len(outages) for outages in measured.values())
+    if actual_count != len(services):
+        errors.append('%s services were killed, %s injected' % (actual_count, len(services)))
+    if measured_count != actual_count:
+        errors.append('%s outages measured, %s happened' % (measured_count, actual_count))
+
+    return dict(backend=backend,
+                errors=errors,
+                wall_time=wall_time,
+                report_time=runner.report_time,
+                ticks=dict(count=tick_count,
+                           missed=sum(stats['missed'] for stats in ticks),
+                           overruns=sum(stats['overruns'] for stats in ticks),
+                           mean_lateness=sum(stats['mean_lateness'] * stats['ticks']
+                                             for stats in ticks) / max(tick_count, 1),
+                           max_lateness=max([stats['max_lateness'] for stats in ticks] or [0.0]),
+                           mean_duration=sum(stats['mean_duration'] * stats['ticks']
+                                             for stats in ticks) / max(tick_count, 1),
+                           max_duration=max([stats['max_duration'] for stats in ticks] or [0.0])),
+                injection_skew=_summary(injector.skew for injector in runner.injectors
+                                        if injector.skew is not None),
+                outages=dict(injected=len(services),
+                             actual=actual_count,
+                             measured=measured_count),
+                detection_lag=_summary(detection_lag),
+                recovery_lag=_summary(recovery_lag),
+                recovery_overhead=_summary(overhead))
+
+
+def measure_probe_throughput(rounds, host_count):
+    '''
+        Probes per second of both monitor backends, every round probes all
+        the hosts of the fake cluster at once
+    '''
+    probe_log = CustomLogger(os.path.join(config.get_value('log_dir'), 'bench-probes'),
+                             log_format='%(message)s', name='bench-probes')
+    task = Task("shell", PROBE_COMMAND).get_dict()
+    throughput = {}
+    for backend, runner in (('ansible', AnsibleRunner('bench-probe', probe_log)),
+                            ('async', AsyncProbeRunner('bench-probe', probe_log))):
+        try:
+            # the first round pays for setting up the runner
+            runner.run(INVENTORY_GROUP, [task])
+            started = time.monotonic()
+            for _ in range(rounds):
+                runner.run(INVENTORY_GROUP, [task])
+            elapsed = time.monotonic() - started
+        finally:
+            runner.close()
+        probes = rounds * host_count
+        throughput[backend] = dict(probes=probes, seconds=elapsed, per_second=probes / elapsed)
+    return throughput
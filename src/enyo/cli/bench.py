@@ -0,0 +1,132 @@
+'''
+    Measures Enyo's own overhead against a fake cluster of local processes:
+    monitor tick latency, injection skew, how much the measured recoveries
+    differ from the real ones, probe throughput, report generation time,
+    import time and peak RSS. The results are written as JSON so they can be compared
+    across versions.
+
+        python -m enyo.cli.bench --output bench.json
+'''
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from enyo.bench.cluster import FakeService, ProcessSupervisor, build_inventory
+from enyo.bench.imports import measure_import_time
+
+
+def write_config(work_dir, backend):
+    log_dir = os.path.join(work_dir, 'logs')
+    os.makedirs(log_dir, exist_ok=True)
+    bench_config = {
+        'log_dir': log_dir + '/',
+        'inventory_file': os.path.join(work_dir, 'inventory.json'),
+        'results_db': os.path.join(work_dir, 'results.db'),
+        'inventory_cache_dir': os.path.join(work_dir, 'inventory-cache'),
+        'monitor_backend': backend
+    }
+    config_file = os.path.join(work_dir, 'config.json')
+    with open(config_file, 'w') as f:
+        json.dump(bench_config, f, indent=2)
+    return config_file
+
+
+def get_environment():
+    try:
+        revision = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                           cwd=os.path.dirname(os.path.abspath(__file__)),
+                                           stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    try:
+        from ansible.release import __version__ as ansible_version
+    except ImportError:
+        ansible_version = None
+    return dict(revision=revision, python=platform.python_version(),
+                ansible=ansible_version, platform=platform.platform(),
+                cpus=os.cpu_count())
+
+
+def run(args, work_dir):
+    run_dir = os.path.join(work_dir, 'run')
+    os.makedirs(run_dir, exist_ok=True)
+    services = [FakeService('svc-%d' % index, run_dir, args.restart_delay)
+                for index in range(args.services)]
+    with open(os.path.join(work_dir, 'inventory.json'), 'w') as f:
+        json.dump(build_inventory(services), f)
+    os.environ['ENYO_CONFIG_FILE'] = write_config(work_dir, args.backend)
+
+    # the fake cluster's config has to be in place before the scenario
+    # module's dependencies start reading it
+    from enyo.bench import scenario
+
+    supervisor = ProcessSupervisor(services)
+    supervisor.start()
+    try:
+        results = dict(scenario=scenario.run_scenario(os.path.join(work_dir, 'scenario.yaml'),
+                                                      services, supervisor, args.duration,
+                                                      args.interval, args.inject_at,
+                                                      args.backend))
+        if args.probe_rounds:
+            results['probes'] = scenario.measure_probe_throughput(args.probe_rounds,
+                                                                  len(services))
+    finally:
+        supervisor.stop()
+    if args.import_rounds:
+        results['import_time'] = measure_import_time(rounds=args.import_rounds)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark Enyo against a fake local cluster")
+    parser.add_argument('--output', default='enyo-bench.json', help="File the results are written to")
+    parser.add_argument('--backend', default='ansible', choices=['ansible', 'async'],
+                        help="Monitor backend")
+    parser.add_argument('--services', type=int, default=3, help="Number of fake services")
+    parser.add_argument('--duration', type=float, default=30,
+                        help="Seconds the fake workload runs")
+    parser.add_argument('--interval', type=float, default=1, help="Monitor interval")
+    parser.add_argument('--inject-at', type=float, default=10,
+                        help="Seconds after the workload start the services are killed")
+    parser.add_argument('--restart-delay', type=float, default=5,
+                        help="Seconds a killed service stays down")
+    parser.add_argument('--probe-rounds', type=int, default=20,
+                        help="Rounds of the probe throughput benchmark, 0 skips it")
+    parser.add_argument('--import-rounds', type=int, default=5,
+                        help="Imports of every entry point measured, the fastest counts, 0 skips it")
+    parser.add_argument('--work-dir', help="Directory for logs and reports, kept after the run")
+    args = parser.parse_args()
+    if args.inject_at + args.restart_delay >= args.duration:
+        parser.error("the services have to be back up before the workload ends, "
+                     "--inject-at plus --restart-delay must be less than --duration")
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='enyo-bench-')
+    started = time.time()
+    try:
+        results = run(args, work_dir)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, True)
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    results.update(started=started,
+                   parameters=dict((name, value) for name, value in vars(args).items()
+                                   if name not in ('output', 'work_dir')),
+                   environment=get_environment(),
+                   # kilobytes on Linux
+                   peak_rss=dict(self=usage.ru_maxrss, children=children.ru_maxrss))
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print("Results written to %s" % args.output)
+    if results['scenario']['errors']:
+        for error in results['scenario']['errors']:
+            print("Error: %s" % error)
+        sys.exit(1)
@@ -0,0 +1,394 @@
+'''
+    Daemon mode of the runner. One long lived process keeps Rally, Ansible,
+    the inventory and the reporting libraries loaded and runs the scenarios
+    submitted over a Unix socket one after the other, so back to back
+    scenarios don't pay for loading them every time.
+
+    Every connection carries one request and its replies, JSON objects one
+    per line:
+
+    {"command": "submit", "scenario": path, "follow": true}
+        queues a scenario and replies {"job": id, "position": n}, with
+        follow the events of the job follow until it finished
+    {"command": "follow", "job": id}
+        all the events of a job until it finished
+    {"command": "status"}, {"command": "status", "job": id}
+        state of all the jobs or of one
+    {"command": "reload"}
+        read the config and the inventory again before the next scenario
+    {"command": "shutdown"}
+        stop once the running scenario finished, queued ones are cancelled
+
+    Events are {"job": id, "event": name, "time": epoch time, ...}: queued,
+    running, log (level and message of the runner log), done or failed
+    (error and duration) and cancelled.
+'''
+import os
+import json
+import time
+import socket
+import logging
+import socketserver
+from collections import OrderedDict
+from queue import Queue
+from threading import Thread, Condition, Lock
+
+from enyo.config import Config
+from enyo.utils.custom_logger import CustomLogger, log_dir_file
+
+config = Config()
+logger = CustomLogger(log_dir_file('daemon.log'), console=True, name=__name__)
+
+# finished jobs whose state and events are kept for status and follow
+KEEP_JOBS = 200
+
+
+def default_socket():
+    return config.get_value('daemon_socket') or os.path.join(config.get_value('log_dir'), 'enyo.sock')
+
+
+class Job(object):
+    '''
+        A submitted scenario and everything that happened to it. Followers
+        block on the condition until new events come in.
+    '''
+
+    def __init__(self, job_id, scenario):
+        self.id = job_id
+        self.scenario = scenario
+        self.status = 'queued'
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.error = None
+        self.events = []
+        self._condition = Condition()
+
+    @property
+    def done(self):
+        return self.status in ('done', 'failed', 'cancelled')
+
+    def add_event(self, event, **values):
+        with self._condition:
+            self.events.append(dict(values, job=self.id, event=event, time=time.time()))
+            self._condition.notify_all()
+
+    def set_status(self, status, **values):
+        with self._condition:
+            self.status = status
+            self.add_event(status, **values)
+
+    def follow(self):
+        '''
+            All the events of the job, blocking until it is done
+        '''
+        position = 0
+        while True:
+            with self._condition:
+                while position == len(self.events) and not self.done:
+                    self._condition.wait()
+                events = self.events[position:]
+                done = self.done
+            position += len(events)
+            for event in events:
+                yield event
+            if done and position == len(self.events):
+                return
+
+    def get_dict(self):
+        return dict(job=self.id, scenario=self.scenario, status=self.status,
+                    submitted=self.submitted, started=self.started, finished=self.finished,
+                    error=self.error)
+
+
+class JobLogHandler(logging.Handler):
+    '''
+        Adds the records of the runner log to the events of the running job
+    '''
+
+    def __init__(self, job):
+        logging.Handler.__init__(self)
+        self.job = job
+
+    def emit(self, record):
+        try:
+            self.job.add_event('log', level=record.levelname, message=record.getMessage())
+        except Exception:
+            self.handleError(record)
+
+
+def warm_up():
+    '''
+        Load everything a scenario needs, the parts which aren't installed
+        are loaded by the first scenario needing them
+    '''
+    steps = (('ansible', _warm_up_ansible), ('rally', _warm_up_rally),
+             ('reporters', _warm_up_reporters))
+    for name, step in steps:
+        started = time.monotonic()
+        try:
+            step()
+        except Exception as exception:
+            logger.warning("Could not load %s: %s", name, exception)
+            continue
+        logger.info("Loaded %s in %.2f seconds", name, time.monotonic() - started)
+
+
+def _warm_up_ansible():
+    from enyo.utils.ansible_api import warm_up
+    warm_up()
+
+
+def _warm_up_rally():
+    from enyo.workloaders.rally import RallyContext
+    RallyContext.get()
+
+
+def _warm_up_reporters():
+    import matplotlib.pyplot
+    import enyo.reporters.recovery
+    import enyo.reporters.correlation
+    import enyo.reporters.store
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        try:
+            line = self.rfile.readline()
+            if not line:
+                return
+            try:
+                request = json.loads(line.decode())
+                replies = self.server.enyo_daemon.handle_request(request)
+            except Exception as exception:
+                replies = [dict(error=str(exception))]
+            for reply in replies:
+                self.wfile.write((json.dumps(reply) + '\n').encode())
+                self.wfile.flush()
+        except BrokenPipeError:
+            # the client went away, the job goes on
+            pass
+
+
+class UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class EnyoDaemon(object):
+    '''
+        Runs the submitted scenarios one at a time with runner_class, the
+        ScenarioRunner. Records of runner_logger are streamed to the
+        followers of the running job.
+    '''
+
+    def __init__(self, socket_path, runner_class, runner_logger):
+        self.socket_path = socket_path
+        self.runner_class = runner_class
+        self.runner_logger = runner_logger
+        self.jobs = OrderedDict()
+        self.queue = Queue()
+        self._next_id = 1
+        self._lock = Lock()
+        # held while a scenario runs, reloads wait for it
+        self._run_lock = Lock()
+        self._stopping = False
+        self.server = None
+        self.worker = Thread(target=self._work, name='enyo-daemon-worker')
+
+    def serve(self):
+        self._remove_stale_socket()
+        warm_up()
+        self.server = UnixServer(self.socket_path, RequestHandler)
+        self.server.enyo_daemon = self
+        self.worker.start()
+        logger.info("Waiting for scenarios on %s", self.socket_path)
+        try:
+            self.server.serve_forever()
+        except KeyboardInterrupt:
+            self.stop()
+        finally:
+            self.server.server_close()
+            os.unlink(self.socket_path)
+        self.worker.join()
+        logger.info("Stopped")
+
+    def _remove_stale_socket(self):
+        if not os.path.exists(self.socket_path):
+            return
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            client.connect(self.socket_path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            os.unlink(self.socket_path)
+            return
+        finally:
+            client.close()
+        raise RuntimeError('A daemon is already listening on %s' % self.socket_path)
+
+    def handle_request(self, request):
+        '''
+            Replies to a request, an iterable of JSON objects
+        '''
+        command = request.get('command')
+        if command == 'submit':
+            job, position = self.submit(request['scenario'])
+            replies = [dict(job=job.id, position=position)]
+            if request.get('follow'):
+                return _chain(replies, job.follow())
+            return replies
+        if command == 'follow':
+            return self._get_job(request['job']).follow()
+        if command == 'status':
+            if request.get('job') is not None:
+                return [self._get_job(request['job']).get_dict()]
+            with self._lock:
+                return [dict(jobs=[job.get_dict() for job in self.jobs.values()])]
+        if command == 'reload':
+            self.reload()
+            return [dict(reloaded=True)]
+        if command == 'shutdown':
+            Thread(target=self.stop).start()
+            return [dict(stopping=True)]
+        raise ValueError('Unknown command %s' % command)
+
+    def _get_job(self, job_id):
+        with self._lock:
+            if job_id not in self.jobs:
+                raise ValueError('Unknown job %s' % job_id)
+            return self.jobs[job_id]
+
+    def submit(self, scenario):
+        if not os.path.exists(scenario):
+            raise ValueError('Scenario file %s not found' % scenario)
+        with self._lock:
+            if self._stopping:
+                raise ValueError('The daemon is stopping')
+            job = Job(self._next_id, scenario)
+            self._next_id += 1
+            self.jobs[job.id] = job
+            self._forget_old_jobs()
+            position = self.queue.qsize()
+            job.add_event('queued', scenario=scenario, position=position)
+            self.queue.put(job)
+        logger.info("Queued job %s: %s", job.id, scenario)
+        return job, position
+
+    def _forget_old_jobs(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.done]
+        for job_id in finished[:max(0, len(finished) - KEEP_JOBS)]:
+            del self.jobs[job_id]
+
+    def reload(self):
+        '''
+            Read the config and the inventory again, between two scenarios
+        '''
+        from enyo.utils.inventory import Inventory
+        from enyo.utils.ansible_api import ExecutionContext
+
+        with self._run_lock:
+            config.reload()
+            Inventory.clear()
+            ExecutionContext.clear()
+            try:
+                from enyo.workloaders.rally import RallyContext
+                RallyContext.get().forget_deployments()
+            except ImportError:
+                pass
+            warm_up()
+        logger.info("Reloaded the config and the inventory")
+
+    def stop(self):
+        with self._lock:
+            if self._stopping:
+                return
+            self._stopping = True
+        logger.info("Stopping after the running scenario")
+        while not self.queue.empty():
+            self.queue.get().set_status('cancelled')
+        self.queue.put(None)
+        self.worker.join()
+        self.server.shutdown()
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            with self._run_lock:
+                self._run(job)
+
+    def _run(self, job):
+        logger.info("Running job %s: %s", job.id, job.scenario)
+        job.started = time.time()
+        job.set_status('running')
+        handler = JobLogHandler(job)
+        self.runner_logger.addHandler(handler)
+        runner = None
+        try:
+            runner = self.runner_class(job.scenario)
+            runner.run()
+        except Exception as exception:
+            logger.exception("Job %s failed", job.id)
+            job.error = '%s: %s' % (type(exception).__name__, exception)
+            if runner is not None:
+                # monitors of a failed scenario would keep running forever
+                runner.stop_monitors()
+        finally:
+            self.runner_logger.removeHandler(handler)
+        job.finished = time.time()
+        job.set_status('failed' if job.error else 'done', error=job.error,
+                       duration=job.finished - job.started)
+        logger.info("Job %s %s in %.1f seconds", job.id, job.status, job.finished - job.started)
+
+
+def _chain(*iterables):
+    for iterable in iterables:
+        for item in iterable:
+            yield item
+
+
+def request(socket_path, message):
+    '''
+        Send a request to the daemon, yields its replies
+    '''
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+        client.sendall((json.dumps(message) + '\n').encode())
+        with client.makefile('r') as replies:
+            for line in replies:
+                yield json.loads(line)
+    finally:
+        client.close()
+
+
+def print_event(event):
+    '''
+        One line of a job event for the console, returns the exit code of
+        the client once the job is over
+    '''
+    if 'error' in event and 'event' not in event:
+        print('Error: %s' % event['error'])
+        return 1
+    if 'position' in event and 'event' not in event:
+        print('Job %s queued, %s scenarios ahead' % (event['job'], event['position']))
+    elif event.get('event') == 'log':
+        print('[job %s] %s %s' % (event['job'], event['level'], event['message']))
+    elif event.get('event') in ('done', 'failed'):
+        print('Job %s %s in %.1f seconds%s' % (event['job'], event['event'], event['duration'],
+                                               ': %s' % event['error'] if event['error'] else ''))
+        return 0 if event['event'] == 'done' else 1
+    elif event.get('event') == 'cancelled':
+        print('Job %s cancelled' % event['job'])
+        return 1
+    return None
+
+
+def print_status(jobs):
+    print('%5s  %-9s  %8s  %s' % ('job', 'status', 'duration', 'scenario'))
+    for job in jobs:
+        duration = '-'
+        if job['started'] is not None:
+            duration = '%.1f' % ((job['finished'] or time.time()) - job['started'])
+        print('%5d  %-9s  %8s  %s' % (job['job'], job['status'], duration, job['scenario']))
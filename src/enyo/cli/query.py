@@ -0,0 +1,72 @@
+import argparse
+from datetime import datetime
+
+from enyo.reporters.store import ResultsStore
+
+
+def _format_time(timestamp):
+    if timestamp is None:
+        return '-'
+    return datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def _format_seconds(seconds):
+    if seconds is None:
+        return '-'
+    return '%.2f' % seconds
+
+
+def list_runs(store, args):
+    for run_id, scenario, loader, started, finished in store.runs(args.scenario, args.limit):
+        print('%6d  %s  %-6s  %s' % (run_id, _format_time(started), loader or '-', scenario))
+
+
+def show_trend(store, args):
+    print('%6s  %-19s  %7s  %8s  %8s' % ('run', 'started', 'outages', 'mttr', 'max'))
+    for run_id, scenario, started, outages, mttr, longest in store.recovery_trend(args.monitor, args.host):
+        print('%6d  %s  %7d  %8s  %8s' % (run_id, _format_time(started), outages,
+                                          _format_seconds(mttr), _format_seconds(longest)))
+
+
+def show_regressions(store, args):
+    regressions = store.regressions(args.monitor, args.window, args.threshold, args.host)
+    if len(regressions) == 0:
+        print('No regressions found')
+        return
+    print('%6s  %-19s  %8s  %8s' % ('run', 'started', 'mttr', 'baseline'))
+    for run_id, scenario, started, outages, mttr, longest, baseline in regressions:
+        print('%6d  %s  %8s  %8s' % (run_id, _format_time(started), _format_seconds(mttr),
+                                     _format_seconds(baseline)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Query the Enyo results store")
+    parser.add_argument('--db', help="Results database, defaults to results_db of the config")
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    runs = subparsers.add_parser('runs', help="List the stored runs")
+    runs.add_argument('--scenario', help="Only runs of scenarios matching this name")
+    runs.add_argument('--limit', type=int, default=50, help="Number of runs to show")
+    runs.set_defaults(func=list_runs)
+
+    trend = subparsers.add_parser('trend', help="Recovery times of a monitor across runs")
+    trend.add_argument('monitor', help="Monitor name, e.g. nova-monitor")
+    trend.add_argument('--host', help="Only recoveries of this host")
+    trend.set_defaults(func=show_trend)
+
+    regressions = subparsers.add_parser('regressions', help="Runs where a monitor's MTTR regressed")
+    regressions.add_argument('monitor', help="Monitor name, e.g. nova-monitor")
+    regressions.add_argument('--host', help="Only recoveries of this host")
+    regressions.add_argument('--window', type=int, default=5,
+                             help="Number of previous runs making the baseline")
+    regressions.add_argument('--threshold', type=float, default=1.2,
+                             help="Ratio to the baseline MTTR counted as a regression")
+    regressions.set_defaults(func=show_regressions)
+
+    args = parser.parse_args()
+    store = ResultsStore(args.db)
+    try:
+        args.func(store, args)
+    finally:
+        store.close()
@@ -4,24 +4,27 @@ import argparse
 from threading import Thread, Event
 import logging
 import time
+from datetime import datetime
 import yaml
 
-from enyo.workloaders.rally import Rally
-from enyo.workloaders.shaker import Shaker
-from rally.api import API
-from rally.cli.commands.deployment import DeploymentCommands
 from enyo.injectors.software import Software
 from enyo.injectors.hardware import Hardware
 from enyo.injectors.network import Network
 from enyo.monitors import BaseMonitor
-from enyo.reporters.recovery import RecoveryReporter
-from enyo.utils.custom_logger import CustomLogger
+from enyo.monitors.scheduler import MonitorScheduler
+from enyo.monitors.stream import StreamingMonitor
+from enyo.monitors.probes import NativeMonitor
+from enyo.monitors.health import HealthTracker
+from enyo.workloaders import FINAL_STATUSES
+from enyo.utils.inventory import Inventory
+from enyo.utils.custom_logger import CustomLogger, log_dir_file
+from enyo.utils import tracing, results
 from enyo.config import Config
 
 config = Config()
-LOG_FILE = os.path.join(config.get_value('log_dir'), 'main.log')
-logger = CustomLogger(LOG_FILE, console=True, name=__name__)
+logger = CustomLogger(log_dir_file('main.log'), console=True, name=__name__)
 logger.setLevel(3)
+EARLY_STOP_GRACE = 60
 
 class ScenarioRunner(object):
 
@@ -29,9 +32,29 @@ class ScenarioRunner(object):
         self.loader = None
         self.injection = None
         self.stop_monitors_flag = Event()
+        self.scenario_file = scenario_file
         self.scenario = self.read_scenario(scenario_file)
+        self.started = time.time()
         self.injectors = []
         self.monitors = []
+        self.scheduler = MonitorScheduler(self.stop_monitors_flag)
+        # follows the monitors while they run
+        self.health = None
+        # stop the workload once the monitors were healthy for this many
+        # seconds after the last injection
+        self.early_stop = self.scenario.get('early_stop', config.get_value('early_stop'))
+        # seconds after the last injection for its outages to show up, the
+        # workload runs to its end when they don't
+        self.early_stop_grace = self.scenario.get('early_stop_grace',
+                                                  config.get_value('early_stop_grace')) \
+            or EARLY_STOP_GRACE
+        self.stopped_early = None
+        # monitors each injection affects by injector name, all monitors of
+        # its hosts when not given
+        self.injection_monitors = {}
+        # trace the phases of the run, profiling the spans matching profile
+        self.trace = bool(config.get_value('trace'))
+        self.profile = config.get_value('trace_profile') or []
 
 
     def start_loaders(self):
@@ -44,12 +67,23 @@ class ScenarioRunner(object):
         if(loader_config==None):
             logger.info("No work loader specified")
             return
+        self.loader = self.create_loader(loader_config)
+        self.loader.start()
+
+
+    def create_loader(self, loader_config):
+        '''
+            The work loader of the scenario. Loader modules are imported
+            only when used, so Rally isn't needed for Shaker scenarios.
+        '''
         if loader_config['type']=="rally":
-            self.loader = Rally(loader_config['scenario_file'], loader_config['deployment_name'])
+            from enyo.workloaders.rally import Rally
+            return Rally(loader_config['scenario_file'], loader_config['deployment_name'])
         elif loader_config['type']=="shaker":
-            self.loader = Shaker(loader_config['host_ip'], loader_config['scenario_file'],
-                                 loader_config['report_file'], loader_config['log_file'])
-        self.loader.start()
+            from enyo.workloaders.shaker import Shaker
+            return Shaker(loader_config['host_ip'], loader_config['scenario_file'],
+                          loader_config['report_file'], loader_config['log_file'])
+        raise ValueError('Unknown loader type %s' % loader_config['type'])
 
 
     def start_injectors(self):
@@ -63,6 +97,7 @@ class ScenarioRunner(object):
             return
 
         for injector in self.scenario['injectors']:
+            self.injection_monitors[injector['name']] = injector.get('monitors')
             if injector['type'] == 'software':
                 self.injectors.append(Software(injector['name'], injector['host'],
                                                injector['command'], injector['time']))
@@ -76,31 +111,26 @@ class ScenarioRunner(object):
         logger.debug(self.loader.deployment_status())
         logger.info('Waiting for the workload task to initialize ...')
 
-        timeout = 0
-        failure = False
-        while(self.loader.task_init_timeout>timeout):
-            if(self.loader.task_status()=="running"):
-                break
-            elif(self.loader.task_status()=="failed"):
-                failure = True
-                break
-            logger.info('Work loader task status: %s', self.loader.task_status())
-            time.sleep(1)
-            timeout += 1
-
-        if(timeout>self.loader.task_init_timeout or failure):
-            logger.info('Failed to initialize work load task. Aborting injectors.')
+        with tracing.span('wait_for_running') as span:
+            status = self.loader.wait_for_running(self.loader.task_init_timeout)
+            span.set(status=status)
+        if status != "running":
+            logger.info('Failed to initialize work load task (status %s). Aborting injectors.',
+                        status)
             return
 
+        # the injection times count from the moment the workload is running
+        anchor = time.monotonic()
         logger.info('Work load task started. Ready to inject')
 
-        list(map(lambda i: i.inject(), self.injectors))
+        for injector in self.injectors:
+            injector.inject(anchor)
 
 
     def start_monitors(self):
         '''
-            Loop through all monitors and create objects and start
-            in seperate threads based on their timers
+            Loop through all monitors, create objects and hand them to the
+            scheduler which runs them at their intervals
         '''
         logger.info('Starting monitors')
         if(self.scenario['monitors']==None):
@@ -108,35 +138,199 @@ class ScenarioRunner(object):
             return
 
         for monitor in self.scenario['monitors']:
-            self.monitors.append(BaseMonitor(monitor['name'], monitor['host'], monitor['command'],
-                                             monitor['interval'], monitor['output'],
-                                             self.stop_monitors_flag))
+            try:
+                self.monitors.append(self.create_monitor(monitor))
+            except ValueError as exception:
+                logger.error("Monitor %s not started: %s", monitor['name'], exception)
+
+        self.health = HealthTracker([monitor.job_name for monitor in self.monitors],
+                                    on_event=self.log_health_event)
+        results.add_listener(self.health.feed)
+        list(map(self.scheduler.add, self.monitors))
+        self.scheduler.start()
+
+
+    def create_monitor(self, monitor):
+        if monitor.get('mode') == 'stream':
+            # the command runs in an agent on the host, reporting changes
+            return StreamingMonitor(monitor['name'], monitor['host'], monitor['command'],
+                                    monitor['interval'], monitor['output'])
+        if monitor.get('probe'):
+            # checked by enyo itself, without a shell command
+            return NativeMonitor(monitor['name'], monitor['host'], monitor['probe'],
+                                 monitor['interval'], monitor['output'], monitor)
+        return BaseMonitor(monitor['name'], monitor['host'], monitor['command'],
+                           monitor['interval'], monitor['output'], monitor.get('backend'))
+
 
-        list(map(lambda m: m.start(), self.monitors))
+    def log_health_event(self, event):
+        if event['event'] == 'down':
+            logger.info("%s on %s is down", event['job_name'], event['host'])
+        else:
+            logger.info("%s on %s recovered after %.3f seconds", event['job_name'],
+                        event['host'], event['duration'])
+
+
+    def get_health(self):
+        '''
+            State of every monitored host, None before the monitors started
+        '''
+        if self.health is None:
+            return None
+        return self.health.get_health()
 
 
     def stop_monitors(self):
         logger.info('Stopping monitors')
         self.stop_monitors_flag.set()
+        if self.scheduler.is_alive():
+            self.scheduler.join()
+        if self.health is not None:
+            results.remove_listener(self.health.feed)
 
 
     def wait_workers(self):
         logger.info("Waiting for workers to finish")
-        map(lambda i: i.wait_to_finish(), self.injectors)
+        for injector in self.injectors:
+            injector.wait_to_finish()
+        if self.early_stop and self.health is not None:
+            with tracing.span('wait_for_recovery'):
+                self.wait_for_recovery(self.early_stop)
         self.loader.wait_to_finish()
         self.stop_monitors()
 
 
+    def wait_for_recovery(self, hold):
+        '''
+            Stop the workload once every series the injections target went
+            down after its injection and all monitored hosts have been up
+            again for hold seconds. Returns when the workload finished on
+            its own before that, or when an outage didn't show up within the
+            grace time, letting the workload run to its end.
+        '''
+        injected = [injector for injector in self.injectors if injector.injected_at is not None]
+        if not injected:
+            return
+        inventory = Inventory.get()
+        targets = [(self.injection_monitors.get(injector.job_name),
+                    inventory.resolve(injector.host) or [injector.host], injector.injected_at)
+                   for injector in injected]
+        last_injection = max(injector.injected_at for injector in injected)
+        logger.info("Stopping the workload once all monitors are healthy for %s seconds "
+                    "after the outages of the injections", hold)
+        while self.loader.task_status() not in FINAL_STATUSES:
+            undetected, recovered_since = self.health.get_recovery(targets)
+            healthy_since = self.health.healthy_since()
+            remaining = 1
+            if recovered_since is not None and healthy_since is not None:
+                remaining = max(recovered_since, healthy_since) + hold - time.time()
+                if remaining <= 0:
+                    logger.info("All monitors healthy for %s seconds, stopping the workload", hold)
+                    self.stopped_early = time.time()
+                    self.loader.stop()
+                    return
+            elif undetected and time.time() - last_injection >= self.early_stop_grace:
+                logger.warning("No outage of %s seen within %s seconds of the injections, "
+                               "running the workload to its end",
+                               ', '.join('%s on %s' % target for target in undetected),
+                               self.early_stop_grace)
+                return
+            # a record may change the state before that
+            self.health.wait(min(1, remaining))
+
+
     def generate_reports(self):
+        # the reporters need numpy and matplotlib, which only reporting loads
+        from enyo.reporters.recovery import RecoveryReporter
+        from enyo.reporters.correlation import CorrelationReporter
+
         logger.info("Generating report")
         # generate report from workload
-        self.loader.generate_report(self.scenario['loader']['report_file'])
+        with tracing.span('report.loader'):
+            self.loader.generate_report(self.scenario['loader']['report_file'],
+                                        self.get_injection_times())
 
         # generate report from monitors
-        for monitor in self.scenario['monitors']:
-            report = RecoveryReporter(monitor['output'])
+        for monitor in self.scenario['monitors'] or []:
+            report = RecoveryReporter(monitor['output'], self.get_services(monitor))
+            with tracing.span('report.recovery', monitor=monitor['name']):
+                report.generate_report()
+
+        # monitors, injections and workload on one time line
+        loader_config = self.scenario['loader']
+        rally_file = loader_config['report_file'] + '.json' if loader_config['type'] == 'rally' else None
+        report = CorrelationReporter(loader_config['report_file'] + '.correlation',
+                                     [monitor['output'] for monitor in self.scenario['monitors'] or []],
+                                     self.get_injection_times(), rally_file)
+        with tracing.span('report.correlation'):
             report.generate_report()
 
+        with tracing.span('store_results'):
+            self.store_results()
+
+    def get_services(self, monitor):
+        '''
+            The replica group of a monitor with a quorum, the hosts of its
+            host pattern. Probe targets which aren't in the inventory are
+            the group as they appear in the log.
+        '''
+        if monitor.get('quorum') is None:
+            return None
+        hosts = monitor.get('targets') or Inventory.get().resolve(monitor['host'])
+        return {monitor['name']: dict(hosts=hosts or None, quorum=monitor['quorum'])}
+
+    def get_injection_times(self):
+        '''
+            Name, host and epoch time of every injection which ran
+        '''
+        return [dict(name=injector.job_name, host=injector.host, time=injector.injected_at)
+                for injector in self.injectors if injector.injected_at is not None]
+
+    def store_results(self):
+        '''
+            Add the results of the run to the results store
+        '''
+        from enyo.reporters.store import ResultsStore
+
+        logger.info("Storing results")
+        store = ResultsStore()
+        try:
+            loader_config = self.scenario['loader'] or {}
+            run_id = store.add_run(os.path.abspath(self.scenario_file), loader_config.get('type'),
+                                   self.started, time.time())
+            store.add_injections(run_id, self.injectors)
+            for monitor in self.scenario['monitors'] or []:
+                store.add_monitor_samples(run_id, monitor['output'])
+                store.add_recoveries(run_id, monitor['output'] + '.out')
+            if loader_config.get('type') == 'rally':
+                store.add_rally_iterations(run_id, loader_config['report_file'] + '.json')
+        except Exception as exception:
+            logger.error("Error occured while storing results: %s", exception)
+        finally:
+            store.close()
+
+    def run(self):
+        '''
+            Run the whole scenario and generate its reports
+        '''
+        if self.trace:
+            tracing.start(self.get_trace_file(), self.profile)
+        try:
+            with tracing.span('scenario', scenario=self.scenario_file):
+                for phase in (self.start_loaders, self.start_injectors, self.start_monitors,
+                              self.wait_workers, self.generate_reports):
+                    with tracing.span(phase.__name__):
+                        phase()
+        finally:
+            tracer = tracing.stop()
+            if tracer is not None:
+                logger.info("Trace written to %s", tracer.output)
+
+    def get_trace_file(self):
+        name = os.path.splitext(os.path.basename(self.scenario_file))[0]
+        return os.path.join(config.get_value('log_dir'), 'traces',
+                            '%s-%s.json' % (name, datetime.now().strftime('%Y%m%d-%H%M%S')))
+
     def read_scenario(self, file):
         with open(file, 'r') as stream:
             try:
@@ -146,19 +340,71 @@ class ScenarioRunner(object):
 
         return scenario
 
+def run_client(args):
+    '''
+        Talk to the daemon, returns the exit code
+    '''
+    from enyo.cli.daemon import request, print_event, print_status, default_socket
+
+    socket_path = args.socket or default_socket()
+    if args.status:
+        message = dict(command='status')
+    elif args.reload:
+        message = dict(command='reload')
+    elif args.shutdown:
+        message = dict(command='shutdown')
+    else:
+        message = dict(command='submit', scenario=os.path.abspath(args.scenario),
+                       follow=not args.detach)
+    exit_code = 0
+    for reply in request(socket_path, message):
+        if 'jobs' in reply:
+            print_status(reply['jobs'])
+            continue
+        code = print_event(reply)
+        if code is not None:
+            exit_code = code
+    return exit_code
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Enyo")
-    parser.add_argument('-s', '--scenario', required=True, help="Scenario file to be passed")
+    parser.add_argument('-s', '--scenario', help="Scenario file to be passed")
+    parser.add_argument('--daemon', action='store_true',
+                        help="Keep Rally and Ansible loaded and run the scenarios submitted on the socket")
+    parser.add_argument('--submit', action='store_true',
+                        help="Queue the scenario on the daemon and follow its progress")
+    parser.add_argument('--detach', action='store_true',
+                        help="Only queue the scenario, don't wait for it")
+    parser.add_argument('--status', action='store_true', help="Show the jobs of the daemon")
+    parser.add_argument('--reload', action='store_true',
+                        help="Make the daemon read the config and the inventory again")
+    parser.add_argument('--shutdown', action='store_true',
+                        help="Stop the daemon once the running scenario finished")
+    parser.add_argument('--trace', action='store_true',
+                        help="Write a Chrome trace of the run to the traces directory of the logs")
+    parser.add_argument('--profile', action='append', default=[], metavar='SPAN',
+                        help="Profile the spans matching this name pattern with cProfile and "
+                        "tracemalloc, implies --trace")
+    parser.add_argument('--socket', help="Socket of the daemon, defaults to daemon_socket of "
+                        "the config or enyo.sock in the log directory")
     args = parser.parse_args()
-    if os.path.exists(args.scenario):
+    if args.daemon:
+        from enyo.cli.daemon import EnyoDaemon, default_socket
+        EnyoDaemon(args.socket or default_socket(), ScenarioRunner, logger).serve()
+    elif args.status or args.reload or args.shutdown:
+        sys.exit(run_client(args))
+    elif args.scenario is None:
+        parser.error("the scenario file is required")
+    elif not os.path.exists(args.scenario):
+        print("Scenario file not found")
+    elif args.submit or args.detach:
+        sys.exit(run_client(args))
+    else:
         logger.info('Starting the scenario')
         scenario = ScenarioRunner(args.scenario)
-        scenario.start_loaders()
-        scenario.start_injectors()
-        scenario.start_monitors()
-        scenario.wait_workers()
-        scenario.generate_reports()
+        scenario.trace = scenario.trace or args.trace or bool(args.profile)
+        scenario.profile = list(scenario.profile) + args.profile
+        scenario.run()
         logger.info('Finished!')
-    else:
-        print("Scenario file not found")
 
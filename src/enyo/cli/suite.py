@@ -0,0 +1,312 @@
+'''
+    Runs a directory of scenarios. Scenarios which don't get in each other's
+    way run at the same time, each in its own runner process with its own log
+    directory, the others wait for the scenarios they conflict with.
+
+    The footprint of a scenario are the hosts its injectors and monitors
+    resolve to in the inventory. Two scenarios conflict when one injects
+    faults on a host the other one uses, or when both use a resource only one
+    can use at a time: the same output file or the same Shaker server. Host
+    patterns which aren't in the inventory, e.g. localhost, count as hosts of
+    their own. Scenarios whose injections hit more hosts than their
+    injectors run on, like virsh commands run on localhost, list those hosts
+    in an optional footprint section:
+
+    footprint:
+      - d52-54-77-77-01-01.virtual.cloud.suse.de
+'''
+import os
+import sys
+import json
+import glob
+import time
+import argparse
+import subprocess
+from datetime import datetime
+
+import yaml
+
+from enyo.config import Config, CONFIG_FILE_VARIABLE
+from enyo.utils.inventory import Inventory
+
+config = Config()
+
+# seconds between checks of the running workers
+POLL_INTERVAL = 1
+
+
+class Footprint(object):
+    '''
+        disrupted: hosts the scenario injects faults on
+        hosts: every host the scenario injects on or monitors
+        resources: things only one scenario can use at a time
+    '''
+
+    def __init__(self, disrupted, hosts, resources):
+        self.disrupted = frozenset(disrupted)
+        self.hosts = frozenset(hosts) | self.disrupted
+        self.resources = frozenset(resources)
+
+    def conflicts(self, other):
+        return bool(self.disrupted & other.hosts or other.disrupted & self.hosts
+                    or self.resources & other.resources)
+
+
+def _resolve(inventory, pattern):
+    return inventory.resolve(pattern) or [pattern]
+
+
+def get_footprint(scenario, inventory):
+    disrupted = set()
+    hosts = set()
+    resources = set()
+    for injector in scenario.get('injectors') or []:
+        disrupted.update(_resolve(inventory, injector['host']))
+    for pattern in scenario.get('footprint') or []:
+        disrupted.update(_resolve(inventory, pattern))
+    for monitor in scenario.get('monitors') or []:
+        hosts.update(_resolve(inventory, monitor['host']))
+        resources.add(os.path.abspath(monitor['output']))
+
+    loader = scenario.get('loader') or {}
+    for key in ('report_file', 'log_file'):
+        if loader.get(key):
+            resources.add(os.path.abspath(loader[key]))
+    if loader.get('type') == 'shaker':
+        resources.add('shaker:%s' % loader['host_ip'])
+    return Footprint(disrupted, hosts, resources)
+
+
+class ScenarioRun(object):
+
+    def __init__(self, scenario_file, run_dir):
+        self.scenario_file = os.path.abspath(scenario_file)
+        self.name = os.path.splitext(os.path.basename(scenario_file))[0]
+        self.run_dir = run_dir
+        self.footprint = None
+        self.status = 'pending'
+        self.error = None
+        self.exit_code = None
+        self.started = None
+        self.finished = None
+        self.waited_for = set()
+        self.process = None
+
+    @property
+    def duration(self):
+        if self.started is None or self.finished is None:
+            return None
+        return self.finished - self.started
+
+    def get_monitor_results(self):
+        '''
+            Outages and recovery times of the monitors of a finished run
+        '''
+        results = {}
+        with open(self.scenario_file, 'r') as f:
+            scenario = yaml.safe_load(f)
+        for monitor in scenario.get('monitors') or []:
+            report = monitor['output'] + '.out'
+            if os.path.exists(report):
+                with open(report, 'r') as f:
+                    results.update(json.load(f).get('monitors', {}))
+        return results
+
+    def get_dict(self):
+        result = dict(name=self.name, scenario=self.scenario_file, status=self.status,
+                      exit_code=self.exit_code, started=self.started, finished=self.finished,
+                      duration=self.duration, log_dir=self.run_dir,
+                      waited_for=sorted(self.waited_for), error=self.error)
+        if self.footprint is not None:
+            result.update(hosts=sorted(self.footprint.hosts),
+                          disrupted=sorted(self.footprint.disrupted))
+        if self.status in ('done', 'failed'):
+            result['monitors'] = self.get_monitor_results()
+        return result
+
+
+class SuiteRunner(object):
+    '''
+        Runs scenario files in up to workers runner processes at a time.
+        Scenarios start in the order of the files, a scenario never overtakes
+        an earlier one it conflicts with. on_finish is called with every
+        ScenarioRun which finished.
+    '''
+    WORKER_MODULE = 'enyo.cli.runner'
+
+    def __init__(self, scenario_files, output_dir, workers, on_finish=None):
+        self.output_dir = output_dir
+        self.workers = workers
+        self.on_finish = on_finish
+        self.runs = [ScenarioRun(scenario_file, os.path.join(output_dir, name))
+                     for scenario_file, name in _run_names(scenario_files)]
+        self.started = None
+        self.finished = None
+
+    def plan(self):
+        '''
+            Work out the footprint of every scenario
+        '''
+        inventory = Inventory.get()
+        for run in self.runs:
+            try:
+                with open(run.scenario_file, 'r') as f:
+                    run.footprint = get_footprint(yaml.safe_load(f), inventory)
+            except (yaml.YAMLError, KeyError, TypeError, AttributeError) as exception:
+                run.status = 'invalid'
+                run.error = '%s: %s' % (type(exception).__name__, exception)
+
+    def conflicts(self):
+        '''
+            Names of the scenarios every scenario conflicts with
+        '''
+        runs = [run for run in self.runs if run.footprint is not None]
+        return dict((run.name, [other.name for other in runs
+                                if other is not run and run.footprint.conflicts(other.footprint)])
+                    for run in runs)
+
+    def run(self):
+        self.plan()
+        self.started = time.time()
+        pending = [run for run in self.runs if run.status == 'pending']
+        running = []
+        while pending or running:
+            for run in list(pending):
+                if len(running) >= self.workers:
+                    break
+                blocking = [other for other in running + pending[:pending.index(run)]
+                            if run.footprint.conflicts(other.footprint)]
+                if blocking:
+                    run.waited_for.update(other.name for other in blocking)
+                    continue
+                pending.remove(run)
+                self._start(run)
+                running.append(run)
+
+            time.sleep(POLL_INTERVAL)
+            for run in list(running):
+                if run.process.poll() is not None:
+                    self._finish(run)
+                    running.remove(run)
+        self.finished = time.time()
+
+    def _start(self, run):
+        os.makedirs(os.path.join(run.run_dir, 'rally'), exist_ok=True)
+        env = dict(os.environ)
+        env[CONFIG_FILE_VARIABLE] = self._write_worker_config(run.run_dir)
+        # the workers run the same enyo as the suite
+        env['PYTHONPATH'] = os.pathsep.join(path for path in sys.path if path)
+        print('Starting %s' % run.name)
+        with open(os.path.join(run.run_dir, 'console.log'), 'w') as console:
+            run.process = subprocess.Popen([sys.executable, '-m', self.WORKER_MODULE,
+                                            '-s', run.scenario_file],
+                                           env=env, stdout=console, stderr=subprocess.STDOUT)
+        run.status = 'running'
+        run.started = time.time()
+
+    def _finish(self, run):
+        run.finished = time.time()
+        run.exit_code = run.process.returncode
+        run.status = 'done' if run.exit_code == 0 else 'failed'
+        print('%s %s in %.0f seconds' % (run.name, run.status, run.duration))
+        if self.on_finish is not None:
+            self.on_finish(run)
+
+    def _write_worker_config(self, run_dir):
+        '''
+            The config of a worker: the suite's config writing the logs to
+            the run directory and the results to the suite's results store
+        '''
+        with open(os.environ[CONFIG_FILE_VARIABLE], 'r') as f:
+            worker_config = json.load(f)
+        log_dir = config.get_value('log_dir')
+        worker_config.update(
+            log_dir=run_dir + os.sep,
+            results_db=config.get_value('results_db') or os.path.join(log_dir, 'results.db'),
+            inventory_cache_dir=config.get_value('inventory_cache_dir') or
+            os.path.join(log_dir, 'inventory-cache'))
+        config_file = os.path.join(run_dir, 'config.json')
+        with open(config_file, 'w') as f:
+            json.dump(worker_config, f, indent=2)
+        return config_file
+
+    def get_summary(self):
+        durations = [run.duration for run in self.runs if run.duration is not None]
+        wall_time = self.finished - self.started if self.finished is not None else None
+        return dict(started=self.started, finished=self.finished, wall_time=wall_time,
+                    serial_time=sum(durations), workers=self.workers,
+                    scenarios=[run.get_dict() for run in self.runs])
+
+
+def _run_names(scenario_files):
+    '''
+        Scenario files with a run directory name unique in the suite
+    '''
+    seen = {}
+    for scenario_file in scenario_files:
+        name = os.path.splitext(os.path.basename(scenario_file))[0]
+        seen[name] = seen.get(name, 0) + 1
+        yield scenario_file, name if seen[name] == 1 else '%s-%d' % (name, seen[name])
+
+
+def _format_seconds(seconds):
+    if seconds is None:
+        return '-'
+    return '%.0f' % seconds
+
+
+def print_summary(summary):
+    print('%-40s  %-8s  %8s  %s' % ('scenario', 'status', 'duration', 'waited for'))
+    for run in summary['scenarios']:
+        print('%-40s  %-8s  %8s  %s' % (run['name'], run['status'], _format_seconds(run['duration']),
+                                        ', '.join(run['waited_for']) or '-'))
+    print('Wall time %s seconds, %s seconds one after the other'
+          % (_format_seconds(summary['wall_time']), _format_seconds(summary['serial_time'])))
+
+
+def print_plan(suite):
+    for name, conflicts in suite.conflicts().items():
+        print('%-40s  %s' % (name, ', '.join(conflicts) or '-'))
+    for run in suite.runs:
+        if run.status == 'invalid':
+            print('%-40s  invalid: %s' % (run.name, run.error))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a directory of Enyo scenarios")
+    parser.add_argument('scenarios', nargs='+',
+                        help="Scenario files or directories of scenario files")
+    parser.add_argument('--pattern', default='*.yaml',
+                        help="Scenario files taken from the directories")
+    parser.add_argument('--workers', type=int, default=4,
+                        help="Number of scenarios running at the same time")
+    parser.add_argument('--output-dir', help="Directory for the logs of every scenario and the "
+                        "summary, defaults to a new directory in the log directory")
+    parser.add_argument('--plan', action='store_true',
+                        help="Only show which scenarios conflict with each other")
+    args = parser.parse_args()
+
+    scenario_files = []
+    for path in args.scenarios:
+        if os.path.isdir(path):
+            scenario_files.extend(sorted(glob.glob(os.path.join(path, args.pattern))))
+        else:
+            scenario_files.append(path)
+    output_dir = args.output_dir or os.path.join(config.get_value('log_dir'),
+                                                 datetime.now().strftime('suite-%Y%m%d-%H%M%S'))
+    suite = SuiteRunner(scenario_files, output_dir, args.workers)
+
+    if args.plan:
+        suite.plan()
+        print_plan(suite)
+        sys.exit(0)
+
+    os.makedirs(output_dir, exist_ok=True)
+    suite.run()
+    summary = suite.get_summary()
+    summary_file = os.path.join(output_dir, 'summary.json')
+    with open(summary_file, 'w') as f:
+        json.dump(summary, f, indent=2)
+    print_summary(summary)
+    print('Summary written to %s' % summary_file)
+    sys.exit(0 if all(run['status'] == 'done' for run in summary['scenarios']) else 1)
@@ -0,0 +1,302 @@
+'''
+    Parameter sweeps: one scenario template run with every combination of
+    the values of its parameters. A sweep spec names the template and the
+    values of every parameter:
+
+    scenario: scenario_nova.yaml
+    parameters:
+      injectors.nova-failure-node1.time: [60, 90, 120]
+      monitors.*.interval: [1, 2, 5]
+      injectors.*.host: [compute, controller]
+
+    A parameter is a dotted path into the scenario. On a mapping a segment
+    selects a key, on a list the item at an index, the items with that name
+    or with * all the items. The template path is relative to the spec.
+
+    The points of the matrix run through the suite runner, points which
+    don't conflict run at the same time. Every finished point is added to
+    the checkpoint file of the sweep, running the same sweep again only runs
+    the points which aren't in it yet. The recovery and workload metrics of
+    every point are written to results.csv.
+'''
+import os
+import sys
+import csv
+import json
+import copy
+import hashlib
+import argparse
+import itertools
+
+import yaml
+
+from enyo.config import Config
+from enyo.cli.suite import SuiteRunner
+
+config = Config()
+
+# metrics of a point, in the order of the table
+METRICS = ('outages', 'mttr', 'max_recovery', 'unrecovered', 'workload_recovery',
+           'iterations', 'error_rate', 'p50', 'p95')
+
+
+def _select(node, segment):
+    if isinstance(node, dict):
+        return [node[segment]] if segment in node else []
+    if isinstance(node, list):
+        if segment == '*':
+            return list(node)
+        if segment.isdigit():
+            return [node[int(segment)]] if int(segment) < len(node) else []
+        return [item for item in node if isinstance(item, dict) and item.get('name') == segment]
+    return []
+
+
+def set_value(scenario, path, value):
+    '''
+        Set the value at the dotted path of the scenario
+    '''
+    segments = path.split('.')
+    targets = [scenario]
+    for segment in segments[:-1]:
+        targets = [child for target in targets for child in _select(target, segment)]
+    targets = [target for target in targets if isinstance(target, dict)]
+    if len(targets) == 0:
+        raise ValueError('%s matches nothing in the scenario' % path)
+    for target in targets:
+        target[segments[-1]] = value
+
+
+class SweepPoint(object):
+    '''
+        One combination of parameter values. The key identifies the point
+        in the checkpoint, the name its scenario and run directory.
+    '''
+
+    def __init__(self, index, values):
+        self.index = index
+        self.values = values
+        self.key = hashlib.sha1(json.dumps(values, sort_keys=True).encode()).hexdigest()[:12]
+        self.name = 'point-%03d-%s' % (index, self.key[:6])
+
+
+class Sweep(object):
+
+    def __init__(self, spec_file, output_dir, workers):
+        with open(spec_file, 'r') as f:
+            spec = yaml.safe_load(f)
+        self.template_file = os.path.join(os.path.dirname(os.path.abspath(spec_file)),
+                                          spec['scenario'])
+        with open(self.template_file, 'r') as f:
+            self.template = yaml.safe_load(f)
+        self.parameters = spec['parameters']
+        self.output_dir = output_dir
+        self.workers = workers
+        self.scenario_dir = os.path.join(output_dir, 'scenarios')
+        self.run_dir = os.path.join(output_dir, 'runs')
+        self.checkpoint_file = os.path.join(output_dir, 'checkpoint.json')
+        self.points = self.expand()
+        self.results = self.load_checkpoint()
+
+    def expand(self):
+        '''
+            Every combination of the parameter values
+        '''
+        paths = list(self.parameters)
+        return [SweepPoint(index, dict(zip(paths, values)))
+                for index, values in enumerate(itertools.product(*(self.parameters[path]
+                                                                   for path in paths)))]
+
+    def load_checkpoint(self):
+        '''
+            Results of the points finished so far, by key
+        '''
+        results = {}
+        if os.path.exists(self.checkpoint_file):
+            with open(self.checkpoint_file, 'r') as f:
+                for line in f:
+                    # the last line is cut short if the sweep was killed writing it
+                    try:
+                        result = json.loads(line)
+                    except ValueError:
+                        continue
+                    results[result['key']] = result
+        return results
+
+    def get_scenario(self, point):
+        '''
+            The template with the values of the point, writing its outputs
+            to the point's run directory
+        '''
+        scenario = copy.deepcopy(self.template)
+        for path, value in point.values.items():
+            set_value(scenario, path, value)
+
+        run_dir = os.path.join(self.run_dir, point.name)
+        for monitor in scenario.get('monitors') or []:
+            monitor['output'] = os.path.join(run_dir, 'monitors', monitor['name'])
+        loader = scenario.get('loader') or {}
+        for key in ('report_file', 'log_file'):
+            if loader.get(key):
+                loader[key] = os.path.join(run_dir, os.path.basename(loader[key]))
+        return scenario
+
+    def write_scenario(self, point):
+        scenario = self.get_scenario(point)
+        os.makedirs(os.path.join(self.run_dir, point.name, 'monitors'), exist_ok=True)
+        scenario_file = os.path.join(self.scenario_dir, point.name + '.yaml')
+        with open(scenario_file, 'w') as f:
+            yaml.safe_dump(scenario, f, default_flow_style=False)
+        return scenario_file
+
+    def pending(self, retry_failed=False):
+        return [point for point in self.points if point.key not in self.results
+                or (retry_failed and self.results[point.key]['status'] != 'done')]
+
+    def run(self, retry_failed=False):
+        points = self.pending(retry_failed)
+        if len(points) == 0:
+            return
+        os.makedirs(self.scenario_dir, exist_ok=True)
+        by_name = dict((point.name, point) for point in points)
+        scenario_files = [self.write_scenario(point) for point in points]
+
+        with open(self.checkpoint_file, 'a') as checkpoint:
+            def finished(run):
+                point = by_name[run.name]
+                result = dict(key=point.key, name=point.name, values=point.values,
+                              status=run.status, duration=run.duration,
+                              metrics=collect_metrics(self.get_scenario(point)))
+                self.results[point.key] = result
+                checkpoint.write(json.dumps(result) + '\n')
+                checkpoint.flush()
+                os.fsync(checkpoint.fileno())
+
+            suite = SuiteRunner(scenario_files, self.run_dir, self.workers, on_finish=finished)
+            suite.run()
+            for run in suite.runs:
+                if run.status == 'invalid':
+                    print('%s is invalid: %s' % (run.name, run.error))
+
+    def get_table(self):
+        '''
+            Header and one row per point: the parameter values, the status
+            and the metrics
+        '''
+        paths = list(self.parameters)
+        header = paths + ['status', 'duration'] + list(METRICS)
+        rows = []
+        for point in self.points:
+            result = self.results.get(point.key)
+            if result is None:
+                rows.append([point.values[path] for path in paths] + ['pending'] +
+                            [None] * (len(METRICS) + 1))
+                continue
+            rows.append([point.values[path] for path in paths] +
+                        [result['status'], result['duration']] +
+                        [result['metrics'].get(metric) for metric in METRICS])
+        return header, rows
+
+
+def _read_json(file):
+    if not os.path.exists(file):
+        return None
+    with open(file, 'r') as f:
+        return json.load(f)
+
+
+def collect_metrics(scenario):
+    '''
+        Recovery and workload metrics of a finished run of scenario, from
+        the reports the runner wrote
+    '''
+    metrics = {}
+    outages = 0
+    downtime = 0.0
+    longest = None
+    unrecovered = 0
+    for monitor in scenario.get('monitors') or []:
+        report = _read_json(monitor['output'] + '.out') or {}
+        for summary in report.get('monitors', {}).values():
+            outages += summary['outages']
+            unrecovered += summary.get('unrecovered', 0)
+            if summary['outages']:
+                downtime += summary['mttr'] * summary['outages']
+                longest = max(longest or 0.0, summary['max'])
+    metrics.update(outages=outages, unrecovered=unrecovered, max_recovery=longest,
+                   mttr=downtime / outages if outages else None)
+
+    loader = scenario.get('loader') or {}
+    if loader.get('report_file'):
+        correlation = _read_json(loader['report_file'] + '.correlation.json') or {}
+        recoveries = [injection['workload_recovery'] for injection in correlation.get('injections', [])
+                      if injection.get('workload_recovery') is not None]
+        if recoveries:
+            metrics['workload_recovery'] = sum(recoveries) / len(recoveries)
+
+    if loader.get('type') == 'rally':
+        report = _read_json(loader['report_file'] + '.json.out') or {}
+        summaries = [workload['summary'] for workload in report.get('workloads', [])
+                     if workload['summary'].get('count')]
+        if summaries:
+            iterations = sum(summary['count'] for summary in summaries)
+            metrics.update(iterations=iterations,
+                           error_rate=sum(summary['errors'] for summary in summaries) / iterations)
+            # the slowest workload of the task
+            for percentile in ('p50', 'p95'):
+                values = [summary[percentile] for summary in summaries if percentile in summary]
+                if values:
+                    metrics[percentile] = max(values)
+    return metrics
+
+
+def _format(value):
+    if value is None:
+        return '-'
+    if isinstance(value, float):
+        return '%.2f' % value
+    return str(value)
+
+
+def print_table(header, rows):
+    cells = [header] + [[_format(value) for value in row] for row in rows]
+    widths = [max(len(row[column]) for row in cells) for column in range(len(header))]
+    for row in cells:
+        print('  '.join(cell.ljust(width) for cell, width in zip(row, widths)))
+
+
+def write_table(file, header, rows):
+    with open(file, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a scenario with every combination of parameters")
+    parser.add_argument('spec', help="Sweep spec file")
+    parser.add_argument('--workers', type=int, default=4,
+                        help="Number of points running at the same time")
+    parser.add_argument('--output-dir', help="Directory of the sweep, defaults to sweep-<spec name> "
+                        "in the log directory. Running a sweep again resumes it.")
+    parser.add_argument('--retry-failed', action='store_true',
+                        help="Run the points which failed again")
+    parser.add_argument('--list', action='store_true',
+                        help="Only show the points and the results so far")
+    args = parser.parse_args()
+
+    output_dir = args.output_dir or os.path.join(
+        config.get_value('log_dir'), 'sweep-' + os.path.splitext(os.path.basename(args.spec))[0])
+    sweep = Sweep(args.spec, output_dir, args.workers)
+    if not args.list:
+        done = len(sweep.points) - len(sweep.pending(args.retry_failed))
+        print('%s points, %s done before' % (len(sweep.points), done))
+        sweep.run(args.retry_failed)
+
+    header, rows = sweep.get_table()
+    print_table(header, rows)
+    if not args.list:
+        results_file = os.path.join(output_dir, 'results.csv')
+        write_table(results_file, header, rows)
+        print('Results written to %s' % results_file)
+    sys.exit(0 if all(result['status'] == 'done' for result in sweep.results.values()) else 1)
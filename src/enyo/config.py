@@ -1,15 +1,44 @@
 import os
 import json
+from threading import Lock
 
-CONFIG_FILE = os.environ['ENYO_CONFIG_FILE']
+CONFIG_FILE_VARIABLE = 'ENYO_CONFIG_FILE'
 
 class Config():
+    '''
+        The configuration of Enyo. There is only one instance, the file
+        named by ENYO_CONFIG_FILE is read the first time a value is needed,
+        so importing enyo doesn't need it.
+    '''
+    _instance = None
+    _lock = Lock()
 
-    def __init__(self):
-        with open(CONFIG_FILE, 'r') as f :
-            self._cfg = json.loads(f.read())
+    def __new__(cls):
+        with cls._lock:
+            if cls._instance is None:
+                cls._instance = object.__new__(cls)
+                cls._instance._cfg = None
+            return cls._instance
+
+    def _load(self):
+        with self._lock:
+            if self._cfg is None:
+                config_file = os.environ.get(CONFIG_FILE_VARIABLE)
+                if not config_file:
+                    raise RuntimeError('%s is not set' % CONFIG_FILE_VARIABLE)
+                with open(config_file, 'r') as f :
+                    self._cfg = json.loads(f.read())
+            return self._cfg
+
+    def reload(self):
+        '''
+            Read the file again the next time a value is needed
+        '''
+        with self._lock:
+            self._cfg = None
 
     def get_value(self, property):
-        if property not in self._cfg:
+        cfg = self._cfg if self._cfg is not None else self._load()
+        if property not in cfg:
             return None
-        return self._cfg[property]
\ No newline at end of file
+        return cfg[property]
@@ -1,36 +1,152 @@
 import os
-from threading import Timer
-import logging
+import time
+from threading import Thread, Event
 
 from enyo.config import Config
-from enyo.utils.ansible_api import Task, AnsibleRunner
-from enyo.utils.custom_logger import CustomLogger
+from enyo.utils import results, tracing
+from enyo.utils.task import Task
+from enyo.utils.custom_logger import CustomLogger, log_dir_file
 
 config = Config()
-LOG_FILE = os.path.join(config.get_value('log_dir'), 'injectors.log')
-logger = CustomLogger(LOG_FILE, name=__name__)
+logger = CustomLogger(log_dir_file('injectors.log'), name=__name__)
+injections_log = CustomLogger(log_dir_file('injections.json'), log_format='%(message)s', name='injections')
+# seconds before the injection the runner is prepared, has to stay below
+# the ssh ControlPersist time so the warmed up connection is still open
+PREPARE_LEAD = 20
 
 class BaseInjector(object):
+    '''
+        Injects a fault inject_at seconds after an anchor on the monotonic
+        clock. The Ansible runner is prepared ahead of the injection so the
+        fault lands as close as possible to its scheduled time.
+    '''
 
     def __init__(self, job_name, host, command, inject_at):
         self.job_name = job_name
         self.host = host
         self.command = command
         self.inject_at = inject_at
-        self.injection_thread = Timer(self.inject_at, self.__execute__)
+        self.prepare_lead = config.get_value('injection_prepare_lead') or PREPARE_LEAD
+        self.task = Task("shell", self.command).get_dict()
+        self.runner = None
+        self.deadline = None
+        self.scheduled_at = None
+        self.injected_at = None
+        self.finished_at = None
+        self.skew = None
+        # whether the command ran successfully on every host, None until
+        # it ran
+        self.succeeded = None
+        self.error = None
+        self.cancelled = Event()
+        self.injection_thread = Thread(target=self._run, name=job_name)
 
-    def inject(self):
+    def inject(self, anchor=None):
+        '''
+            anchor: monotonic time the injection time counts from, defaults
+            to now
+        '''
+        if anchor is None:
+            anchor = time.monotonic()
+        self.deadline = anchor + self.inject_at
+        self.scheduled_at = time.time() + (self.deadline - time.monotonic())
         logger.info("Running injection after %s seconds", str(self.inject_at))
         self.injection_thread.start()
 
+    def cancel(self):
+        self.cancelled.set()
+
     def wait_to_finish(self):
         logger.info("Waiting for injection thread to join")
-        self.injection_thread.join()
+        if self.injection_thread.ident is not None:
+            self.injection_thread.join()
         logger.info("Finished injection thread")
 
+    def _wait_until(self, deadline):
+        '''
+            Sleep until deadline, returns False if cancelled meanwhile
+        '''
+        with tracing.span('injector.wait', injector=self.job_name):
+            return not self.cancelled.wait(max(0, deadline - time.monotonic()))
+
+    def _run(self):
+        if not self._wait_until(self.deadline - self.prepare_lead):
+            return
+        try:
+            self.prepare()
+        except Exception as exception:
+            # the injection can still be tried without a warm runner
+            logger.error("Failed to prepare injection %s: %s", self.job_name, exception)
+        if not self._wait_until(self.deadline):
+            logger.info("Injection %s cancelled", self.job_name)
+            self.close()
+            return
+        try:
+            self.__execute__()
+        finally:
+            self.close()
+
+    def prepare(self):
+        logger.info("Preparing injection %s", self.job_name)
+        started = time.monotonic()
+        with tracing.span('injector.prepare', injector=self.job_name):
+            self.runner = self._create_runner()
+            self.runner.prepare(self.host, [self.task])
+        logger.info("Prepared injection %s in %.3f seconds", self.job_name,
+                    time.monotonic() - started)
+
+    def _create_runner(self):
+        from enyo.utils.ansible_api import AnsibleRunner
+        return AnsibleRunner(self.job_name, logger)
+
+    def close(self):
+        if self.runner is not None:
+            self.runner.close()
+            self.runner = None
+
     def __execute__(self):
         logger.info("Injecting : %s", str(self.command))
-        injection_task = Task("shell", self.command).get_dict()
-        runner = AnsibleRunner(self.job_name, logger)
-        runner.run(self.host, [injection_task])
-        logger.info("Finished injection")
+        if self.deadline is not None:
+            self.skew = time.monotonic() - self.deadline
+        self.injected_at = time.time()
+        with tracing.span('injector.execute', injector=self.job_name, host=self.host,
+                          skew=self.skew):
+            if self.runner is None:
+                self.runner = self._create_runner()
+            try:
+                self.runner.run(self.host, [self.task])
+            finally:
+                self.finished_at = time.time()
+                self._check(self.runner.results_callback.take())
+                results.write_record(injections_log, self.get_record())
+        logger.info("Finished injection, skew %s seconds", self.skew)
+
+    def _check(self, records):
+        '''
+            Whether the command succeeded on every host, from the records of
+            the run
+        '''
+        failed = [record for record in records if not record['success']]
+        self.succeeded = len(records) > 0 and len(failed) == 0
+        if len(records) == 0:
+            self.error = 'No host of %s ran the injection' % self.host
+        elif failed:
+            self.error = '; '.join('%s: %s' % (record['host'], record['error'] or
+                                               'return code %s' % record.get('return_code'))
+                                   for record in failed)
+        if not self.succeeded:
+            logger.error("Injection %s failed: %s", self.job_name, self.error)
+
+    def get_record(self):
+        return {
+                 'job_name': self.job_name,
+                 'host': self.host,
+                 'command': self.command,
+                 'inject_at': self.inject_at,
+                 'scheduled': self.scheduled_at,
+                 'time': self.injected_at,
+                 'finished': self.finished_at,
+                 'skew': self.skew,
+                 'success': self.succeeded,
+                 'error': self.error
+               }
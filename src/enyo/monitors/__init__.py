@@ -1,35 +1,128 @@
-
 import os
-from threading import Timer, Thread
+import time
+from threading import Lock
 
 from enyo.config import Config
-from enyo.utils.ansible_api import Task, AnsibleRunner
-from enyo.utils.custom_logger import CustomLogger
+from enyo.utils.task import Task
+from enyo.utils import tracing
+from enyo.utils.inventory import Inventory
+from enyo.utils.custom_logger import CustomLogger, log_dir_file
 
 config = Config()
-LOG_FILE = os.path.join(config.get_value('log_dir'), 'monitors.log')
-logger = CustomLogger(LOG_FILE, name=__name__)
+logger = CustomLogger(log_dir_file('monitors.log'), name=__name__)
+
+# a tick starting later than this fraction of the interval after its
+# deadline is counted as a missed deadline
+LATE_TOLERANCE = 0.1
+
+class MonitorStats(object):
+
+    def __init__(self):
+        self._lock = Lock()
+        self.ticks = 0
+        self.missed = 0
+        self.overruns = 0
+        self.max_lateness = 0.0
+        self.total_lateness = 0.0
+        self.total_duration = 0.0
+        self.max_duration = 0.0
+
+    def add_tick(self, lateness, duration, late):
+        with self._lock:
+            self.ticks += 1
+            self.missed += int(late)
+            self.max_lateness = max(self.max_lateness, lateness)
+            self.total_lateness += lateness
+            self.total_duration += duration
+            self.max_duration = max(self.max_duration, duration)
+
+    def add_missed(self, count=1):
+        with self._lock:
+            self.missed += count
+
+    def add_overrun(self):
+        with self._lock:
+            self.overruns += 1
+            self.missed += 1
 
-class BaseMonitor(Thread):
+    def get_dict(self):
+        with self._lock:
+            return dict(ticks=self.ticks,
+                        missed=self.missed,
+                        overruns=self.overruns,
+                        mean_lateness=self.total_lateness / self.ticks if self.ticks else 0.0,
+                        max_lateness=self.max_lateness,
+                        mean_duration=self.total_duration / self.ticks if self.ticks else 0.0,
+                        max_duration=self.max_duration)
 
-    def __init__(self, job_name, host, command, interval, output, stop_event):
-        Thread.__init__(self)
+
+def create_runner(backend, job_name, logger):
+    '''
+        Runner of a monitor backend writing the records to logger
+    '''
+    if backend == 'ansible':
+        from enyo.utils.ansible_api import AnsibleRunner
+        return AnsibleRunner(job_name, logger)
+    elif backend == 'async':
+        from enyo.monitors.async_runner import AsyncProbeRunner
+        return AsyncProbeRunner(job_name, logger)
+    raise ValueError('Unknown monitor backend %s' % backend)
+
+
+def check_interval(job_name, interval):
+    '''
+        Monitors are scheduled every interval seconds, 0 or less would tick
+        without end
+    '''
+    if isinstance(interval, bool) or not isinstance(interval, (int, float)) or interval <= 0:
+        raise ValueError('Interval of monitor %s must be a positive number of seconds, not %r'
+                         % (job_name, interval))
+
+
+class BaseMonitor(object):
+    '''
+        A single monitor. It doesn't run on its own, ticks are dispatched by
+        the MonitorScheduler at the configured interval.
+    '''
+    streaming = False
+
+    def __init__(self, job_name, host, command, interval, output, backend=None):
+        check_interval(job_name, interval)
         self.job_name = job_name
         self.host = host
+        if not Inventory.get().resolve(host):
+            raise ValueError('No hosts match %s of monitor %s' % (host, job_name))
         self.command = command
         self.interval = interval
-        self.stopped = stop_event
         self.monitoring_log = CustomLogger(output,
                                            log_format='%(message)s',
                                            name=job_name)
+        self.stats = MonitorStats()
+        self.task = Task("shell", self.command).get_dict()
+        self.backend = backend or config.get_value('monitor_backend') or 'ansible'
+        self.runner = create_runner(self.backend, self.job_name, self.monitoring_log)
 
-    def run(self):
-        logger.info("Running %s monitor every %s seconds", self.name, str(self.interval))
-        while not self.stopped.wait(self.interval):
+    def tick(self, deadline):
+        '''
+            Run one probe which was due at deadline (monotonic clock)
+        '''
+        lateness = time.monotonic() - deadline
+        started = time.monotonic()
+        try:
             self.__execute__()
+        except Exception as exception:
+            logger.error("Monitor %s failed: %s", self.job_name, exception)
+        duration = time.monotonic() - started
+        self.stats.add_tick(lateness, duration, lateness > self.interval * LATE_TOLERANCE)
+        logger.debug("Monitor %s took %.3f seconds, %.3f seconds late",
+                     self.job_name, duration, lateness)
+
+    def close(self):
+        self.runner.close()
+        # a long lived process runs many scenarios, don't keep their logs open
+        self.monitoring_log.close()
 
     def __execute__(self):
         logger.debug("Running %s for monitoring on host %s", self.command, self.host)
-        injection_task = Task("shell", self.command).get_dict()
-        runner = AnsibleRunner(self.job_name, self.monitoring_log)
-        runner.run(self.host, [injection_task])
\ No newline at end of file
+        with tracing.span('monitor.execute', monitor=self.job_name, host=self.host):
+            self.runner.run(self.host, [self.task])
@@ -0,0 +1,271 @@
+'''
+    Lightweight monitor backend which runs the probe commands directly on an
+    asyncio loop instead of going through Ansible. Remote hosts are reached
+    with ssh over multiplexed connections which stay open between ticks,
+    hosts using the local connection run the command as a local subprocess.
+    The connection variables are read from the same inventory Ansible uses.
+'''
+import asyncio
+import atexit
+import os
+import shlex
+import shutil
+import subprocess
+import tempfile
+from threading import Thread, Lock
+
+from enyo.config import Config
+from enyo.utils import results
+from enyo.utils.inventory import Inventory
+from . import logger
+
+config = Config()
+DEFAULT_TIMEOUT = 30
+DEFAULT_CONCURRENCY = 256
+DEFAULT_PYTHON = 'python3'
+CONTROL_PERSIST = '300s'
+# ssh exits with 255 when the connection itself failed
+SSH_CONNECTION_ERROR = 255
+
+
+class ProbeLoop(object):
+    '''
+        A single asyncio loop running in its own thread, shared by all the
+        async runners of the process
+    '''
+    _instance = None
+    _lock = Lock()
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.semaphore = None
+        self.thread = Thread(target=self._run, name='probe-loop', daemon=True)
+        self.thread.start()
+
+    @classmethod
+    def get(cls):
+        with cls._lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def run(self, coroutine):
+        '''
+            Run coroutine on the loop and wait for its result
+        '''
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def submit(self, coroutine):
+        '''
+            Start coroutine on the loop, returns its future
+        '''
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    async def limit(self):
+        '''
+            Semaphore bounding the number of probes running at once
+        '''
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(config.get_value('probe_concurrency')
+                                               or DEFAULT_CONCURRENCY)
+        return self.semaphore
+
+
+class SSHOptions(object):
+    '''
+        Builds command lines for running a command on a host from the
+        Ansible connection variables of the host
+    '''
+    _control_dir = None
+    _lock = Lock()
+
+    @classmethod
+    def control_dir(cls):
+        with cls._lock:
+            if cls._control_dir is None:
+                cls._control_dir = tempfile.mkdtemp(prefix='enyo-ssh-')
+                atexit.register(cls.close_all)
+            return cls._control_dir
+
+    @classmethod
+    def close_all(cls):
+        '''
+            Stop the ssh master connections and remove their sockets
+        '''
+        if cls._control_dir is None:
+            return
+        for name in os.listdir(cls._control_dir):
+            subprocess.call(['ssh', '-o', 'ControlPath=' + os.path.join(cls._control_dir, name),
+                             '-O', 'exit', 'enyo'],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        shutil.rmtree(cls._control_dir, True)
+        cls._control_dir = None
+
+
+def is_local(host_vars):
+    return host_vars.get('ansible_connection') == 'local'
+
+
+def python_interpreter(host_vars):
+    '''
+        Interpreter running enyo's helper scripts on the host: host_python
+        from the config, else the one Ansible uses on the host
+    '''
+    python = config.get_value('host_python') or host_vars.get('ansible_python_interpreter')
+    if not python or python.startswith('auto'):
+        return DEFAULT_PYTHON
+    return python
+
+
+def _is_true(value):
+    return str(value).lower() in ('true', 'yes', '1')
+
+
+def remote_command(host_vars, command):
+    '''
+        The shell command to run on the target, wrapped in sudo when the host
+        requires privilege escalation to another user
+    '''
+    user = host_vars.get('ansible_user', host_vars.get('ansible_ssh_user', 'root'))
+    become_user = host_vars.get('ansible_become_user', 'root')
+    shell_command = '/bin/sh -c ' + shlex.quote(command)
+    if _is_true(host_vars.get('ansible_become', False)) and user != become_user:
+        return 'sudo -n -H -u %s %s' % (shlex.quote(become_user), shell_command)
+    return shell_command
+
+
+def build_command(host_vars, command, timeout=DEFAULT_TIMEOUT):
+    '''
+        argv and environment to run command on the host described by host_vars
+    '''
+    if is_local(host_vars):
+        return ['/bin/sh', '-c', command], None
+
+    address = host_vars.get('ansible_host', host_vars.get('ansible_ssh_host',
+                                                           host_vars['inventory_hostname']))
+    user = host_vars.get('ansible_user', host_vars.get('ansible_ssh_user'))
+    port = host_vars.get('ansible_port', host_vars.get('ansible_ssh_port'))
+    key_file = host_vars.get('ansible_ssh_private_key_file',
+                             host_vars.get('ansible_private_key_file'))
+    password = host_vars.get('ansible_ssh_pass', host_vars.get('ansible_password'))
+
+    argv = ['ssh',
+            '-o', 'ControlMaster=auto',
+            '-o', 'ControlPersist=' + CONTROL_PERSIST,
+            '-o', 'ControlPath=' + os.path.join(SSHOptions.control_dir(), '%C'),
+            '-o', 'ConnectTimeout=%d' % timeout]
+    if password is None:
+        argv += ['-o', 'BatchMode=yes']
+    if port:
+        argv += ['-p', str(port)]
+    if key_file:
+        argv += ['-i', key_file]
+    if user:
+        argv += ['-l', user]
+    argv += shlex.split(host_vars.get('ansible_ssh_common_args', ''))
+    argv += shlex.split(host_vars.get('ansible_ssh_extra_args', ''))
+    argv += [address, remote_command(host_vars, command)]
+
+    env = None
+    if password is not None:
+        # sshpass reads the password from the environment so it never shows up in ps
+        argv = ['sshpass', '-e'] + argv
+        env = dict(os.environ, SSHPASS=str(password))
+    return argv, env
+
+
+class AsyncProbeRunner(object):
+    '''
+        Drop-in replacement of AnsibleRunner for monitors. Only shell tasks
+        are supported; the result records are the same ResultsCollector
+        writes.
+    '''
+
+    def __init__(self, job_name, logger, inventory=None, timeout=None):
+        self.job_name = job_name
+        self.logger = logger
+        self.inventory = Inventory.get(inventory)
+        self.timeout = timeout or config.get_value('probe_timeout') or DEFAULT_TIMEOUT
+        self.probe_loop = ProbeLoop.get()
+
+    def run(self, hosts, tasks):
+        commands = []
+        for task in tasks:
+            action = task['action']
+            if action['module'] != 'shell':
+                raise ValueError('Only shell tasks can run without Ansible, got %s' % action['module'])
+            commands.append(action['args'])
+        return self.probe_loop.run(self.run_async(hosts, commands))
+
+    def run_commands(self, host_commands):
+        '''
+            Run a different command on every host at the same time, returns
+            the records
+        '''
+        return self.probe_loop.run(self._run_commands(host_commands))
+
+    async def _run_commands(self, host_commands):
+        return await asyncio.gather(*[self._probe(host, command)
+                                      for host, command in host_commands.items()])
+
+    async def run_async(self, hosts, commands):
+        records = []
+        for command in commands:
+            records.extend(await asyncio.gather(*[self._probe(host, command)
+                                                  for host in self.inventory.resolve(hosts)]))
+        return records
+
+    async def _probe(self, host, command):
+        host_vars = self.inventory.host_vars(host)
+        argv, env = build_command(host_vars, command, self.timeout)
+        semaphore = await self.probe_loop.limit()
+        async with semaphore:
+            try:
+                process = await asyncio.create_subprocess_exec(*argv, env=env,
+                                                               stdin=subprocess.DEVNULL,
+                                                               stdout=subprocess.PIPE,
+                                                               stderr=subprocess.PIPE)
+            except OSError as exception:
+                record = results.unreachable_record(self.job_name, results.now(), host, str(exception))
+                self._write(record)
+                return record
+
+            try:
+                stdout, stderr = await asyncio.wait_for(process.communicate(), self.timeout)
+            except asyncio.TimeoutError:
+                process.kill()
+                await process.wait()
+                record = results.unreachable_record(self.job_name, results.now(), host,
+                                                    'Timed out after %s seconds' % self.timeout)
+                self._write(record)
+                return record
+
+        end = results.now()
+        # Ansible strips the trailing newline of the shell module's output
+        stdout = stdout.decode('utf-8', 'replace').rstrip('\r\n')
+        stderr = stderr.decode('utf-8', 'replace').rstrip('\r\n')
+        return_code = process.returncode
+
+        if not is_local(host_vars) and return_code == SSH_CONNECTION_ERROR:
+            record = results.unreachable_record(self.job_name, end, host, stderr)
+        elif return_code == 0:
+            record = results.ok_record(self.job_name, end, host, command, return_code, stdout)
+        else:
+            record = results.failed_record(self.job_name, end, host, command, return_code,
+                                           stdout, stderr)
+        self._write(record)
+        return record
+
+    def _write(self, record):
+        # without a logger the records are only returned
+        if self.logger is not None:
+            results.write_record(self.logger, record)
+
+    def close(self):
+        # the ssh master connections are shared with the other runners and
+        # are stopped when the process exits
+        pass
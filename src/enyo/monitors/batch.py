@@ -0,0 +1,266 @@
+'''
+    Monitors probing the same hosts at the same interval are run as one
+    batch: every tick each host runs a small Python script which starts all
+    the commands of the batch for that host at once and prints their return
+    codes, output and times as JSON. The results are split up again into
+    the records of every monitor, so a host gets one connection per tick
+    instead of one per monitor.
+
+    The Ansible backend runs the whole batch as one play whose task picks
+    the commands of each host by its inventory name, the async backend runs
+    the script of every host over its own ssh connection, local hosts aren't
+    batched there. Hosts which can't run the script, e.g. without python3,
+    are probed by every monitor on its own again.
+'''
+import json
+import time
+import base64
+import shlex
+
+from enyo.config import Config
+from enyo.utils import results, tracing
+from enyo.utils.task import Task
+from enyo.utils.inventory import Inventory
+from . import logger, create_runner, LATE_TOLERANCE
+from .async_runner import is_local, python_interpreter, DEFAULT_PYTHON
+
+config = Config()
+DEFAULT_TIMEOUT = 30
+# backends running shell commands on the hosts
+BATCHED_BACKENDS = ('ansible', 'async')
+
+# runs on the monitored hosts, has to stay compatible with their Python
+BATCH_SCRIPT = '''
+import base64, json, subprocess, sys, threading, time
+batch = json.loads(base64.b64decode(sys.argv[1]).decode())
+results = {}
+def run(key, command):
+    started = time.time()
+    process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        stdout, stderr = process.communicate(timeout=batch['timeout'])
+        code = process.returncode
+    except subprocess.TimeoutExpired:
+        process.kill()
+        stdout, stderr = process.communicate()
+        code = None
+    results[key] = dict(rc=code, stdout=stdout.decode('utf-8', 'replace'),
+                        stderr=stderr.decode('utf-8', 'replace'), start=started, end=time.time())
+threads = [threading.Thread(target=run, args=command) for command in batch['commands'].get(sys.argv[2], [])]
+for thread in threads:
+    thread.start()
+for thread in threads:
+    thread.join()
+sys.stdout.write(json.dumps(dict(now=time.time(), results=results)))
+'''
+
+
+def batch_command(commands, host, timeout, python=DEFAULT_PYTHON):
+    '''
+        Shell command running the batch script on host. commands maps the
+        hosts to their (key, command) pairs, host is the inventory name
+        of the host the script runs on.
+    '''
+    payload = json.dumps(dict(timeout=timeout, commands=commands))
+    # base64 keeps the commands out of the reach of quoting and templating
+    encoded = base64.b64encode(payload.encode()).decode()
+    return '%s -c %s %s %s' % (python, shlex.quote(BATCH_SCRIPT), encoded, host)
+
+
+def parse_batch_output(output):
+    '''
+        The results printed by the batch script, None if the script didn't
+        run
+    '''
+    try:
+        batch = json.loads(output)
+    except (TypeError, ValueError):
+        return None
+    if not isinstance(batch, dict) or 'results' not in batch:
+        return None
+    return batch
+
+
+class _BatchStats(object):
+    '''
+        Ticks of a batch count for all its monitors
+    '''
+
+    def __init__(self, monitors):
+        self.monitors = monitors
+
+    def add_tick(self, lateness, duration, late):
+        for monitor in self.monitors:
+            monitor.stats.add_tick(lateness, duration, late)
+
+    def add_missed(self, count=1):
+        for monitor in self.monitors:
+            monitor.stats.add_missed(count)
+
+    def add_overrun(self):
+        for monitor in self.monitors:
+            monitor.stats.add_overrun()
+
+
+class MonitorBatch(object):
+    '''
+        Monitors with the same interval and backend, scheduled as one.
+        hosts maps every host to the indexes of the monitors probing it.
+    '''
+
+    def __init__(self, monitors, hosts):
+        self.monitors = monitors
+        self.hosts = hosts
+        self.interval = monitors[0].interval
+        self.backend = monitors[0].backend
+        self.job_name = 'batch(%s)' % ', '.join(monitor.job_name for monitor in monitors)
+        self.stats = _BatchStats(monitors)
+        self.timeout = config.get_value('probe_timeout') or DEFAULT_TIMEOUT
+        # hosts which couldn't run the script, probed by every monitor again
+        self.unbatched = set()
+        self.runner = create_runner(self.backend, self.job_name, None)
+
+    def _commands(self, hosts):
+        return dict((host, [(str(index), self.monitors[index].command)
+                            for index in self.hosts[host]])
+                    for host in hosts)
+
+    def _run_batch(self, hosts):
+        '''
+            The records of the batch script on every host
+        '''
+        commands = self._commands(hosts)
+        inventory = Inventory.get()
+        if self.backend == 'ansible':
+            # one play per interpreter, the task picks the commands of
+            # every host
+            by_python = {}
+            for host in hosts:
+                by_python.setdefault(python_interpreter(inventory.host_vars(host)), []).append(host)
+            records = []
+            for python, python_hosts in by_python.items():
+                command = batch_command(dict((host, commands[host]) for host in python_hosts),
+                                        '{{ inventory_hostname }}', self.timeout, python)
+                # as cmd, Ansible doesn't parse the = in the script as arguments
+                self.runner.run(':'.join(python_hosts),
+                                [Task("shell", dict(cmd=command)).get_dict()])
+                records.extend(self.runner.results_callback.take())
+            return records
+        return self.runner.run_commands(dict(
+            (host, batch_command(dict([(host, commands[host])]), host, self.timeout,
+                                 python_interpreter(inventory.host_vars(host))))
+            for host in hosts))
+
+    def tick(self, deadline):
+        lateness = time.monotonic() - deadline
+        started = time.monotonic()
+        try:
+            with tracing.span('monitor.batch', monitors=len(self.monitors)):
+                self.__execute__()
+        except Exception as exception:
+            logger.error("Monitor batch %s failed: %s", self.job_name, exception)
+        duration = time.monotonic() - started
+        self.stats.add_tick(lateness, duration, lateness > self.interval * LATE_TOLERANCE)
+
+    def __execute__(self):
+        # hosts failing the batch in this tick are probed by _demultiplex
+        unbatched = list(self.unbatched)
+        hosts = [host for host in self.hosts if host not in self.unbatched]
+        if hosts:
+            for record in self._run_batch(hosts):
+                self._demultiplex(record)
+        for host in unbatched:
+            for index in self.hosts[host]:
+                monitor = self.monitors[index]
+                monitor.runner.run(host, [monitor.task])
+
+    def _demultiplex(self, record):
+        '''
+            Write the records of the monitors from the record of the batch
+            script on one host
+        '''
+        host = record['host']
+        indexes = self.hosts[host]
+        if 'return_code' not in record:
+            # the host is unreachable for all the monitors
+            for index in indexes:
+                monitor = self.monitors[index]
+                results.write_record(monitor.monitoring_log, results.unreachable_record(
+                    monitor.job_name, record['time'], host, record.get('error')))
+            return
+
+        batch = parse_batch_output(record['output'])
+        if batch is None:
+            logger.warning("Batch script failed on %s, probing it with every monitor: %s",
+                           host, record.get('error') or record['output'])
+            self.unbatched.add(host)
+            for index in indexes:
+                monitor = self.monitors[index]
+                monitor.runner.run(host, [monitor.task])
+            return
+
+        # the command times are on the host's clock, the record time on the
+        # clock of the backend
+        offset = record['time'] - batch['now']
+        for index in indexes:
+            monitor = self.monitors[index]
+            result = batch['results'].get(str(index))
+            if result is None:
+                monitor_record = results.unreachable_record(monitor.job_name, record['time'],
+                                                            host, 'No result from the batch')
+            elif result['rc'] is None:
+                monitor_record = results.unreachable_record(
+                    monitor.job_name, result['end'] + offset, host,
+                    'Timed out after %s seconds' % self.timeout)
+            elif result['rc'] == 0:
+                monitor_record = results.ok_record(monitor.job_name, result['end'] + offset, host,
+                                                   monitor.command, result['rc'],
+                                                   result['stdout'].rstrip('\r\n'))
+            else:
+                monitor_record = results.failed_record(monitor.job_name, result['end'] + offset,
+                                                       host, monitor.command, result['rc'],
+                                                       result['stdout'].rstrip('\r\n'),
+                                                       result['stderr'].rstrip('\r\n'))
+            results.write_record(monitor.monitoring_log, monitor_record)
+
+    def close(self):
+        self.runner.close()
+        for monitor in self.monitors:
+            monitor.close()
+
+
+def group_monitors(monitors, inventory=None):
+    '''
+        Monitors to schedule: monitors of the same backend and interval
+        sharing a host are folded into a MonitorBatch, the others stay on
+        their own
+    '''
+    inventory = inventory or Inventory.get()
+    groups = {}
+    units = []
+    for monitor in monitors:
+        if monitor.backend not in BATCHED_BACKENDS:
+            units.append(monitor)
+            continue
+        hosts = inventory.resolve(monitor.host)
+        if not hosts or (monitor.backend == 'async' and any(
+                is_local(inventory.host_vars(host)) for host in hosts)):
+            # e.g. Ansible's implicit localhost. The async backend runs
+            # commands on local hosts without a connection, starting the
+            # script costs more than it saves.
+            units.append(monitor)
+            continue
+        groups.setdefault((monitor.backend, monitor.interval), []).append((monitor, hosts))
+
+    for members in groups.values():
+        hosts = {}
+        for index, (monitor, monitor_hosts) in enumerate(members):
+            for host in monitor_hosts:
+                hosts.setdefault(host, []).append(index)
+        if all(len(indexes) == 1 for indexes in hosts.values()):
+            units.extend(monitor for monitor, _ in members)
+            continue
+        batch = MonitorBatch([monitor for monitor, _ in members], hosts)
+        logger.info("Batching %s monitors on %s hosts", len(members), len(hosts))
+        units.append(batch)
+    return units
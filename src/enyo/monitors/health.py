@@ -0,0 +1,141 @@
+'''
+    Follows the monitors while they run. Every record a monitor writes goes
+    through a state machine of its series (monitor and host), which turns
+    the down -> up transitions into outages as they happen instead of after
+    the run. The transitions are the ones RecoveryReporter finds in the
+    monitor logs: a series is down from its first failed sample until its
+    first successful one.
+'''
+import time
+from threading import Condition
+
+from enyo.utils.results import to_epoch
+
+UP = 'up'
+DOWN = 'down'
+
+
+class SeriesState(object):
+
+    def __init__(self, job_name, host, state, since):
+        self.job_name = job_name
+        self.host = host
+        self.state = state
+        # time of the last transition, or of the first sample
+        self.since = since
+        self.last = since
+        # time of the last down transition
+        self.down_at = None
+        self.outages = 0
+
+    def get_dict(self):
+        return dict(job_name=self.job_name, host=self.host, state=self.state, since=self.since,
+                    down_at=self.down_at, outages=self.outages)
+
+
+class HealthTracker(object):
+    '''
+        State of every series of the monitors named job_names. feed() is
+        the results listener, on_event is called with every down and up
+        event.
+    '''
+
+    def __init__(self, job_names, on_event=None):
+        self.job_names = frozenset(job_names)
+        self.on_event = on_event
+        self.series = {}
+        self.events = []
+        self._changed = Condition()
+
+    def feed(self, record):
+        job_name = record.get('job_name')
+        if job_name not in self.job_names:
+            return
+        record_time = to_epoch(record['time'])
+        failed = record.get('return_code', -1) != 0
+        event = None
+        with self._changed:
+            key = (job_name, record['host'])
+            series = self.series.get(key)
+            if series is None:
+                # like the reporter, every series starts healthy
+                series = SeriesState(job_name, record['host'], UP, record_time)
+                self.series[key] = series
+            elif record_time < series.last:
+                # a tick finishing after a later one, the series moved on
+                return
+            series.last = record_time
+
+            if failed and series.state == UP:
+                series.state = DOWN
+                series.since = record_time
+                series.down_at = record_time
+                series.outages += 1
+                event = dict(event=DOWN, job_name=job_name, host=series.host, time=record_time)
+            elif not failed and series.state == DOWN:
+                event = dict(event=UP, job_name=job_name, host=series.host, time=record_time,
+                             duration=record_time - series.since)
+                series.state = UP
+                series.since = record_time
+            if event is not None:
+                self.events.append(event)
+            self._changed.notify_all()
+        if event is not None and self.on_event is not None:
+            self.on_event(event)
+
+    def healthy_since(self):
+        '''
+            Time since when every series is up, None while a series is down
+            or a monitor hasn't reported yet
+        '''
+        with self._changed:
+            reported = set(job_name for job_name, _ in self.series)
+            if reported != self.job_names:
+                return None
+            if any(series.state == DOWN for series in self.series.values()):
+                return None
+            return max(series.since for series in self.series.values())
+
+    def get_recovery(self, targets):
+        '''
+            Recovery of the series targeted by injections
+
+            targets: the job names (None for all monitors), hosts and
+            injection time of every injection
+            returns the job names and hosts targeted which haven't gone down
+            since their injection, '*' for the job name of a host without
+            any series, and the time since when all the targeted series are
+            up again, None until then
+        '''
+        with self._changed:
+            targeted = []
+            undetected = []
+            for job_names, hosts, injected_at in targets:
+                for host in hosts:
+                    series = [state for state in self.series.values() if state.host == host
+                              and (job_names is None or state.job_name in job_names)]
+                    if not series:
+                        undetected.append(('*', host))
+                    undetected.extend((state.job_name, state.host) for state in series
+                                      if state.down_at is None or state.down_at < injected_at)
+                    targeted.extend(series)
+            if not targeted or undetected or any(state.state == DOWN for state in targeted):
+                return undetected, None
+            return undetected, max(state.since for state in targeted)
+
+    def wait(self, timeout):
+        '''
+            Wait at most timeout seconds for the next record
+        '''
+        with self._changed:
+            self._changed.wait(timeout)
+
+    def get_health(self):
+        with self._changed:
+            series = [state.get_dict() for state in self.series.values()]
+            recoveries = [event['duration'] for event in self.events if event['event'] == UP]
+        down = [state for state in series if state['state'] == DOWN]
+        return dict(healthy=len(down) == 0 and len(series) > 0, time=time.time(),
+                    down=len(down), series=series, outages=sum(state['outages'] for state in series),
+                    recovered=len(recoveries), recoveries=recoveries)
+
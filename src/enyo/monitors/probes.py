@@ -0,0 +1,268 @@
+'''
+    Native probes, run by enyo itself on the probe loop instead of a shell
+    command on a host. A monitor with a probe checks every host of its host
+    pattern at once, each check with its own timeout:
+
+    - name: keystone-api
+      probe: http
+      host: controller
+      url: http://{address}:5000/v3
+      interval: 1
+      output: /var/log/enyo/keystone-api
+
+    tcp connects to port, http sends a request to url and checks the status
+    against expect, one status or a list of them (any status below 400 by
+    default), udp sends payload to port and waits for a reply containing
+    expect. {address} in url is the ansible_host of the host. Host patterns
+    which aren't in the inventory are taken as addresses, targets lists
+    addresses to use instead of a host pattern. file and pidfile check a
+    path on the machine enyo runs on.
+
+    The records are the ones of the shell monitors, the command is the probe
+    and its target. They also carry the connect and response latency in
+    seconds where the probe has them.
+'''
+import os
+import ssl
+import time
+import asyncio
+from urllib.parse import urlsplit
+
+from enyo.config import Config
+from enyo.utils import results, tracing
+from enyo.utils.inventory import Inventory
+from enyo.utils.custom_logger import CustomLogger
+from . import BaseMonitor, MonitorStats, logger, check_interval
+from .async_runner import ProbeLoop
+
+config = Config()
+DEFAULT_PROBE_TIMEOUT = 5
+
+
+async def _close(writer):
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except OSError:
+        pass
+
+
+async def probe_tcp(address, options):
+    started = time.perf_counter()
+    _, writer = await asyncio.open_connection(address, options['port'])
+    connect_latency = time.perf_counter() - started
+    await _close(writer)
+    return dict(return_code=0, output='', connect_latency=connect_latency)
+
+
+def _ssl_context(options):
+    context = ssl.create_default_context()
+    if options.get('verify') is False:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+async def probe_http(address, options):
+    parts = urlsplit(options['url'].format(address=address))
+    https = parts.scheme == 'https'
+    path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+    started = time.perf_counter()
+    reader, writer = await asyncio.open_connection(parts.hostname,
+                                                   parts.port or (443 if https else 80),
+                                                   ssl=_ssl_context(options) if https else None)
+    connect_latency = time.perf_counter() - started
+    try:
+        writer.write(('%s %s HTTP/1.1\r\nHost: %s\r\nUser-Agent: enyo\r\nConnection: close\r\n\r\n'
+                      % (options.get('method', 'GET'), path, parts.netloc)).encode())
+        await writer.drain()
+        status_line = (await reader.readline()).decode('latin-1').strip()
+        response_latency = time.perf_counter() - started
+    finally:
+        await _close(writer)
+
+    fields = status_line.split()
+    if len(fields) < 2 or not fields[1].isdigit():
+        return dict(return_code=1, output=status_line, error='Not an HTTP response',
+                    connect_latency=connect_latency, response_latency=response_latency)
+    status = int(fields[1])
+    expect = options.get('expect')
+    if isinstance(expect, int):
+        expect = [expect]
+    healthy = status in expect if expect else status < 400
+    result = dict(return_code=0 if healthy else status, output=status_line,
+                  connect_latency=connect_latency, response_latency=response_latency)
+    if not healthy:
+        result['error'] = 'Unexpected status %s' % status
+    return result
+
+
+class _Reply(asyncio.DatagramProtocol):
+
+    def __init__(self, reply):
+        self.reply = reply
+
+    def datagram_received(self, data, address):
+        if not self.reply.done():
+            self.reply.set_result(data)
+
+    def error_received(self, exception):
+        # e.g. the ICMP port unreachable of a closed port
+        if not self.reply.done():
+            self.reply.set_exception(exception)
+
+
+async def probe_udp(address, options):
+    loop = asyncio.get_running_loop()
+    reply = loop.create_future()
+    transport, _ = await loop.create_datagram_endpoint(lambda: _Reply(reply),
+                                                       remote_addr=(address, options['port']))
+    try:
+        started = time.perf_counter()
+        transport.sendto(options.get('payload', '').encode())
+        data = await reply
+        response_latency = time.perf_counter() - started
+    finally:
+        transport.close()
+    output = data.decode('utf-8', 'replace')
+    expect = options.get('expect')
+    if expect is not None and expect not in output:
+        return dict(return_code=1, output=output, error='Reply without %s' % expect,
+                    response_latency=response_latency)
+    return dict(return_code=0, output=output, response_latency=response_latency)
+
+
+async def probe_file(address, options):
+    if os.path.exists(options['path']):
+        return dict(return_code=0, output='')
+    return dict(return_code=1, output='', error='%s does not exist' % options['path'])
+
+
+async def probe_pidfile(address, options):
+    try:
+        with open(options['path'], 'r') as f:
+            pid = int(f.read().strip())
+    except (OSError, ValueError) as exception:
+        return dict(return_code=1, output='', error=str(exception))
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return dict(return_code=1, output=str(pid), error='No process %s' % pid)
+    except PermissionError:
+        # the process exists, it only belongs to someone else
+        pass
+    return dict(return_code=0, output=str(pid))
+
+
+PROBES = {
+    'tcp': probe_tcp,
+    'http': probe_http,
+    'udp': probe_udp,
+    'file': probe_file,
+    'pidfile': probe_pidfile,
+}
+# probes checking the machine enyo runs on, once per tick
+LOCAL_PROBES = ('file', 'pidfile')
+
+
+def get_targets(host, options, inventory):
+    '''
+        Host name and address of every target of a probe
+    '''
+    if options.get('targets'):
+        return [(address, address) for address in options['targets']]
+    hosts = inventory.resolve(host)
+    if not hosts:
+        return [(host, host)]
+    return [(name, inventory.host_vars(name).get('ansible_host', name)) for name in hosts]
+
+
+def describe(probe, address, options):
+    '''
+        The command of the records of a probe
+    '''
+    if probe == 'http':
+        return 'http %s %s' % (options.get('method', 'GET'), options['url'].format(address=address))
+    if probe in LOCAL_PROBES:
+        return '%s %s' % (probe, options['path'])
+    return '%s %s:%s' % (probe, address, options['port'])
+
+
+class NativeMonitor(BaseMonitor):
+    '''
+        A monitor running one of the PROBES on the probe loop. options are
+        the settings of the probe from the scenario.
+    '''
+
+    def __init__(self, job_name, host, probe, interval, output, options):
+        if probe not in PROBES:
+            raise ValueError('Unknown probe %s' % probe)
+        check_interval(job_name, interval)
+        self.job_name = job_name
+        self.host = host
+        self.probe = probe
+        self.interval = interval
+        self.options = options
+        self.monitoring_log = CustomLogger(output,
+                                           log_format='%(message)s',
+                                           name=job_name)
+        self.stats = MonitorStats()
+        self.backend = 'native'
+        self.timeout = options.get('timeout') or config.get_value('probe_timeout') \
+            or DEFAULT_PROBE_TIMEOUT
+        if probe in LOCAL_PROBES:
+            self.targets = [(host, None)]
+        else:
+            self.targets = get_targets(host, options, Inventory.get())
+        self.commands = [describe(probe, address, options) for _, address in self.targets]
+        self.command = self.commands[0]
+        self.probe_loop = ProbeLoop.get()
+
+    def __execute__(self):
+        logger.debug("Probing %s targets of %s", len(self.targets), self.job_name)
+        with tracing.span('monitor.execute', monitor=self.job_name, probe=self.probe,
+                          targets=len(self.targets)):
+            for record in self.probe_loop.run(self._run()):
+                results.write_record(self.monitoring_log, record)
+
+    async def _run(self):
+        return await asyncio.gather(*[self._probe(host, address, command)
+                                      for (host, address), command
+                                      in zip(self.targets, self.commands)])
+
+    async def _probe(self, host, address, command):
+        semaphore = await self.probe_loop.limit()
+        async with semaphore:
+            try:
+                result = await asyncio.wait_for(PROBES[self.probe](address, self.options),
+                                                self.timeout)
+            except asyncio.TimeoutError:
+                return results.unreachable_record(self.job_name, results.now(), host,
+                                                  'Timed out after %s seconds' % self.timeout)
+            except ConnectionRefusedError as exception:
+                # the host answered, only the service is down
+                return results.failed_record(self.job_name, results.now(), host, command, 1,
+                                             '', str(exception))
+            except OSError as exception:
+                return results.unreachable_record(self.job_name, results.now(), host,
+                                                  str(exception) or type(exception).__name__)
+            except Exception as exception:
+                # e.g. a malformed reply, only this target's probe failed
+                logger.error("Probe %s of %s failed: %s", self.job_name, host, exception)
+                return results.failed_record(self.job_name, results.now(), host, command, 1,
+                                             '', str(exception) or type(exception).__name__)
+
+        end = results.now()
+        if result['return_code'] == 0:
+            record = results.ok_record(self.job_name, end, host, command, 0, result['output'])
+        else:
+            record = results.failed_record(self.job_name, end, host, command,
+                                           result['return_code'], result['output'],
+                                           result.get('error', ''))
+        for latency in ('connect_latency', 'response_latency'):
+            if latency in result:
+                record[latency] = result[latency]
+        return record
+
+    def close(self):
+        self.monitoring_log.close()
@@ -0,0 +1,102 @@
+import heapq
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread
+
+from enyo.config import Config
+from . import logger
+from .batch import group_monitors
+
+config = Config()
+DEFAULT_WORKERS = 16
+
+class MonitorScheduler(Thread):
+    '''
+        Drives all the monitors from one thread. Each monitor has a deadline on
+        the monotonic clock which always advances by exactly its interval, so
+        probe runtime doesn't stretch the period. Ticks run on a bounded pool
+        of workers; a tick that is still running when its next deadline comes
+        is an overrun and that deadline is skipped. Monitors probing the same
+        hosts at the same interval are batched into one tick unless
+        monitor_batching is off. Streaming monitors aren't ticked, they are
+        started and stopped with the others.
+    '''
+
+    def __init__(self, stop_event, max_workers=None):
+        Thread.__init__(self)
+        self.stopped = stop_event
+        self.monitors = []
+        self.max_workers = max_workers or config.get_value('monitor_workers') or DEFAULT_WORKERS
+
+    def add(self, monitor):
+        self.monitors.append(monitor)
+
+    def run(self):
+        if len(self.monitors) == 0:
+            return
+
+        # streaming monitors probe on their own, they are only started
+        streams = [monitor for monitor in self.monitors if monitor.streaming]
+        units = [monitor for monitor in self.monitors if not monitor.streaming]
+        if units and config.get_value('monitor_batching') is not False:
+            units = group_monitors(units)
+        workers = max(1, min(self.max_workers, len(units)))
+        logger.info("Scheduling %s monitors as %s units on %s workers, %s streaming",
+                    len(self.monitors), len(units), workers, len(streams))
+        executor = ThreadPoolExecutor(max_workers=workers)
+        try:
+            for stream in streams:
+                stream.start()
+            if units:
+                self._schedule(executor, units)
+            else:
+                self.stopped.wait()
+        finally:
+            executor.shutdown(wait=True)
+            for unit in units + streams:
+                unit.close()
+            self.log_stats()
+
+    def _schedule(self, executor, units):
+        '''
+            units are monitors or batches of monitors, both have an
+            interval, tick, stats and a job_name
+        '''
+        start = time.monotonic()
+        # the index keeps heap entries comparable when deadlines are equal
+        deadlines = [(start + unit.interval, index, unit)
+                     for index, unit in enumerate(units)]
+        heapq.heapify(deadlines)
+        running = {}
+
+        while not self.stopped.is_set():
+            deadline, index, monitor = deadlines[0]
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                self.stopped.wait(delay)
+                continue
+
+            previous = running.get(index)
+            if previous is not None and not previous.done():
+                monitor.stats.add_overrun()
+                logger.debug("Monitor %s overran its interval", monitor.job_name)
+            else:
+                running[index] = executor.submit(monitor.tick, deadline)
+
+            # stay on the fixed grid, skipping the deadlines that already passed
+            next_deadline = deadline + monitor.interval
+            now = time.monotonic()
+            if next_deadline <= now:
+                skipped = int((now - next_deadline) // monitor.interval) + 1
+                monitor.stats.add_missed(skipped)
+                next_deadline += skipped * monitor.interval
+            heapq.heapreplace(deadlines, (next_deadline, index, monitor))
+
+    def get_stats(self):
+        return dict((monitor.job_name, monitor.stats.get_dict()) for monitor in self.monitors)
+
+    def log_stats(self):
+        for job_name, stats in self.get_stats().items():
+            logger.info("Monitor %s: %s ticks, %s missed deadlines, %s overruns, "
+                        "max lateness %.3f seconds", job_name, stats['ticks'],
+                        stats['missed'], stats['overruns'], stats['max_lateness'])
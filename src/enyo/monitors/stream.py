@@ -0,0 +1,338 @@
+'''
+    Streaming monitors: instead of reaching the host every tick, a small
+    agent is started on the host once and runs the check command there at
+    the interval, e.g. every 100ms. It only reports the probes whose return
+    code differs from the one before, with the host's time of the probe,
+    over the ssh channel it was started on. Intervals well below the cost of
+    a connection become possible and the records still have the probe's
+    time, so recovery times are as precise as the interval.
+
+    The agent also sends a heartbeat every second. A host which stays
+    silent, or whose channel breaks, is recorded unreachable and the agent
+    is started again once it can be reached. The agent exits when its stdin
+    is closed, which also happens when enyo dies. The connection uses the
+    same inventory variables as the async backend.
+
+    The records are the ones of the other backends, only fewer: one per
+    transition and one with the last state when the monitor stops.
+'''
+import json
+import base64
+import shlex
+import asyncio
+import subprocess
+from threading import Lock
+
+from enyo.config import Config
+from enyo.utils import results
+from enyo.utils.inventory import Inventory
+from enyo.utils.custom_logger import CustomLogger
+from . import logger, check_interval
+from .async_runner import ProbeLoop, build_command, python_interpreter, DEFAULT_TIMEOUT
+
+config = Config()
+HEARTBEAT = 1
+# heartbeats missed before the host counts as unreachable
+MISSED_HEARTBEATS = 3
+RECONNECT_DELAY = 1
+
+# runs on the monitored hosts, has to stay compatible with their Python
+AGENT_SCRIPT = '''
+import base64, json, os, subprocess, sys, threading, time
+spec = json.loads(base64.b64decode(sys.argv[1]).decode())
+lock = threading.Lock()
+counters = dict(probes=0, missed=0, total_lateness=0.0, max_lateness=0.0, total_duration=0.0,
+                max_duration=0.0)
+def emit(message):
+    with lock:
+        sys.stdout.write(json.dumps(message) + '\\n')
+        sys.stdout.flush()
+def watch_stdin():
+    sys.stdin.read()
+    os._exit(0)
+def beat():
+    while True:
+        time.sleep(spec['heartbeat'])
+        emit(dict(counters, event='beat', now=time.time()))
+emit(dict(event='hello', now=time.time(), pid=os.getpid()))
+threading.Thread(target=watch_stdin, daemon=True).start()
+threading.Thread(target=beat, daemon=True).start()
+interval = spec['interval']
+state = 'start'
+deadline = time.monotonic()
+while True:
+    started = time.monotonic()
+    counters['total_lateness'] += started - deadline
+    counters['max_lateness'] = max(counters['max_lateness'], started - deadline)
+    try:
+        process = subprocess.Popen(spec['command'], shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        try:
+            stdout, stderr = process.communicate(timeout=spec['timeout'])
+            code = process.returncode
+        except subprocess.TimeoutExpired:
+            process.kill()
+            stdout, stderr = process.communicate()
+            code = None
+    except OSError as exception:
+        stdout, stderr, code = b'', str(exception).encode(), 127
+    now = time.time()
+    duration = time.monotonic() - started
+    counters['total_duration'] += duration
+    counters['max_duration'] = max(counters['max_duration'], duration)
+    counters['probes'] += 1
+    if code != state:
+        state = code
+        # messages are lines read by asyncio, which limits their length
+        emit(dict(event='probe', time=now, rc=code, stdout=stdout.decode('utf-8', 'replace')[-4096:],
+                  stderr=stderr.decode('utf-8', 'replace')[-4096:]))
+    deadline += interval
+    delay = deadline - time.monotonic()
+    if delay < 0:
+        skipped = int(-delay // interval) + 1
+        counters['missed'] += skipped
+        deadline += skipped * interval
+        delay = deadline - time.monotonic()
+    time.sleep(max(delay, 0))
+'''
+
+
+def agent_command(command, interval, timeout, heartbeat=HEARTBEAT, python='python3'):
+    '''
+        Shell command starting the agent running command every interval
+        seconds
+    '''
+    spec = json.dumps(dict(command=command, interval=interval, timeout=timeout,
+                           heartbeat=heartbeat))
+    encoded = base64.b64encode(spec.encode()).decode()
+    return '%s -u -c %s %s' % (python, shlex.quote(AGENT_SCRIPT), encoded)
+
+
+class StreamStats(object):
+    '''
+        Probe counters the agents report in their heartbeats, summed over
+        the hosts and the agents started on them
+    '''
+    SUMS = ('probes', 'missed', 'total_lateness', 'total_duration')
+    MAXIMA = ('max_lateness', 'max_duration')
+
+    def __init__(self):
+        self._lock = Lock()
+        self.finished = dict((key, 0) for key in self.SUMS + self.MAXIMA)
+        self.agents = {}
+        self.transitions = 0
+        self.reconnects = 0
+
+    def update(self, host, beat):
+        with self._lock:
+            self.agents[host] = dict((key, beat[key]) for key in self.SUMS + self.MAXIMA)
+
+    def agent_stopped(self, host):
+        '''
+            The agent on host is gone, a new one counts from zero again
+        '''
+        with self._lock:
+            counters = self.agents.pop(host, None)
+            if counters is not None:
+                self.finished = self._merge([self.finished, counters])
+
+    def _merge(self, counters):
+        merged = dict((key, sum(agent[key] for agent in counters)) for key in self.SUMS)
+        merged.update((key, max(agent[key] for agent in counters)) for key in self.MAXIMA)
+        return merged
+
+    def add_transition(self):
+        with self._lock:
+            self.transitions += 1
+
+    def add_reconnect(self):
+        with self._lock:
+            self.reconnects += 1
+
+    def get_dict(self):
+        with self._lock:
+            counters = self._merge([self.finished] + list(self.agents.values()))
+            ticks = counters['probes']
+            return dict(ticks=ticks,
+                        missed=counters['missed'],
+                        overruns=0,
+                        mean_lateness=counters['total_lateness'] / ticks if ticks else 0.0,
+                        max_lateness=counters['max_lateness'],
+                        mean_duration=counters['total_duration'] / ticks if ticks else 0.0,
+                        max_duration=counters['max_duration'],
+                        transitions=self.transitions,
+                        reconnects=self.reconnects)
+
+
+class StreamingMonitor(object):
+    '''
+        A monitor whose command runs in an agent on every host. It isn't
+        ticked by the scheduler, which starts it and stops it with the
+        other monitors.
+    '''
+    streaming = True
+
+    def __init__(self, job_name, host, command, interval, output):
+        check_interval(job_name, interval)
+        self.job_name = job_name
+        self.host = host
+        self.command = command
+        self.interval = interval
+        self.monitoring_log = CustomLogger(output,
+                                           log_format='%(message)s',
+                                           name=job_name)
+        self.stats = StreamStats()
+        self.inventory = Inventory.get()
+        self.hosts = self.inventory.resolve(host)
+        if not self.hosts:
+            raise ValueError('No hosts match %s of monitor %s' % (host, job_name))
+        self.timeout = config.get_value('probe_timeout') or DEFAULT_TIMEOUT
+        self.probe_loop = ProbeLoop.get()
+        self.stopping = None
+        self.future = None
+        # last record of every host
+        self.last = {}
+
+    def start(self):
+        self.stopping = self.probe_loop.run(_new_event())
+        self.future = self.probe_loop.submit(self._run())
+
+    def stop(self):
+        if self.future is None:
+            return
+        self.probe_loop.loop.call_soon_threadsafe(self.stopping.set)
+        self.future.result()
+        # close the series at the end of the run, with the state they had
+        now = results.now()
+        for host, record in self.last.items():
+            record = dict(record, time=now)
+            results.write_record(self.monitoring_log, record)
+        self.future = None
+
+    def close(self):
+        self.stop()
+        self.monitoring_log.close()
+
+    async def _run(self):
+        await asyncio.gather(*[self._stream(host) for host in self.hosts])
+
+    def _write(self, host, record):
+        self.last[host] = record
+        self.stats.add_transition()
+        results.write_record(self.monitoring_log, record)
+
+    def _unreachable(self, host, time, error):
+        '''
+            Record host unreachable, unless it already is
+        '''
+        last = self.last.get(host)
+        if last is None or 'return_code' in last:
+            self._write(host, results.unreachable_record(self.job_name, time, host, error))
+
+    async def _stream(self, host):
+        '''
+            Keep an agent running on host until the monitor stops
+        '''
+        host_vars = self.inventory.host_vars(host)
+        command = agent_command(self.command, self.interval, self.timeout,
+                                python=python_interpreter(host_vars))
+        while not self.stopping.is_set():
+            argv, env = build_command(host_vars, command, self.timeout)
+            try:
+                process = await asyncio.create_subprocess_exec(*argv, env=env,
+                                                               stdin=subprocess.PIPE,
+                                                               stdout=subprocess.PIPE,
+                                                               stderr=subprocess.PIPE)
+            except OSError as exception:
+                self._unreachable(host, results.now(), str(exception))
+            else:
+                error = await self._read(host, process)
+                self.stats.agent_stopped(host)
+                if error is not None:
+                    self._unreachable(host, error[0], error[1])
+            if not self.stopping.is_set():
+                self.stats.add_reconnect()
+                try:
+                    await asyncio.wait_for(self.stopping.wait(), RECONNECT_DELAY)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _read(self, host, process):
+        '''
+            Turn the messages of the agent into records until the monitor
+            stops or the agent is lost. Returns the time and the reason the
+            agent was lost, None when it was stopped.
+        '''
+        # offset from the clock of the host to ours, the smallest one seen
+        # is the closest to the real one
+        offset = None
+        last_seen = results.now()
+        # connecting may take up to the timeout, then heartbeats come
+        silence = self.timeout
+        stopping = asyncio.ensure_future(self.stopping.wait())
+        try:
+            while True:
+                reading = asyncio.ensure_future(process.stdout.readline())
+                done, _ = await asyncio.wait([reading, stopping], timeout=silence,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if stopping in done:
+                    reading.cancel()
+                    await _end(process)
+                    return None
+                if not done:
+                    reading.cancel()
+                    await _end(process)
+                    return last_seen, 'No heartbeat for %s seconds' % silence
+                line = reading.result()
+                if not line:
+                    stderr = await _end(process)
+                    return results.now(), stderr or 'Agent exited with %s' % process.returncode
+                try:
+                    message = json.loads(line)
+                except ValueError:
+                    logger.warning("Unexpected output of the agent of %s on %s: %s",
+                                   self.job_name, host, line)
+                    continue
+
+                last_seen = results.now()
+                if 'now' in message:
+                    offset = last_seen - message['now'] if offset is None \
+                        else min(offset, last_seen - message['now'])
+                    silence = HEARTBEAT * MISSED_HEARTBEATS
+                if message['event'] == 'beat':
+                    self.stats.update(host, message)
+                elif message['event'] == 'probe':
+                    self._write(host, self._record(host, message, offset or 0.0))
+        finally:
+            stopping.cancel()
+
+    def _record(self, host, message, offset):
+        time = message['time'] + offset
+        stdout = message['stdout'].rstrip('\r\n')
+        if message['rc'] is None:
+            return results.unreachable_record(self.job_name, time, host,
+                                              'Timed out after %s seconds' % self.timeout)
+        if message['rc'] == 0:
+            return results.ok_record(self.job_name, time, host, self.command, 0, stdout)
+        return results.failed_record(self.job_name, time, host, self.command, message['rc'],
+                                     stdout, message['stderr'].rstrip('\r\n'))
+
+
+async def _new_event():
+    # the event has to be created on the probe loop
+    return asyncio.Event()
+
+
+async def _end(process):
+    '''
+        Stop the agent by closing its stdin, kill it if that didn't work.
+        Returns what it wrote to stderr.
+    '''
+    if process.stdin is not None and not process.stdin.is_closing():
+        process.stdin.close()
+    try:
+        await asyncio.wait_for(process.wait(), HEARTBEAT)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+    stderr = await process.stderr.read()
+    return stderr.decode('utf-8', 'replace').strip()
@@ -0,0 +1,213 @@
+'''
+    Joins the monitor samples, the outages found in them, the workload
+    iterations and the injections of a run into one table of events sorted
+    by epoch time, saved as .npz, and correlates them: how long after an
+    injection the workload started failing, how long after the service
+    recovered the workload recovered.
+'''
+import os
+import json
+
+import numpy as np
+
+from enyo.utils.custom_logger import CustomLogger, log_dir_file
+from enyo.config import Config
+from enyo.reporters.recovery import MonitorData, find_outages
+from enyo.reporters.rally import RallyData
+
+config = Config()
+logger = CustomLogger(log_dir_file('report.log'), name=__name__)
+
+# kinds of events
+MONITOR = 0
+ITERATION = 1
+INJECTION = 2
+OUTAGE_START = 3
+OUTAGE_END = 4
+# kinds of series
+SERIES_MONITOR = 0
+SERIES_WORKLOAD = 1
+SERIES_INJECTION = 2
+
+
+class CorrelationDataset(object):
+    '''
+        Events of a run as columns sorted by time:
+        time: epoch time of the event, for iterations the time they finished
+        kind: MONITOR sample, workload ITERATION, INJECTION, OUTAGE_START or
+        OUTAGE_END of a monitored service
+        series: index into names, the monitor (job@host), the workload or
+        the injector the event belongs to
+        value: duration of iterations and recovered outages, nan otherwise
+        failed: failed monitor samples and iterations
+        series_kinds tells monitors, workloads and injectors apart.
+    '''
+
+    def __init__(self, names, series_kinds, time, kind, series, value, failed):
+        self.names = names
+        self.series_kinds = series_kinds
+        self.time = time
+        self.kind = kind
+        self.series = series
+        self.value = value
+        self.failed = failed
+
+    def __len__(self):
+        return len(self.time)
+
+    @classmethod
+    def build(cls, monitor_files, injection_times, rally_file=None):
+        '''
+            monitor_files: monitor logs
+            injection_times: name, host and epoch time of every injection
+            rally_file: JSON report of the Rally task, if there was one
+        '''
+        names = []
+        series_kinds = []
+        columns = []
+
+        def add_series(name, series_kind):
+            names.append(name)
+            series_kinds.append(series_kind)
+            return len(names) - 1
+
+        def add_events(time, kind, series, value=None, failed=None):
+            count = len(time)
+            columns.append((np.asarray(time, dtype=np.float64),
+                            np.full(count, kind, dtype=np.int8),
+                            np.asarray(series, dtype=np.int32),
+                            np.full(count, np.nan) if value is None else np.asarray(value, dtype=np.float64),
+                            np.zeros(count, dtype=bool) if failed is None else np.asarray(failed, dtype=bool)))
+
+        for monitor_file in monitor_files:
+            if not os.path.exists(monitor_file) or os.path.getsize(monitor_file) == 0:
+                continue
+            data = MonitorData.load(monitor_file)
+            codes = np.array([add_series('%s@%s' % (job, host), SERIES_MONITOR)
+                              for job in data.jobs for host in data.hosts], dtype=np.int32)
+            local = data.job_codes.astype(np.int64) * len(data.hosts) + data.host_codes
+            add_events(data.times, MONITOR, codes[local], failed=data.failed)
+            (recovered, down, up), (unrecovered, open_down) = find_outages(local, data.times, data.failed)
+            add_events(np.concatenate((down, open_down)), OUTAGE_START,
+                       codes[np.concatenate((recovered, unrecovered))])
+            add_events(up, OUTAGE_END, codes[recovered], value=up - down)
+
+        if rally_file and os.path.exists(rally_file):
+            data = RallyData.load(rally_file)
+            codes = np.array([add_series('%s/%s' % (workload['subtask'], workload['name']),
+                                         SERIES_WORKLOAD)
+                              for workload in data.workloads], dtype=np.int32)
+            workloads, started, durations, failed = data.iterations.to_arrays()
+            add_events(started + np.nan_to_num(durations), ITERATION, codes[workloads],
+                       value=durations, failed=failed)
+
+        injections = [injection for injection in injection_times or []
+                      if injection.get('time') is not None]
+        add_events([injection['time'] for injection in injections], INJECTION,
+                   [add_series('%s@%s' % (injection['name'], injection.get('host')), SERIES_INJECTION)
+                    for injection in injections])
+
+        time, kind, series, value, failed = [np.concatenate(column) for column in zip(*columns)]
+        order = np.argsort(time, kind='stable')
+        return cls(np.array(names, dtype=str), np.array(series_kinds, dtype=np.int8),
+                   time[order], kind[order], series[order], value[order], failed[order])
+
+    def save(self, path):
+        np.savez(path, names=self.names, series_kinds=self.series_kinds, time=self.time,
+                 kind=self.kind, series=self.series, value=self.value, failed=self.failed)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as arrays:
+            return cls(arrays['names'], arrays['series_kinds'], arrays['time'], arrays['kind'],
+                       arrays['series'], arrays['value'], arrays['failed'])
+
+    def select(self, kind, start=None, end=None, series=None):
+        '''
+            Indexes of the events of a kind between start and end
+        '''
+        low = 0 if start is None else np.searchsorted(self.time, start)
+        high = len(self.time) if end is None else np.searchsorted(self.time, end)
+        mask = self.kind[low:high] == kind
+        if series is not None:
+            mask &= np.isin(self.series[low:high], series)
+        return low + np.flatnonzero(mask)
+
+
+def _first(dataset, index):
+    return float(dataset.time[index[0]]) if len(index) else None
+
+
+def _since(time, reference):
+    if time is None or reference is None:
+        return None
+    return time - reference
+
+
+def correlate(dataset):
+    '''
+        Cross signal metrics of every injection, looking at the events
+        between the injection and the next one
+    '''
+    injections = dataset.select(INJECTION)
+    results = []
+    for number, index in enumerate(injections):
+        start = dataset.time[index]
+        end = dataset.time[injections[number + 1]] if number + 1 < len(injections) else None
+
+        monitor_failures = dataset.select(MONITOR, start, end)
+        monitor_failures = monitor_failures[dataset.failed[monitor_failures]]
+        outages = dataset.select(OUTAGE_START, start, end)
+        recoveries = dataset.select(OUTAGE_END, start, end)
+        # the service is back once every outage starting after the injection ended
+        outage_series = np.unique(dataset.series[outages])
+        recovered_series = np.unique(dataset.series[recoveries])
+        service_recovered = None
+        if len(outages) and np.all(np.isin(outage_series, recovered_series)):
+            service_recovered = float(dataset.time[recoveries].max())
+
+        iterations = dataset.select(ITERATION, start, end)
+        failed_iterations = iterations[dataset.failed[iterations]]
+        workload_recovered = None
+        if len(failed_iterations):
+            after_failures = iterations[iterations > failed_iterations[-1]]
+            workload_recovered = _first(dataset, after_failures)
+
+        first_failed_iteration = _first(dataset, failed_iterations)
+        results.append(dict(
+            name=str(dataset.names[dataset.series[index]]),
+            time=float(start),
+            first_monitor_failure=_since(_first(dataset, monitor_failures), start),
+            first_failed_iteration=_since(first_failed_iteration, start),
+            service_recovery=_since(service_recovered, start),
+            workload_recovery=_since(workload_recovered, start),
+            workload_recovery_after_service=_since(workload_recovered, service_recovered),
+            workload_downtime=_since(workload_recovered, first_failed_iteration),
+            outages=int(len(outages)),
+            unrecovered_outages=int(len(np.setdiff1d(outage_series, recovered_series))),
+            iterations=int(len(iterations)),
+            failed_iterations=int(len(failed_iterations))))
+    return results
+
+
+class CorrelationReporter():
+
+    def __init__(self, output_file, monitor_files, injection_times, rally_file=None):
+        '''
+            output_file: base name of the .npz dataset and the .json metrics
+        '''
+        self.output_dataset = output_file + '.npz'
+        self.output_file = output_file + '.json'
+        self.monitor_files = monitor_files
+        self.injection_times = injection_times
+        self.rally_file = rally_file
+
+    def generate_report(self):
+        dataset = CorrelationDataset.build(self.monitor_files, self.injection_times, self.rally_file)
+        if len(dataset) == 0:
+            logger.info("No data to correlate")
+            return
+        dataset.save(self.output_dataset)
+        logger.info("%s events written to %s", len(dataset), self.output_dataset)
+        with open(self.output_file, 'w') as f:
+            json.dump(dict(injections=correlate(dataset)), f)
@@ -1,64 +1,351 @@
+'''
+    Analysis of the JSON report of a Rally task. Every workload of every
+    task and subtask is covered, together with the atomic actions of its
+    iterations: duration percentiles, throughput and error rate overall, in
+    sliding windows and before, during and after every injection.
+'''
 import os
 import json
-from datetime import datetime
+from array import array
 
-import matplotlib.pyplot as plt
 import numpy as np
 
-from enyo.utils.custom_logger import CustomLogger
+from enyo.utils.custom_logger import CustomLogger, log_dir_file
 from enyo.config import Config
-from enyo.utils import Utils
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
 
 config = Config()
-LOG_FILE = os.path.join(config.get_value('log_dir'), 'rally-reporter.log')
-logger = CustomLogger(LOG_FILE, name=__name__)
+logger = CustomLogger(log_dir_file('rally-reporter.log'), name=__name__)
+
+PERCENTILES = (50, 95, 99)
+# length and step of the sliding windows, the injection phases are one
+# window long each
+WINDOW = 30
+WINDOW_STEP = 10
+
+TASK = 'tasks.item'
+SUBTASK = TASK + '.subtasks.item'
+WORKLOAD = SUBTASK + '.workloads.item'
+ITERATION = WORKLOAD + '.data.item'
+
+
+def workload_name(workload):
+    '''
+        Scenario name of a workload of the Rally JSON report, which keeps it
+        as the only key of the scenario section
+    '''
+    if workload.get('name'):
+        return workload['name']
+    return next(iter(workload.get('scenario') or {}), None)
+
+
+def _flatten_actions(actions, started, prefix=''):
+    '''
+        (name, started, duration, failed) of the atomic actions of an
+        iteration, nested actions are named after their parents
+    '''
+    if isinstance(actions, dict):
+        # reports of older Rally versions only have the durations
+        for name, duration in actions.items():
+            yield prefix + name, started, duration, duration is None
+        return
+    for action in actions:
+        name = prefix + action['name']
+        finished = action.get('finished_at')
+        duration = finished - action['started_at'] if finished is not None else None
+        yield name, action['started_at'], duration, action.get('failed', False) or duration is None
+        for child in _flatten_actions(action.get('children') or [], action['started_at'],
+                                      name + ' > '):
+            yield child
+
+
+class Samples(object):
+    '''
+        Growing columns of timed samples of many series
+    '''
+
+    def __init__(self):
+        self.series = array('i')
+        self.started = array('d')
+        self.durations = array('d')
+        self.failed = array('b')
+
+    def add(self, series, started, duration, failed):
+        self.series.append(series)
+        self.started.append(started)
+        self.durations.append(duration if duration is not None else np.nan)
+        self.failed.append(bool(failed))
+
+    def to_arrays(self):
+        '''
+            series, start, duration and failed as arrays sorted by series
+            and start time
+        '''
+        series = np.frombuffer(self.series, dtype=np.int32) if len(self.series) else np.empty(0, np.int32)
+        started = np.frombuffer(self.started, dtype=np.float64) if len(self.started) else np.empty(0)
+        durations = np.frombuffer(self.durations, dtype=np.float64) if len(self.durations) else np.empty(0)
+        failed = np.frombuffer(self.failed, dtype=np.int8).astype(bool) if len(self.failed) else np.empty(0, bool)
+        order = np.lexsort((started, series))
+        return series[order], started[order], durations[order], failed[order]
+
+
+class RallyData(object):
+    '''
+        The iterations and atomic actions of all the workloads of a report.
+        Workloads are identified by their index in workloads, actions by
+        their index in actions.
+    '''
+
+    def __init__(self):
+        self.workloads = []
+        self.actions = []
+        self._action_codes = {}
+        self.iterations = Samples()
+        self.atomic_actions = Samples()
+
+    def add_workload(self, task, subtask, name=None, position=None):
+        self.workloads.append(dict(task=task, subtask=subtask, name=name, position=position))
+        return len(self.workloads) - 1
+
+    def add_iteration(self, workload, iteration):
+        error = iteration.get('error') or []
+        self.iterations.add(workload, iteration['timestamp'], iteration['duration'], len(error) != 0)
+        for name, started, duration, failed in _flatten_actions(iteration.get('atomic_actions') or [],
+                                                                iteration['timestamp']):
+            key = (workload, name)
+            if key not in self._action_codes:
+                self._action_codes[key] = len(self.actions)
+                self.actions.append(key)
+            self.atomic_actions.add(self._action_codes[key], started, duration, failed)
+
+    @classmethod
+    def load(cls, file):
+        data = cls()
+        if ijson is None:
+            logger.warning("ijson isn't installed, loading all of %s into memory", file)
+            with open(file, 'r') as f:
+                report = json.load(f)
+            for task in report.get('tasks', []):
+                for subtask in task.get('subtasks', []):
+                    for workload in subtask.get('workloads', []):
+                        code = data.add_workload(task.get('uuid'), subtask.get('title'),
+                                                 workload_name(workload), workload.get('position'))
+                        for iteration in workload.get('data', []):
+                            data.add_iteration(code, iteration)
+            return data
+
+        with open(file, 'rb') as f:
+            data._parse(ijson.parse(f, use_float=True))
+        return data
+
+    def _parse(self, events):
+        '''
+            Fill in the data from the ijson events of a report, building only
+            one iteration at a time
+        '''
+        tasks = []
+        subtasks = []
+        workload = None
+        builder = None
+        for prefix, event, value in events:
+            if builder is not None:
+                builder.event(event, value)
+                if prefix == ITERATION and event == 'end_map':
+                    self.add_iteration(workload, builder.value)
+                    builder = None
+            elif prefix == ITERATION and event == 'start_map':
+                builder = ijson.ObjectBuilder()
+                builder.event(event, value)
+            elif prefix == TASK and event == 'start_map':
+                tasks.append(None)
+            elif prefix == TASK + '.uuid':
+                tasks[-1] = value
+            elif prefix == SUBTASK and event == 'start_map':
+                subtasks.append((len(tasks) - 1, None))
+            elif prefix == SUBTASK + '.title':
+                subtasks[-1] = (subtasks[-1][0], value)
+            elif prefix == WORKLOAD and event == 'start_map':
+                # the task and subtask are filled in at the end, their keys
+                # can come after the workloads
+                workload = self.add_workload(len(subtasks) - 1, None)
+            elif prefix in (WORKLOAD + '.scenario', WORKLOAD + '.name') and event in ('map_key', 'string'):
+                self.workloads[workload]['name'] = self.workloads[workload]['name'] or value
+            elif prefix == WORKLOAD + '.position':
+                self.workloads[workload]['position'] = value
+
+        for workload in self.workloads:
+            task, subtask = subtasks[workload['task']]
+            workload.update(task=tasks[task], subtask=subtask)
+
+
+def summarize(started, durations, failed, span=None):
+    '''
+        Count, errors, error rate, throughput and duration percentiles of a
+        set of samples. Throughput is samples per second of span, which
+        defaults to the time the samples cover.
+    '''
+    count = len(started)
+    if count == 0:
+        return dict(count=0)
+    if span is None:
+        span = (started + np.nan_to_num(durations)).max() - started.min()
+    errors = int(np.count_nonzero(failed))
+    summary = dict(count=int(count), errors=errors, error_rate=errors / count,
+                   throughput=float(count / span) if span > 0 else None)
+    finished = durations[np.isfinite(durations)]
+    if len(finished):
+        summary['mean'] = float(finished.mean())
+        for percentile, value in zip(PERCENTILES, np.percentile(finished, PERCENTILES)):
+            summary['p%d' % percentile] = float(value)
+    return summary
+
+
+def sliding_windows(started, durations, failed, window=WINDOW, step=WINDOW_STEP):
+    '''
+        Duration percentiles, throughput and error rate of the samples
+        starting in every window of window seconds, windows starting every
+        step seconds. started has to be sorted.
+    '''
+    if len(started) == 0:
+        return dict(start=[])
+    starts = np.arange(started[0], started[-1] + step, step)
+    low = np.searchsorted(started, starts)
+    high = np.searchsorted(started, starts + window)
+    counts = high - low
+    failures = np.concatenate(([0], np.cumsum(failed)))
+    errors = failures[high] - failures[low]
+
+    percentiles = np.full((len(starts), len(PERCENTILES)), np.nan)
+    for index in np.flatnonzero(counts):
+        values = durations[low[index]:high[index]]
+        values = values[np.isfinite(values)]
+        if len(values):
+            percentiles[index] = np.percentile(values, PERCENTILES)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        error_rate = errors / counts
+    windows = dict(start=starts.tolist(), count=counts.tolist(),
+                   throughput=(counts / window).tolist(),
+                   error_rate=_to_list(error_rate))
+    for column, percentile in enumerate(PERCENTILES):
+        windows['p%d' % percentile] = _to_list(percentiles[:, column])
+    return windows
+
+
+def _to_list(values):
+    return [float(value) if np.isfinite(value) else None for value in values]
+
+
+def compare_injection(started, durations, failed, injected_at, window=WINDOW):
+    '''
+        Summaries of the window before an injection, the window starting
+        with it and the window after that
+    '''
+    phases = {}
+    for phase, start in (('before', injected_at - window), ('during', injected_at),
+                         ('after', injected_at + window)):
+        low, high = np.searchsorted(started, (start, start + window))
+        phases[phase] = summarize(started[low:high], durations[low:high], failed[low:high], window)
+    before = phases['before']
+    during = phases['during']
+    if before.get('p95') and during.get('p95') is not None:
+        phases['p95_change'] = during['p95'] / before['p95'] - 1
+    if before['count'] and during['count']:
+        phases['error_rate_change'] = during['error_rate'] - before['error_rate']
+    return phases
+
+
+def _segments(series, count):
+    '''
+        Start and end index of every series in arrays sorted by series
+    '''
+    codes = np.arange(count)
+    return np.searchsorted(series, codes), np.searchsorted(series, codes, side='right')
+
 
 class RallyReporter():
 
-    def __init__(self, input_file):
+    def __init__(self, input_file, injection_times=None):
         self.input_file = input_file
+        self.output_file = input_file + '.out'
         self.output_graph = input_file + '.pdf'
+        self.injection_times = sorted(injection_times or [], key=lambda injection: injection['time'])
+
+    def _analyze(self, started, durations, failed):
+        return dict(summary=summarize(started, durations, failed),
+                    windows=sliding_windows(started, durations, failed),
+                    injections=[dict(injection, **compare_injection(started, durations, failed,
+                                                                    injection['time']))
+                                for injection in self.injection_times])
+
+    def get_report(self, data):
+        series, started, durations, failed = data.iterations.to_arrays()
+        low, high = _segments(series, len(data.workloads))
+        workloads = []
+        for code, workload in enumerate(data.workloads):
+            part = slice(low[code], high[code])
+            workloads.append(dict(workload, atomic_actions={},
+                                  **self._analyze(started[part], durations[part], failed[part])))
+
+        series, started, durations, failed = data.atomic_actions.to_arrays()
+        low, high = _segments(series, len(data.actions))
+        for code, (workload, name) in enumerate(data.actions):
+            part = slice(low[code], high[code])
+            workloads[workload]['atomic_actions'][name] = self._analyze(started[part],
+                                                                        durations[part], failed[part])
+        return dict(workloads=workloads)
 
 
     def plot(self, data):
-        if (len(data.keys())==0):
-            logger.info("Empty data, nothing to plot")
-            return
+        import matplotlib.pyplot as plt
 
-        try:
-            # getting the specific data from the data generated by rally
-            results = data['tasks'][0]['subtasks'][0]['workloads'][0]['data']
-        except Exception as exception:
-            logger.error("Error occured while reading rally report: %s",
-                         exception)
+        series, started, durations, failed = data.iterations.to_arrays()
+        if len(started) == 0:
+            logger.info("Empty data, nothing to plot")
             return
 
-        min_timestamp = results[0]['timestamp']
-        timestamp = [r['timestamp']-min_timestamp for r in results]
-        boot_and_delete =  [r['duration'] for r in results]
+        low, high = _segments(series, len(data.workloads))
+        shown = [code for code in range(len(data.workloads)) if high[code] > low[code]]
+        min_timestamp = started.min()
+        figure, axes = plt.subplots(len(shown), 1, sharex=True, squeeze=False,
+                                    figsize=(6.4, 3 * len(shown)))
+        for axis, code in zip(axes[:, 0], shown):
+            part = slice(low[code], high[code])
+            timestamp = started[part] - min_timestamp
+            errors = failed[part]
+            axis.plot(timestamp, durations[part], 'o-', color='deepskyblue', markersize=3)
+            axis.scatter(timestamp[errors], durations[part][errors], color='orangered', zorder=10)
+            windows = sliding_windows(started[part], durations[part], failed[part])
+            axis.plot(np.array(windows['start']) + WINDOW / 2 - min_timestamp,
+                      np.array(windows['p95'], dtype=np.float64), color='navy', label='p95')
+            for injection in self.injection_times:
+                axis.axvline(injection['time'] - min_timestamp, color='orangered', linestyle='--')
+            axis.set_title(data.workloads[code]['name'] or '', fontsize='small')
+            axis.set_ylabel('Duration (seconds)')
 
-        error_timestamp = [r['timestamp']-min_timestamp for r in results if len(r['error'])!=0]
-        error_boot_and_delete =  [r['duration'] for r in results if len(r['error'])!=0]
+        axes[-1, 0].set_xlabel('Time (seconds)')
+        figure.tight_layout()
+        figure.savefig(self.output_graph)
+        plt.close(figure)
 
-        plt.plot(timestamp, boot_and_delete, 'o-', color='deepskyblue')
-        plt.scatter(error_timestamp, error_boot_and_delete, color='orangered', zorder=10)
 
-        plt.xlabel('Time (seconds)')
-        plt.ylabel('Provisioning Duration (seconds)')
-        plt.tight_layout()
-
-        plt.savefig(self.output_graph)
-        plt.clf()
+    def generate_report(self):
+        if not os.path.exists(self.input_file):
+            logger.info("No rally report %s found. No report to generate.", self.input_file)
+            return
 
+        data = RallyData.load(self.input_file)
+        logger.info("%s iterations of %s workloads read from %s", len(data.iterations.started),
+                    len(data.workloads), self.input_file)
+        with open(self.output_file, 'w') as f:
+            json.dump(self.get_report(data), f)
 
-    def _create_graph(self):
         try:
-            data = Utils.read_json_file(self.input_file)
             self.plot(data)
         except Exception as exception:
             logger.error("Error occured during creation of graphical report: %s",
                          exception)
-
-
-    def generate_report(self):
-        self._create_graph()
@@ -1,82 +1,346 @@
 import os
 import json
-import fileinput
-from datetime import datetime
+from array import array
+from datetime import datetime, timezone
 
-import matplotlib.pyplot as plt
 import numpy as np
 
-from enyo.utils.custom_logger import CustomLogger
+from enyo.utils.custom_logger import CustomLogger, log_dir_file
 from enyo.config import Config
 from enyo.utils import Utils
+from enyo.utils.results import read_records, to_epoch
 
 config = Config()
-LOG_FILE = os.path.join(config.get_value('log_dir'), 'report.log')
-logger = CustomLogger(LOG_FILE, name=__name__)
-TIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+logger = CustomLogger(log_dir_file('report.log'), name=__name__)
+CHUNK_SIZE = 100000
+PERCENTILES = (50, 95, 99)
+QUARTER_HOUR = 900
+
+
+class MonitorData(object):
+    '''
+        Monitoring records of a monitor log as columns. Job names and hosts
+        are stored as integer codes into the jobs and hosts lists.
+    '''
+
+    def __init__(self, jobs, hosts, job_codes, host_codes, times, failed):
+        self.jobs = jobs
+        self.hosts = hosts
+        self.job_codes = job_codes
+        self.host_codes = host_codes
+        self.times = times
+        self.failed = failed
+
+    def __len__(self):
+        return len(self.times)
+
+    @classmethod
+    def load(cls, file):
+        '''
+            Read a monitor log chunk by chunk into arrays
+        '''
+        jobs = {}
+        hosts = {}
+        job_codes = array('i')
+        host_codes = array('i')
+        return_codes = array('i')
+        times = []
+
+        for chunk in _read_chunks(file):
+            job_codes.extend([jobs.setdefault(record.get('job_name'), len(jobs))
+                              for record in chunk])
+            host_codes.extend([hosts.setdefault(record['host'], len(hosts))
+                               for record in chunk])
+            # unreachable hosts don't have a return code
+            return_codes.extend([record.get('return_code', -1) for record in chunk])
+            times.append(_to_epoch_array([record['time'] for record in chunk]))
+
+        return cls(list(jobs), list(hosts),
+                   np.frombuffer(job_codes, dtype=np.int32),
+                   np.frombuffer(host_codes, dtype=np.int32),
+                   np.concatenate(times) if times else np.empty(0),
+                   np.frombuffer(return_codes, dtype=np.int32) != 0)
+
+
+def _read_chunks(file):
+    '''
+        Lists of at most CHUNK_SIZE records. One record per line logs are
+        decoded a whole chunk at a time, older logs record by record.
+    '''
+    with open(file, 'r') as f:
+        first_line = ''
+        for first_line in f:
+            if first_line.strip():
+                break
+        compact = first_line.strip().endswith('}')
+
+    if not compact:
+        chunk = []
+        for record in read_records(file):
+            chunk.append(record)
+            if len(chunk) == CHUNK_SIZE:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+        return
+
+    with open(file, 'r') as f:
+        lines = []
+        for line in f:
+            if line.strip():
+                lines.append(line)
+            if len(lines) == CHUNK_SIZE:
+                yield json.loads('[' + ','.join(lines) + ']')
+                lines = []
+        if lines:
+            yield json.loads('[' + ','.join(lines) + ']')
+
+
+def _to_epoch_array(values):
+    try:
+        return np.array(values, dtype=np.float64)
+    except ValueError:
+        pass
+    # time strings of older logs are local time, numpy parses them as UTC
+    try:
+        parsed = np.array(values, dtype='datetime64[us]').astype(np.int64) / 1e6
+    except ValueError:
+        return np.array([to_epoch(value) for value in values], dtype=np.float64)
+    # the offset changes with daylight saving time, which only ever starts
+    # or ends at a quarter of an hour, so it is the same within each one
+    quarters, index = np.unique(parsed // QUARTER_HOUR, return_inverse=True)
+    offsets = np.array([_local_offset(quarter * QUARTER_HOUR) for quarter in quarters])
+    return parsed + offsets[index]
+
+
+def _local_offset(wall_time):
+    '''
+        Seconds to add to a local wall time parsed as UTC to get its epoch
+        time, the way to_epoch reads it
+    '''
+    local = datetime.fromtimestamp(wall_time, timezone.utc).replace(tzinfo=None)
+    return local.timestamp() - wall_time
+
+
+def find_outages(series, times, failed):
+    '''
+        All the down -> up transitions of every series
+
+        series: integer code of the series (host and monitor) of every sample
+        times: epoch time of every sample
+        failed: whether the sample was a failure
+        returns series, down time and up time of every recovered outage and
+        series and down time of outages which hadn't recovered by the end
+    '''
+    if len(times) == 0:
+        empty = np.empty(0)
+        return (empty.astype(np.int64), empty, empty), (empty.astype(np.int64), empty)
+
+    order = np.lexsort((times, series))
+    series = series[order]
+    times = times[order]
+    failed = failed[order]
+
+    previous_failed = np.empty_like(failed)
+    previous_failed[0] = False
+    previous_failed[1:] = failed[:-1]
+    # the first sample of every series starts from a healthy state
+    previous_failed[1:][series[1:] != series[:-1]] = False
+
+    starts = np.flatnonzero(failed & ~previous_failed)
+    ends = np.flatnonzero(~failed & previous_failed)
+    # every end closes the last start before it, which is of the same series
+    closed = np.searchsorted(starts, ends) - 1
+    closing_starts = starts[closed]
+
+    open_starts = np.delete(starts, closed)
+    return ((series[closing_starts], times[closing_starts], times[ends]),
+            (series[open_starts], times[open_starts]))
+
+
+def count_healthy(series, times, failed):
+    '''
+        Number of healthy series over time, healthy as in find_outages.
+        Series without any sample aren't counted.
+
+        returns the times the count changed, starting with the first
+        sample, and the count from each of them on
+    '''
+    order = np.lexsort((times, series))
+    series = series[order]
+    times = times[order]
+    failed = failed[order]
+
+    previous_failed = np.empty_like(failed)
+    previous_failed[0] = False
+    previous_failed[1:] = failed[:-1]
+    previous_failed[1:][series[1:] != series[:-1]] = False
+
+    seen = len(np.unique(series))
+    changed = np.flatnonzero(failed != previous_failed)
+    change_times = times[changed]
+    deltas = np.where(failed[changed], -1, 1)
+    in_order = np.argsort(change_times, kind='stable')
+    # series seen at all start healthy
+    change_times = np.concatenate(([times.min()], change_times[in_order]))
+    counts = seen + np.concatenate(([0], np.cumsum(deltas[in_order])))
+
+    # changes at the same time count once, with the count after all of them
+    last = np.ones(len(change_times), dtype=bool)
+    last[:-1] = change_times[1:] != change_times[:-1]
+    return change_times[last], counts[last]
+
+
+def find_intervals_below(times, counts, threshold):
+    '''
+        Intervals during which a step function is below threshold
+
+        times, counts: the steps, as count_healthy returns them
+        returns start and end of every interval which ended and the start of
+        the one still going on at the last step, None if there is none
+    '''
+    below = counts < threshold
+    previous_below = np.empty_like(below)
+    previous_below[0] = False
+    previous_below[1:] = below[:-1]
+    starts = times[below & ~previous_below]
+    ends = times[~below & previous_below]
+    if len(starts) > len(ends):
+        return starts[:-1], ends, float(starts[-1])
+    return starts, ends, None
+
+
+def _summarize_intervals(starts, ends, open_start, end):
+    summary = summarize(ends - starts)
+    summary['unrestored'] = 0 if open_start is None else 1
+    # the one still going on counts until the end of the monitoring
+    total = float((ends - starts).sum()) + (0.0 if open_start is None else end - open_start)
+    return summary, total
+
+
+def service_availability(series, times, failed, size, quorum):
+    '''
+        Availability of a service which needs quorum of its size replicas
+        healthy, from the samples of the replicas as for find_outages.
+        Replicas without any sample count as down.
+
+        returns the time the service had quorum and all its replicas, the
+        quorum loss and degraded intervals, and the healthy count over time
+    '''
+    change_times, counts = count_healthy(series, times, failed)
+    start, end = float(times.min()), float(times.max())
+    window = end - start
+    durations = np.diff(np.append(change_times, end))
+
+    service = dict(replicas=int(size), quorum=int(quorum), start=start, end=end,
+                   min_healthy=int(counts.min()),
+                   mean_healthy=float((durations * counts).sum() / window) if window
+                   else float(counts[0]))
+    for name, threshold in (('quorum_loss', quorum), ('degraded', size)):
+        starts, ends, open_start = find_intervals_below(change_times, counts, threshold)
+        summary, total = _summarize_intervals(starts, ends, open_start, end)
+        intervals = [dict(down=float(down), up=float(up), duration=float(up - down))
+                     for down, up in zip(starts, ends)]
+        if open_start is not None:
+            intervals.append(dict(down=open_start, up=None, duration=None))
+        service[name] = dict(summary, intervals=intervals)
+        service['availability' if name == 'quorum_loss' else 'full_availability'] = \
+            1.0 - total / window if window else float(counts[0] >= threshold)
+    service['timeline'] = [[float(time), int(count)] for time, count in zip(change_times, counts)]
+    return service
+
+
+def summarize(durations):
+    durations = np.asarray(durations, dtype=np.float64)
+    if len(durations) == 0:
+        return dict(outages=0)
+    summary = dict(outages=int(len(durations)),
+                   mttr=float(durations.mean()),
+                   min=float(durations.min()),
+                   max=float(durations.max()),
+                   total_downtime=float(durations.sum()))
+    for percentile, value in zip(PERCENTILES, np.percentile(durations, PERCENTILES)):
+        summary['p%d' % percentile] = float(value)
+    return summary
+
+
+def _summarize_by(codes, names, durations, unrecovered_codes):
+    summaries = {}
+    for code in np.unique(np.concatenate((codes, unrecovered_codes))):
+        summary = summarize(durations[codes == code])
+        summary['unrecovered'] = int(np.count_nonzero(unrecovered_codes == code))
+        summaries[names[code]] = summary
+    return summaries
+
 
 class RecoveryReporter():
+    '''
+        services: optional replica groups by monitor name, each with the
+        hosts of the group and the quorum of them the service needs, a
+        number or majority. Without hosts, the hosts in the log are the
+        group.
+    '''
 
-    def __init__(self, input_file):
+    def __init__(self, input_file, services=None):
         self.input_file = input_file
+        self.services = services or {}
         self.output_file = input_file + '.out'
         self.output_graph = input_file + '.png'
 
-    def _get_json(self, file):
+    def _get_recovery_times(self, data):
         '''
-            Convert file's data to json list
-
-        file: file containing json appended data created by the monitors
+            data: monitoring results as MonitorData
+            recovery_times: returns all the outages found in the monitoring
+            results and their statistics per host and per monitor
         '''
-        with open(file, 'r') as f :
-            filedata = f.read()
-        filedata = filedata.replace('}\n{', '},{')
-        return json.loads('[' + filedata + ']')
+        # one series per monitor and host
+        series = data.job_codes.astype(np.int64) * len(data.hosts) + data.host_codes
+        (recovered, down, up), (unrecovered, _) = find_outages(series, data.times, data.failed)
+        durations = up - down
 
-    def _get_result_for_hosts(self, results):
-        '''
-            Split results for by hosts
-        '''
-        sorted_by_host = sorted(results, key=lambda x:x['host'])
-        all_results = []
-        result_from_host = []
-        previous = None
-        for result in sorted_by_host:
-            if result['host'] != previous:
-                if(len(result_from_host)!=0):
-                    all_results.append(result_from_host)
-                result_from_host = [result]
-                previous = result['host']
-            else:
-                result_from_host.append(result)
-        all_results.append(result_from_host)
-
-        return all_results
-
-    def _get_recovery_time(self, results):
+        job_codes, host_codes = np.divmod(recovered, len(data.hosts))
+        unrecovered_jobs, unrecovered_hosts = np.divmod(unrecovered, len(data.hosts))
+
+        outages = [dict(job_name=data.jobs[job], host=data.hosts[host],
+                        down=float(down_at), up=float(up_at), duration=float(duration))
+                   for job, host, down_at, up_at, duration
+                   in zip(job_codes, host_codes, down, up, durations)]
+        return dict(hosts=_summarize_by(host_codes, data.hosts, durations, unrecovered_hosts),
+                    monitors=_summarize_by(job_codes, data.jobs, durations, unrecovered_jobs),
+                    outages=outages)
+
+    def _get_services(self, data):
         '''
-            result: monitoring results of the same host and monitor
-            recovery_times: returns list of all the recovery times during the
-            monitoring
+            Quorum and availability of every monitor in services, computed
+            over the hosts of its group
         '''
-        results = sorted(results, key=lambda x:x['time'])
-        recovery_times = []
-        previous_rc = 0
-        for result in results:
-            if result['return_code'] > 0 and previous_rc == 0:
-                failure_time = datetime.strptime(result['time'], TIME_FORMAT)
-                previous_rc = 1
-            elif result['return_code'] == 0 and previous_rc > 0:
-                up_time = datetime.strptime(result['time'], TIME_FORMAT)
-                previous_rc = 0
-                recovery_time = (up_time-failure_time).total_seconds()
-                recovery_times.append(recovery_time)
-
-        # only getting the last one
-        if (len(recovery_times)>0):
-            return recovery_times[len(recovery_times)-1]
-        else:
-            return None
+        services = {}
+        for job_name, group in self.services.items():
+            if job_name not in data.jobs:
+                logger.info("No samples of %s, no service availability", job_name)
+                continue
+            hosts = group.get('hosts') or data.hosts
+            # host codes of the log to replica indexes, -1 outside the group
+            replicas = dict((host, index) for index, host in enumerate(hosts))
+            replica_codes = np.array([replicas.get(host, -1) for host in data.hosts],
+                                     dtype=np.int64)
+            replica = replica_codes[data.host_codes]
+            selected = (data.job_codes == data.jobs.index(job_name)) & (replica >= 0)
+            if not selected.any():
+                logger.info("No samples of the hosts of %s, no service availability", job_name)
+                continue
+
+            quorum = group['quorum']
+            if quorum == 'majority':
+                quorum = len(hosts) // 2 + 1
+            service = service_availability(replica[selected], data.times[selected],
+                                           data.failed[selected], len(hosts), quorum)
+            logger.info("%s had quorum (%s of %s) %.4f of the time, %s quorum losses",
+                        job_name, quorum, len(hosts), service['availability'],
+                        service['quorum_loss']['outages'] + service['quorum_loss']['unrestored'])
+            services[job_name] = service
+        return services
 
 
     def _write_to_file(self, recovery_times):
@@ -85,20 +349,26 @@ class RecoveryReporter():
 
 
     def plot_recovery_times_plot(self, data):
-        if (len(data.keys())==0):
+        import matplotlib.pyplot as plt
+
+        hosts = dict((host, summary) for host, summary in data.get('hosts', {}).items()
+                     if summary['outages'] > 0)
+        if (len(hosts.keys())==0):
             logger.info("Empty data, nothing to plot")
             return
 
-        nodes = [i.split('.')[0] for i in data.keys()]
-        recovery_times = [data[t] for t in data.keys()]
+        nodes = [i.split('.')[0] for i in hosts.keys()]
+        recovery_times = [hosts[t]['mttr'] for t in hosts.keys()]
+        errors = np.array([[hosts[t]['mttr'] - hosts[t]['min'] for t in hosts.keys()],
+                           [hosts[t]['max'] - hosts[t]['mttr'] for t in hosts.keys()]])
         x_pos = np.arange(len(nodes))
 
-        plt.bar(x_pos, recovery_times, align='center', alpha=0.5)
+        plt.bar(x_pos, recovery_times, yerr=errors, align='center', alpha=0.5)
 
         plt.xticks(x_pos, nodes, rotation=45, ha="right")
 
         plt.xlabel('Nodes')
-        plt.ylabel('Time to recover (seconds)')
+        plt.ylabel('Mean time to recover (seconds)')
         plt.tight_layout()
 
         plt.savefig(self.output_graph)
@@ -115,19 +385,19 @@ class RecoveryReporter():
 
 
     def generate_time_vs_recovery_report(self):
-        monitor_data = self._get_json(self.input_file)
-        if(len(monitor_data)==0):
+        if not os.path.exists(self.input_file) or os.path.getsize(self.input_file) == 0:
             logger.info("No monitoring data found. No report to generate.")
             return
 
-        results_by_host = self._get_result_for_hosts(monitor_data)
-        all_recovery_times = {}
-        for single_host_results in results_by_host:
-            recovery_time = self._get_recovery_time(single_host_results)
-            if(recovery_time):
-                all_recovery_times[single_host_results[1]['host']] = recovery_time
+        data = MonitorData.load(self.input_file)
+        if(len(data)==0):
+            logger.info("No monitoring data found. No report to generate.")
+            return
+        all_recovery_times = self._get_recovery_times(data)
+        if self.services:
+            all_recovery_times['services'] = self._get_services(data)
 
-        logger.info("%s services recoverd", len(all_recovery_times))
+        logger.info("%s outages found in %s samples", len(all_recovery_times['outages']), len(data))
         logger.info("Writing results to file")
         self._write_to_file(all_recovery_times)
         self._create_graph()
@@ -135,4 +405,3 @@ class RecoveryReporter():
     def generate_report(self):
         logger.info("Generating report")
         self.generate_time_vs_recovery_report()
-
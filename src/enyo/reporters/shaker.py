@@ -0,0 +1,322 @@
+'''
+    Analysis of the raw JSON report of Shaker. The samples of every agent
+    are read into flat arrays, one series per agent pair and measured
+    metric, and every series is compared before and after each injection.
+'''
+import os
+import json
+
+import numpy as np
+
+from enyo.utils.custom_logger import CustomLogger, log_dir_file
+from enyo.config import Config
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+config = Config()
+logger = CustomLogger(log_dir_file('report.log'), name=__name__)
+
+THROUGHPUT = 0
+LATENCY = 1
+PACKET_LOSS = 2
+KIND_NAMES = ('throughput', 'latency', 'packet_loss')
+# factor converting a throughput unit to Mbit/s
+THROUGHPUT_UNITS = {'bit/s': 1e-6, 'bits/s': 1e-6, 'kbit/s': 1e-3, 'kbits/s': 1e-3,
+                    'mbit/s': 1.0, 'mbits/s': 1.0, 'gbit/s': 1e3, 'gbits/s': 1e3}
+# a sample is degraded when throughput dropped or latency rose by more than
+# this fraction of the baseline, or packet loss rose by this many percent
+THRESHOLDS = np.array([0.2, 0.2, 1.0])
+# seconds before an injection the baseline is taken from
+BASELINE_WINDOW = 30
+
+
+def metric_kind(name, unit):
+    '''
+        Kind of a column of the Shaker samples and the factor its values
+        are scaled with, None for columns which aren't analyzed
+    '''
+    name = name.lower()
+    unit = (unit or '').lower()
+    if 'loss' in name or 'lost' in name:
+        return PACKET_LOSS, 1.0
+    if unit in THROUGHPUT_UNITS:
+        return THROUGHPUT, THROUGHPUT_UNITS[unit]
+    if unit == 'ms' or 'latency' in name or 'ping' in name:
+        return LATENCY, 1.0
+    return None, None
+
+
+def _stream_records(file):
+    with open(file, 'rb') as f:
+        for _, record in ijson.kvitems(f, 'records', use_float=True):
+            yield record
+
+
+def read_report(file):
+    '''
+        Agents and records of a Shaker report. With ijson installed the
+        records are streamed one by one instead of loading the whole report.
+    '''
+    if ijson is None:
+        logger.warning("ijson isn't installed, loading all of %s into memory", file)
+        with open(file, 'r') as f:
+            report = json.load(f)
+        records = report.get('records', {})
+        return report.get('agents', {}), (records.values() if isinstance(records, dict) else records)
+
+    with open(file, 'rb') as f:
+        agents = dict(ijson.kvitems(f, 'agents', use_float=True))
+    return agents, _stream_records(file)
+
+
+def pair_name(record, agents):
+    agent_id = record.get('agent')
+    agent = agents.get(agent_id, {})
+    peer = agent.get('slave_id') or agent.get('minion_id')
+    if peer:
+        return '%s->%s' % (agent_id, peer)
+    return str(agent_id)
+
+
+class ShakerData(object):
+    '''
+        All the samples of a Shaker report as arrays sorted by series and
+        time. A series is one metric of one agent pair, its name, metric
+        and kind are in names, metrics and kinds.
+    '''
+
+    def __init__(self, names, metrics, kinds, series, times, values):
+        self.names = names
+        self.metrics = metrics
+        self.kinds = kinds
+        self.series = series
+        self.times = times
+        self.values = values
+
+    def __len__(self):
+        return len(self.times)
+
+    @classmethod
+    def load(cls, file):
+        agents, records = read_report(file)
+        codes = {}
+        kinds = []
+        series = []
+        times = []
+        values = []
+
+        for record in records:
+            samples = record.get('samples') or []
+            meta = record.get('meta') or []
+            if len(samples) == 0 or len(meta) < 2:
+                continue
+            # the time column counts from the start of the agent's test
+            samples = np.array(samples, dtype=np.float64)
+            sample_times = samples[:, 0] + float(record.get('start') or 0)
+            pair = pair_name(record, agents)
+
+            for column, (name, unit) in enumerate(meta[1:], 1):
+                kind, scale = metric_kind(name, unit)
+                if kind is None:
+                    continue
+                key = (pair, name)
+                if key not in codes:
+                    codes[key] = len(codes)
+                    kinds.append(kind)
+                column_values = samples[:, column] * scale
+                # agents report nothing for the intervals they were cut off
+                valid = np.isfinite(column_values)
+                series.append(np.full(np.count_nonzero(valid), codes[key], dtype=np.int64))
+                times.append(sample_times[valid])
+                values.append(column_values[valid])
+
+        if len(series) == 0:
+            empty = np.empty(0)
+            return cls([], [], np.empty(0, dtype=np.int64), empty.astype(np.int64), empty, empty)
+
+        series = np.concatenate(series)
+        times = np.concatenate(times)
+        values = np.concatenate(values)
+        order = np.lexsort((times, series))
+        return cls([pair for pair, _ in codes], [name for _, name in codes],
+                   np.array(kinds, dtype=np.int64), series[order], times[order], values[order])
+
+
+def _first_per_series(series, mask, count):
+    '''
+        Index of the first sample of every series for which mask is set, -1
+        for series without any. Samples have to be sorted by series and time.
+    '''
+    first = np.full(count, -1, dtype=np.int64)
+    index = np.flatnonzero(mask)
+    codes, positions = np.unique(series[index], return_index=True)
+    first[codes] = index[positions]
+    return first
+
+
+def _at(values, index):
+    return np.where(index >= 0, values[np.maximum(index, 0)], np.nan)
+
+
+def find_degradations(data, injected_at, end, baseline_window=BASELINE_WINDOW):
+    '''
+        How every series reacted to an injection
+
+        data: ShakerData
+        injected_at: epoch time of the injection
+        end: end of the window after the injection, e.g. the next injection
+        returns arrays indexed by series: baseline (mean of the samples in
+        baseline_window before the injection), depth (largest deviation from
+        the baseline: fraction of throughput lost, fraction of latency added,
+        percent of packets lost), time to degrade and time to restore, both
+        counted from the injection and nan when it didn't happen
+    '''
+    count = len(data.names)
+    series = data.series
+    times = data.times
+
+    before = (times < injected_at) & (times >= injected_at - baseline_window)
+    sums = np.bincount(series[before], data.values[before], minlength=count)
+    samples = np.bincount(series[before], minlength=count)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        baseline = sums / samples
+        sample_baseline = baseline[series]
+        sample_kinds = data.kinds[series]
+        ratio = data.values / sample_baseline
+        deviation = np.where(sample_kinds == PACKET_LOSS, data.values - sample_baseline,
+                             np.where(sample_kinds == THROUGHPUT, 1 - ratio, ratio - 1))
+
+    after = (times >= injected_at) & (times < end) & np.isfinite(deviation)
+    degraded = after & (deviation > THRESHOLDS[sample_kinds])
+
+    depth = np.full(count, np.nan)
+    index = np.flatnonzero(after)
+    if len(index):
+        after_series = series[index]
+        starts = np.flatnonzero(np.concatenate(([True], after_series[1:] != after_series[:-1])))
+        depth[after_series[starts]] = np.maximum.reduceat(deviation[index], starts)
+
+    degraded_at = _at(times, _first_per_series(series, degraded, count))
+    with np.errstate(invalid='ignore'):
+        restored = after & ~degraded & (times > degraded_at[series])
+    restored_at = _at(times, _first_per_series(series, restored, count))
+    return baseline, depth, degraded_at - injected_at, restored_at - injected_at
+
+
+def _value(value):
+    value = float(value)
+    return value if np.isfinite(value) else None
+
+
+def _stats(values):
+    values = values[np.isfinite(values)]
+    if len(values) == 0:
+        return dict(mean=None, max=None)
+    return dict(mean=float(values.mean()), max=float(values.max()))
+
+
+class ShakerReporter():
+
+    def __init__(self, input_file, injection_times=None):
+        self.input_file = input_file
+        self.output_file = input_file + '.out'
+        self.output_graph = input_file + '.png'
+        self.injection_times = sorted(injection_times or [], key=lambda injection: injection['time'])
+
+    def _get_degradations(self, data):
+        injections = []
+        for index, injection in enumerate(self.injection_times):
+            if index + 1 < len(self.injection_times):
+                end = self.injection_times[index + 1]['time']
+            else:
+                end = np.inf
+            baseline, depth, time_to_degrade, time_to_restore = find_degradations(
+                data, injection['time'], end)
+            degraded = np.isfinite(time_to_degrade)
+
+            pairs = {}
+            for code in np.flatnonzero(np.isfinite(baseline)):
+                pairs.setdefault(data.names[code], {})[data.metrics[code]] = dict(
+                    kind=KIND_NAMES[data.kinds[code]],
+                    baseline=_value(baseline[code]),
+                    depth=_value(depth[code]),
+                    degraded=bool(degraded[code]),
+                    time_to_degrade=_value(time_to_degrade[code]),
+                    time_to_restore=_value(time_to_restore[code]))
+
+            summary = {}
+            for kind, kind_name in enumerate(KIND_NAMES):
+                in_kind = (data.kinds == kind) & np.isfinite(baseline)
+                if not np.any(in_kind):
+                    continue
+                hit = in_kind & degraded
+                summary[kind_name] = dict(series=int(np.count_nonzero(in_kind)),
+                                          degraded=int(np.count_nonzero(hit)),
+                                          unrestored=int(np.count_nonzero(hit & ~np.isfinite(time_to_restore))),
+                                          depth=_stats(depth[hit]),
+                                          time_to_degrade=_stats(time_to_degrade[hit]),
+                                          time_to_restore=_stats(time_to_restore[hit]))
+            injections.append(dict(injection, summary=summary, pairs=pairs))
+        return injections
+
+    def _get_series_stats(self, data):
+        count = len(data.names)
+        samples = np.bincount(data.series, minlength=count)
+        means = np.bincount(data.series, data.values, minlength=count) / np.maximum(samples, 1)
+        pairs = {}
+        for code in np.flatnonzero(samples):
+            pairs.setdefault(data.names[code], {})[data.metrics[code]] = dict(
+                kind=KIND_NAMES[data.kinds[code]], samples=int(samples[code]),
+                mean=float(means[code]))
+        return pairs
+
+
+    def plot(self, data):
+        import matplotlib.pyplot as plt
+
+        kinds = [kind for kind in range(len(KIND_NAMES)) if np.any(data.kinds == kind)]
+        if len(data) == 0 or len(kinds) == 0:
+            logger.info("Empty data, nothing to plot")
+            return
+
+        start = data.times.min()
+        # mean over all the series of a kind in one second bins
+        bins = (data.times - start).astype(np.int64)
+        figure, axes = plt.subplots(len(kinds), 1, sharex=True, squeeze=False)
+        for axis, kind in zip(axes[:, 0], kinds):
+            in_kind = data.kinds[data.series] == kind
+            sums = np.bincount(bins[in_kind], data.values[in_kind])
+            samples = np.bincount(bins[in_kind])
+            seconds = np.flatnonzero(samples)
+            axis.plot(seconds, sums[seconds] / samples[seconds], color='deepskyblue')
+            for injection in self.injection_times:
+                axis.axvline(injection['time'] - start, color='orangered', linestyle='--')
+            axis.set_ylabel(KIND_NAMES[kind].replace('_', ' '))
+
+        axes[-1, 0].set_xlabel('Time (seconds)')
+        figure.tight_layout()
+        figure.savefig(self.output_graph)
+        plt.close(figure)
+
+
+    def generate_report(self):
+        if not os.path.exists(self.input_file):
+            logger.info("No shaker report %s found. No report to generate.", self.input_file)
+            return
+
+        data = ShakerData.load(self.input_file)
+        logger.info("%s samples of %s series read from %s", len(data), len(data.names),
+                    self.input_file)
+        report = dict(series=self._get_series_stats(data),
+                      injections=self._get_degradations(data))
+        with open(self.output_file, 'w') as f:
+            json.dump(report, f)
+
+        try:
+            self.plot(data)
+        except Exception as exception:
+            logger.error("Error occured during creation of graphical report: %s",
+                         exception)
@@ -0,0 +1,227 @@
+'''
+    SQLite store keeping the results of every run in one place, so results
+    can be compared across runs without parsing the raw logs again.
+'''
+import os
+import json
+import sqlite3
+
+import numpy as np
+
+from enyo.utils.custom_logger import CustomLogger, log_dir_file
+from enyo.config import Config
+from enyo.reporters.recovery import MonitorData
+from enyo.reporters.rally import RallyData
+
+config = Config()
+logger = CustomLogger(log_dir_file('report.log'), name=__name__)
+# seconds a write waits for the ones of other processes, e.g. the parallel
+# workers of a suite storing their runs
+DEFAULT_TIMEOUT = 300
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    scenario TEXT NOT NULL,
+    loader TEXT,
+    started REAL,
+    finished REAL
+);
+CREATE TABLE IF NOT EXISTS injections (
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    name TEXT,
+    type TEXT,
+    host TEXT,
+    command TEXT,
+    inject_at REAL,
+    injected REAL,
+    scheduled_at REAL,
+    finished REAL,
+    skew REAL
+);
+CREATE TABLE IF NOT EXISTS monitor_samples (
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    job_name TEXT,
+    host TEXT,
+    time REAL,
+    failed INTEGER
+);
+CREATE TABLE IF NOT EXISTS recoveries (
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    job_name TEXT,
+    host TEXT,
+    down REAL,
+    up REAL,
+    duration REAL
+);
+CREATE TABLE IF NOT EXISTS rally_iterations (
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    task TEXT,
+    subtask TEXT,
+    workload TEXT,
+    timestamp REAL,
+    duration REAL,
+    error INTEGER
+);
+CREATE INDEX IF NOT EXISTS runs_scenario ON runs(scenario, started);
+CREATE INDEX IF NOT EXISTS injections_run ON injections(run_id);
+CREATE INDEX IF NOT EXISTS samples_run ON monitor_samples(run_id, job_name, host, time);
+CREATE INDEX IF NOT EXISTS samples_host ON monitor_samples(host, time);
+CREATE INDEX IF NOT EXISTS recoveries_run ON recoveries(run_id);
+CREATE INDEX IF NOT EXISTS recoveries_service ON recoveries(job_name, host);
+CREATE INDEX IF NOT EXISTS recoveries_host ON recoveries(host, down);
+CREATE INDEX IF NOT EXISTS iterations_run ON rally_iterations(run_id, workload, timestamp);
+'''
+
+
+def default_path():
+    return config.get_value('results_db') or os.path.join(config.get_value('log_dir'), 'results.db')
+
+
+class ResultsStore(object):
+
+    def __init__(self, path=None):
+        self.path = path or default_path()
+        self.connection = sqlite3.connect(self.path, timeout=config.get_value('results_db_timeout')
+                                          or DEFAULT_TIMEOUT)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.executescript(SCHEMA)
+        # scheduled held the offset of inject_at, easily mixed up with the
+        # epoch time of scheduled_at
+        self._add_missing_columns('injections', dict(scheduled_at='REAL', finished='REAL',
+                                                     skew='REAL'),
+                                  renamed=dict(scheduled='inject_at'))
+
+    def _add_missing_columns(self, table, columns, renamed=None):
+        '''
+            Upgrade tables created by older versions, renamed maps old column
+            names to new ones
+        '''
+        existing = [row[1] for row in self.connection.execute('PRAGMA table_info(%s)' % table)]
+        with self.connection:
+            for old, new in (renamed or {}).items():
+                if old in existing and new not in existing:
+                    self.connection.execute('ALTER TABLE %s RENAME COLUMN %s TO %s'
+                                            % (table, old, new))
+            for column, column_type in columns.items():
+                if column not in existing:
+                    self.connection.execute('ALTER TABLE %s ADD COLUMN %s %s'
+                                            % (table, column, column_type))
+
+    def close(self):
+        self.connection.close()
+
+    def add_run(self, scenario, loader, started, finished):
+        with self.connection:
+            cursor = self.connection.execute(
+                'INSERT INTO runs (scenario, loader, started, finished) VALUES (?, ?, ?, ?)',
+                (scenario, loader, started, finished))
+        return cursor.lastrowid
+
+    def add_injections(self, run_id, injectors):
+        with self.connection:
+            self.connection.executemany(
+                'INSERT INTO injections (run_id, name, type, host, command, inject_at, injected, '
+                'scheduled_at, finished, skew) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                [(run_id, injector.job_name, type(injector).__name__.lower(), injector.host,
+                  injector.command, injector.inject_at, injector.injected_at,
+                  injector.scheduled_at, injector.finished_at, injector.skew)
+                 for injector in injectors])
+
+    def add_monitor_samples(self, run_id, monitor_file):
+        '''
+            Store every sample of a monitor log
+        '''
+        if not os.path.exists(monitor_file):
+            logger.info("No monitor log %s to store", monitor_file)
+            return
+        data = MonitorData.load(monitor_file)
+        jobs = np.array(data.jobs, dtype=object)[data.job_codes]
+        hosts = np.array(data.hosts, dtype=object)[data.host_codes]
+        with self.connection:
+            self.connection.executemany(
+                'INSERT INTO monitor_samples VALUES (?, ?, ?, ?, ?)',
+                zip([run_id] * len(data), jobs, hosts, data.times.tolist(),
+                    data.failed.astype(int).tolist()))
+
+    def add_recoveries(self, run_id, recovery_file):
+        '''
+            Store the outages found by the RecoveryReporter
+        '''
+        if not os.path.exists(recovery_file):
+            logger.info("No recovery report %s to store", recovery_file)
+            return
+        with open(recovery_file, 'r') as f:
+            outages = json.load(f).get('outages', [])
+        with self.connection:
+            self.connection.executemany(
+                'INSERT INTO recoveries VALUES (?, ?, ?, ?, ?, ?)',
+                [(run_id, outage['job_name'], outage['host'], outage['down'], outage['up'],
+                  outage['duration']) for outage in outages])
+
+    def add_rally_iterations(self, run_id, rally_file):
+        '''
+            Store the iterations of every workload of a Rally JSON report
+        '''
+        if not os.path.exists(rally_file):
+            logger.info("No rally report %s to store", rally_file)
+            return
+        # streamed with ijson, large reports aren't loaded into memory at once
+        data = RallyData.load(rally_file)
+        series, started, durations, failed = data.iterations.to_arrays()
+        rows = []
+        for code, timestamp, duration, error in zip(series.tolist(), started.tolist(),
+                                                    durations.tolist(), failed.tolist()):
+            workload = data.workloads[code]
+            rows.append((run_id, workload['task'], workload['subtask'], workload['name'],
+                         timestamp, None if np.isnan(duration) else duration, int(error)))
+        with self.connection:
+            self.connection.executemany(
+                'INSERT INTO rally_iterations VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def runs(self, scenario=None, limit=None):
+        query = 'SELECT id, scenario, loader, started, finished FROM runs'
+        params = []
+        if scenario:
+            query += ' WHERE scenario LIKE ?'
+            params.append('%' + scenario + '%')
+        query += ' ORDER BY started DESC'
+        if limit:
+            query += ' LIMIT ?'
+            params.append(limit)
+        return self.connection.execute(query, params).fetchall()
+
+    def recovery_trend(self, job_name, host=None):
+        '''
+            Outage count, MTTR and the longest recovery of a monitor in every
+            run it sampled, oldest run first. Runs without outages have a
+            count of 0 and no MTTR.
+        '''
+        recoveries = 'recoveries.run_id = runs.id AND recoveries.job_name = ?'
+        samples = 'monitor_samples.run_id = runs.id AND monitor_samples.job_name = ?'
+        params = [job_name]
+        if host:
+            recoveries += ' AND recoveries.host = ?'
+            samples += ' AND monitor_samples.host = ?'
+            params.append(host)
+        query = ('SELECT runs.id, runs.scenario, runs.started, COUNT(recoveries.duration), '
+                 'AVG(recoveries.duration), MAX(recoveries.duration) '
+                 'FROM runs LEFT JOIN recoveries ON %s '
+                 'WHERE EXISTS (SELECT 1 FROM monitor_samples WHERE %s) '
+                 'GROUP BY runs.id ORDER BY runs.started' % (recoveries, samples))
+        return self.connection.execute(query, params + params).fetchall()
+
+    def regressions(self, job_name, window=5, threshold=1.2, host=None):
+        '''
+            Runs whose MTTR is more than threshold times the mean MTTR of the
+            window runs before them. Runs without outages count with an MTTR
+            of 0.
+        '''
+        trend = self.recovery_trend(job_name, host)
+        regressions = []
+        for index in range(1, len(trend)):
+            previous = [row[4] or 0 for row in trend[max(0, index - window):index]]
+            baseline = sum(previous) / len(previous)
+            if (trend[index][4] or 0) > baseline * threshold:
+                regressions.append(trend[index] + (baseline,))
+        return regressions
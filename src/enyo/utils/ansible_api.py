@@ -1,8 +1,10 @@
 #!/usr/bin/env python
 import os
 import json
+import atexit
 import shutil
 import logging
+from threading import Lock
 
 from ansible.module_utils.common.collections import ImmutableDict
 from ansible.parsing.dataloader import DataLoader
@@ -15,10 +17,37 @@ from ansible import context
 import ansible.constants as C
 
 from enyo.config import Config
+from enyo.utils import results
+from enyo.utils.inventory import Inventory, populate
 from enyo.utils.custom_logger import CustomLogger
+from enyo.utils.task import Task
+from enyo.utils import tracing
 
 ENYO_BIN_DIR = "/home/ihti/thesis/code/enyo/inventory/"
 config = Config()
+# Ansible's plugin loader isn't thread safe, runners starting in parallel
+# threads load their callback plugins one at a time
+_plugin_lock = Lock()
+_plugin_loader_ready = False
+
+
+def init_plugin_loader():
+    '''
+        Set up Ansible's plugin and collection loader once per process, which
+        its CLI does on start. Without it no play finds ansible.builtin.
+    '''
+    global _plugin_loader_ready
+    with _plugin_lock:
+        if _plugin_loader_ready:
+            return
+        try:
+            from ansible.plugins.loader import init_plugin_loader as init_loader
+        except ImportError:
+            # ansible-core before 2.15 sets it up when it's imported
+            pass
+        else:
+            init_loader()
+        _plugin_loader_ready = True
 
 class ResultsCollector(CallbackBase):
   def __init__(self, job_name, logger, *args, **kwargs):
@@ -26,52 +55,86 @@ class ResultsCollector(CallbackBase):
     self.hosts = []
     self.logger = logger
     self.job_name = job_name
+    # results of warm up runs are not recorded
+    self.muted = False
 
-  def v2_runner_on_unreachable(self, result, ignore_errors=False):
-    result_json = {
-                    'job_name': self.job_name,
-                    'time': result._result['end'],
-                    'host': result._host.get_name(),
-                    'output': 'Host unreachable',
-                    'error' : result._result['stderr'],
-                    'success': False
-                  }
+  def _add(self, result_json):
     self.hosts.append(result_json)
-    self.logger.info(json.dumps(result_json, indent=4))
+    # without a logger the records are only collected
+    if self.logger is not None:
+      results.write_record(self.logger, result_json)
+
+  def _end_time(self, result):
+    if 'end' in result._result:
+      return results.to_epoch(result._result['end'])
+    return results.now()
+
+  def _command(self, result):
+    # modules failing before the command ran, e.g. on a bad argument or a
+    # missing interpreter, only return msg
+    args = result._task.args
+    return result._result.get('cmd', args.get('_raw_params', args.get('cmd')))
+
+  def v2_runner_on_unreachable(self, result, ignore_errors=False):
+    if self.muted:
+      return
+    # unreachable results don't carry the module's stderr
+    self._add(results.unreachable_record(self.job_name,
+                                         self._end_time(result),
+                                         result._host.get_name(),
+                                         result._result.get('stderr', result._result.get('msg'))))
 
   def v2_runner_on_ok(self, result):
-    result_json = {
-                    'job_name': self.job_name,
-                    'time':result._result['end'],
-                    'host':result._host.get_name(),
-                    'command': result._result['cmd'],
-                    'return_code': result._result['rc'],
-                    'output': result._result['stdout'],
-                    'success':True
-                  }
-    self.hosts.append(result_json)
-    self.logger.info(json.dumps(result_json, indent=4))
+    if self.muted:
+      return
+    self._add(results.ok_record(self.job_name,
+                                self._end_time(result),
+                                result._host.get_name(),
+                                self._command(result),
+                                result._result.get('rc', 0),
+                                result._result.get('stdout', '')))
 
   def v2_runner_on_failed(self, result, ignore_errors=False):
-    result_json = {
-                    'job_name': self.job_name,
-                    'time':result._result['end'],
-                    'host':result._host.get_name(),
-                    'command': result._result['cmd'],
-                    'return_code': result._result['rc'],
-                    'output': result._result['stdout'],
-                    'error' : result._result['stderr'],
-                    'success':False
-                  }
-    self.hosts.append(result_json)
-    self.logger.info(json.dumps(result_json, indent=4))
+    if self.muted:
+      return
+    self._add(results.failed_record(self.job_name,
+                                    self._end_time(result),
+                                    result._host.get_name(),
+                                    self._command(result),
+                                    result._result.get('rc', 1),
+                                    result._result.get('stdout', ''),
+                                    result._result.get('stderr', result._result.get('msg'))))
 
   def get(self):
     return self.hosts
 
-class AnsibleRunner():
+  def take(self):
+    '''
+      The records collected since the last call
+    '''
+    hosts = self.hosts
+    self.hosts = []
+    return hosts
+
+def _remove_local_tmp():
+    # shared by every runner of the process, removed once when it exits
+    shutil.rmtree(C.DEFAULT_LOCAL_TMP, True)
+
+atexit.register(_remove_local_tmp)
+
 
-    def __init__(self, job_name, logger , inventory=config.get_value('inventory_file')):
+class ExecutionContext():
+    '''
+        Loader and inventory shared by every AnsibleRunner using the same
+        inventory source, so the inventory is only built once per process
+        instead of once per run. Runs change the caches of their variable
+        manager, every runner has its own.
+    '''
+    _contexts = {}
+    _lock = Lock()
+
+    def __init__(self, inventory):
+        init_plugin_loader()
         # since the API is constructed for CLI it expects certain options to always be set in the context object
         context.CLIARGS = ImmutableDict(connection='smart', module_path=['/to/mymodules'], forks=10, become=None,
                                         become_method=None, become_user=None, check=False, diff=False,
@@ -79,57 +142,127 @@ class AnsibleRunner():
 
         # initialize needed objects
         self.loader = DataLoader() # Takes care of finding and reading yaml, json and ini files
+
+        # create an empty inventory and fill it in-process from the cached
+        # inventory, instead of letting Ansible run the inventory script.
+        # Parsing no sources would only warn that none was parsed.
+        self.inventory = InventoryManager(loader=self.loader, sources=[], parse=False)
+        populate(self.inventory._inventory, Inventory.get(inventory).data)
+
+    @classmethod
+    def get(cls, inventory):
+        with cls._lock:
+            if inventory not in cls._contexts:
+                cls._contexts[inventory] = cls(inventory)
+            return cls._contexts[inventory]
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            cls._contexts.clear()
+
+
+class AnsibleRunner():
+    '''
+        Long lived runner, meant to be created once per monitor/injector and
+        reused for every run. The compiled plays, the variable manager and
+        the TaskQueueManager with its loaded callbacks are kept between
+        runs. Its worker processes are not: the TaskQueueManager forks them
+        for every play and stops them at the end of it. close() has to be
+        called once the runner is not needed anymore.
+    '''
+
+    def __init__(self, job_name, logger , inventory=None):
+        self.context = ExecutionContext.get(inventory or config.get_value('inventory_file'))
+        self.loader = self.context.loader
+        self.inventory = self.context.inventory
+        # variable manager takes care of merging all the different sources to give you a unified view of variables available in each context
+        self.variable_manager = VariableManager(loader=self.loader, inventory=self.inventory)
         self.passwords = dict(vault_pass='secret')
 
         # Instantiate our ResultCallback for handling results as they come in. Ansible expects this to be one of its main display outlets
-        # Move it to run?
         self.results_callback = ResultsCollector(job_name, logger)
 
-        # create inventory, use path to host config file as source or hosts in a comma separated string
-        self.inventory = InventoryManager(loader=self.loader, sources=inventory)
+        self._plays = {}
+        self._tqm = None
 
-        # variable manager takes care of merging all the different sources to give you a unified view of variables available in each context
-        self.variable_manager = VariableManager(loader=self.loader, inventory=self.inventory)
+    def _get_play(self, hosts, tasks):
+        key = (hosts, json.dumps(tasks, sort_keys=True))
+        if key not in self._plays:
+            # create data structure that represents our play, including tasks, this is basically what our YAML loader does internally.
+            play_source =  dict(
+                    name = "Test Playbook",
+                    hosts = hosts,
+                    gather_facts = 'no',
+                    tasks = tasks
+                )
 
-    def run(self, hosts, tasks):
-        # create data structure that represents our play, including tasks, this is basically what our YAML loader does internally.
-        play_source =  dict(
-                name = "Test Playbook",
-                hosts = hosts,
-                gather_facts = 'no',
-                tasks = tasks
-            )
-
-        # Create play object, playbook objects use .load instead of init or new methods,
-        # this will also automatically create the task objects from the info provided in play_source
-        play = Play().load(play_source, variable_manager=self.variable_manager, loader=self.loader)
-
-        # Run it - instantiate task queue manager, which takes care of forking and setting up all objects to iterate over host list and tasks
-        tqm = None
+            # Create play object, playbook objects use .load instead of init or new methods,
+            # this will also automatically create the task objects from the info provided in play_source
+            self._plays[key] = Play().load(play_source, variable_manager=self.variable_manager,
+                                           loader=self.loader)
+        return self._plays[key]
+
+    def _get_tqm(self):
+        if self._tqm is None:
+            with _plugin_lock:
+                # instantiate task queue manager, which takes care of forking and setting up all objects to iterate over host list and tasks
+                self._tqm = TaskQueueManager(
+                        inventory=self.inventory,
+                        variable_manager=self.variable_manager,
+                        loader=self.loader,
+                        passwords=self.passwords,
+                        stdout_callback=self.results_callback,  # Use our custom callback instead of the ``default`` callback plugin, which prints to stdout
+                    )
+                self._tqm.load_callbacks()
+        else:
+            # the TQM remembers failed and unreachable hosts across plays and
+            # would skip them on the next run, every run has to probe all hosts
+            self._tqm.clear_failed_hosts()
+            self._tqm._unreachable_hosts.clear()
+        return self._tqm
+
+    def prepare(self, hosts, tasks):
+        '''
+            Get everything ready for running tasks on hosts later: compile the
+            play, start the task queue manager and open the connections with
+            a ping which also runs the interpreter discovery
+        '''
+        self._get_play(hosts, tasks)
+        self.results_callback.muted = True
         try:
-            tqm = TaskQueueManager(
-                    inventory=self.inventory,
-                    variable_manager=self.variable_manager,
-                    loader=self.loader,
-                    passwords=self.passwords,
-                    stdout_callback=self.results_callback,  # Use our custom callback instead of the ``default`` callback plugin, which prints to stdout
-                )
-            result = tqm.run(play) # most interesting data for a play is actually sent to the callback's methods
+            self.run(hosts, [Task("ping", {}).get_dict()])
         finally:
-            # we always need to cleanup child procs and the structures we use to communicate with them
-            if tqm is not None:
-                tqm.cleanup()
-
-            # Remove ansible tmpdir
-            shutil.rmtree(C.DEFAULT_LOCAL_TMP, True)
-
-class Task():
-    def __init__(self, module_name, module_args, **kwargs):
-        self.module_name = module_name
-        self.module_args = module_args
-        self.kwargs = kwargs
-
-    def get_dict(self):
-        action = dict(action=dict(module=self.module_name, args=self.module_args))
-        action.update(self.kwargs)
-        return action
\ No newline at end of file
+            self.results_callback.muted = False
+
+    def run(self, hosts, tasks):
+        with tracing.span('ansible.run', hosts=hosts):
+            with tracing.span('ansible.setup'):
+                play = self._get_play(hosts, tasks)
+                tqm = self._get_tqm()
+            try:
+                with tracing.span('ansible.execute'):
+                    return tqm.run(play) # most interesting data for a play is actually sent to the callback's methods
+            except Exception:
+                # don't reuse a task queue manager left in an unknown state
+                self._cleanup_tqm()
+                raise
+
+    def _cleanup_tqm(self):
+        # we always need to cleanup child procs and the structures we use to communicate with them
+        if self._tqm is not None:
+            self._tqm.cleanup()
+            self._tqm = None
+
+    def close(self):
+        self._cleanup_tqm()
+
+
+def warm_up(inventory=None):
+    '''
+        Build the execution context of inventory and load the callback
+        plugins, so the first runner of a long lived process starts fast
+    '''
+    runner = AnsibleRunner('warm-up', logging.getLogger(__name__), inventory)
+    runner._get_tqm()
+    runner._cleanup_tqm()
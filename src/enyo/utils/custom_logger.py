@@ -1,11 +1,29 @@
+import os
 import logging
 import sys
 from logging import Logger
 from logging.handlers import TimedRotatingFileHandler
+from threading import Lock
+
+from enyo.config import Config
 
 DEFAULT_LOG_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
 
+
+def log_dir_file(file_name):
+    '''
+        Path of file_name in the log_dir of the config, looked up when the
+        logger writes its first record
+    '''
+    return lambda: os.path.join(Config().get_value('log_dir'), file_name)
+
+
 class CustomLogger(Logger):
+    '''
+        log_file is a path or a function returning it. The handlers are only
+        added when the first record is logged, so creating a logger doesn't
+        need the config or touch the file system.
+    '''
     def __init__(
         self,
         log_file,
@@ -15,18 +33,46 @@ class CustomLogger(Logger):
         **kwargs
     ):
         self.formatter = logging.Formatter(log_format)
-        self.log_file = log_file
+        self._log_file = log_file
+        self.console = console
+        self._handlers_added = False
+        self._handlers_lock = Lock()
 
         Logger.__init__(self, *args, **kwargs)
 
-        # self.addHandler(self.get_console_handler())
-        # if log_file:
-        self.addHandler(self.get_file_handler())
-        if console:
-            self.addHandler(self.get_console_handler())
-
         self.propagate = False
 
+    @property
+    def log_file(self):
+        if callable(self._log_file):
+            return self._log_file()
+        return self._log_file
+
+    def handle(self, record):
+        if not self._handlers_added:
+            self._add_handlers()
+        Logger.handle(self, record)
+
+    def _add_handlers(self):
+        with self._handlers_lock:
+            if self._handlers_added:
+                return
+            self.addHandler(self.get_file_handler())
+            if self.console:
+                self.addHandler(self.get_console_handler())
+            self._handlers_added = True
+
+    def close(self):
+        '''
+            Close the handlers, they are added again if another record is
+            logged
+        '''
+        with self._handlers_lock:
+            for handler in list(self.handlers):
+                self.removeHandler(handler)
+                handler.close()
+            self._handlers_added = False
+
     def get_console_handler(self):
         console_handler = logging.StreamHandler(sys.stdout)
         console_handler.setFormatter(self.formatter)
@@ -35,4 +81,4 @@ class CustomLogger(Logger):
     def get_file_handler(self):
         file_handler = TimedRotatingFileHandler(self.log_file, when="midnight")
         file_handler.setFormatter(self.formatter)
-        return file_handler
\ No newline at end of file
+        return file_handler
@@ -0,0 +1,297 @@
+'''
+    Ansible dynamic inventory access. The inventory is the JSON the inventory
+    script hands to Ansible (groups plus _meta.hostvars). It is built once per
+    run and shared by Ansible and the parts of enyo which talk to the hosts
+    directly.
+
+    The enyo inventory script (inventory/inventory.py) is run in-process and
+    its output cached on disk, keyed by the modification times of the script,
+    the inventory plugins, the inventory config and the deployment map.
+'''
+import os
+import sys
+import glob
+import json
+import hashlib
+import importlib.util
+import subprocess
+import tempfile
+from fnmatch import fnmatch
+from threading import Lock
+
+from enyo.config import Config
+
+config = Config()
+# hosts Ansible knows without an inventory entry, run with the local connection
+IMPLICIT_LOCALHOST = ('localhost', '127.0.0.1', '::1')
+
+
+class Inventory(object):
+    _inventories = {}
+    _lock = Lock()
+
+    def __init__(self, data):
+        self.data = data
+        self.hostvars = data.get('_meta', {}).get('hostvars', {})
+        self.groups = dict((name, group) for name, group in data.items()
+                           if name != '_meta')
+        self._group_hosts = {}
+        self._group_depth = None
+        self._host_groups = None
+        self._host_vars = {}
+
+    @classmethod
+    def get(cls, source=None):
+        '''
+            Inventory for source, loaded only once per process
+        '''
+        source = source or config.get_value('inventory_file')
+        with cls._lock:
+            if source not in cls._inventories:
+                cls._inventories[source] = cls(load_inventory(source))
+            return cls._inventories[source]
+
+    @classmethod
+    def clear(cls):
+        '''
+            Forget the loaded inventories, they are loaded again on next use
+        '''
+        with cls._lock:
+            cls._inventories.clear()
+
+    def _children(self, group):
+        value = self.groups.get(group, {})
+        # a group can also be given as a plain list of hosts
+        if isinstance(value, list):
+            return []
+        return value.get('children', [])
+
+    def _direct_hosts(self, group):
+        value = self.groups.get(group, {})
+        if isinstance(value, list):
+            return value
+        return value.get('hosts', [])
+
+    def group_hosts(self, group):
+        '''
+            All hosts of group including the ones of its child groups
+        '''
+        if group not in self._group_hosts:
+            hosts = []
+            seen_groups = set()
+            pending = [group]
+            while pending:
+                current = pending.pop()
+                if current in seen_groups:
+                    continue
+                seen_groups.add(current)
+                hosts.extend(self._direct_hosts(current))
+                pending.extend(self._children(current))
+            self._group_hosts[group] = list(dict.fromkeys(hosts))
+        return self._group_hosts[group]
+
+    def all_hosts(self):
+        hosts = list(self.hostvars)
+        for group in self.groups:
+            hosts.extend(self._direct_hosts(group))
+        return list(dict.fromkeys(hosts))
+
+    def _match(self, pattern):
+        if pattern in ('all', '*'):
+            return self.all_hosts()
+        if pattern in self.groups:
+            return self.group_hosts(pattern)
+        if pattern in self.hostvars:
+            return [pattern]
+        matched = []
+        for group in self.groups:
+            if fnmatch(group, pattern):
+                matched.extend(self.group_hosts(group))
+        matched.extend(host for host in self.all_hosts() if fnmatch(host, pattern))
+        if not matched and pattern in IMPLICIT_LOCALHOST:
+            return [pattern]
+        return list(dict.fromkeys(matched))
+
+    def resolve(self, pattern):
+        '''
+            Hosts matching an Ansible host pattern. Supports unions with ':'
+            or ',', intersections with '&', exclusions with '!' and
+            wildcards.
+        '''
+        hosts = []
+        intersections = []
+        exclusions = set()
+        for part in pattern.replace(',', ':').split(':'):
+            part = part.strip()
+            if not part:
+                continue
+            if part.startswith('!'):
+                exclusions.update(self._match(part[1:]))
+            elif part.startswith('&'):
+                intersections.append(set(self._match(part[1:])))
+            else:
+                hosts.extend(self._match(part))
+
+        hosts = list(dict.fromkeys(hosts))
+        for intersection in intersections:
+            hosts = [host for host in hosts if host in intersection]
+        return [host for host in hosts if host not in exclusions]
+
+    def _depths(self):
+        '''
+            Depth of every group in the group hierarchy
+        '''
+        if self._group_depth is None:
+            children = set()
+            for group in self.groups:
+                children.update(self._children(group))
+            pending = [(group, 0 if group == 'all' else 1) for group in self.groups
+                       if group not in children]
+            depth = {}
+            while pending:
+                group, level = pending.pop()
+                if depth.get(group, -1) >= level:
+                    continue
+                depth[group] = level
+                pending.extend((child, level + 1) for child in self._children(group))
+            self._group_depth = depth
+        return self._group_depth
+
+    def host_groups(self, host):
+        '''
+            Groups of host ordered from the least to the most specific one
+        '''
+        if self._host_groups is None:
+            depth = self._depths()
+            host_groups = {}
+            for group in sorted(depth, key=lambda group: (depth[group], group)):
+                for member in self.group_hosts(group):
+                    host_groups.setdefault(member, []).append(group)
+            self._host_groups = host_groups
+        return self._host_groups.get(host, [])
+
+    def host_vars(self, host):
+        '''
+            Variables of host merged the way Ansible does: group variables
+            from the least to the most specific group, host variables last.
+            The implicit localhost uses the local connection and the Python
+            running enyo.
+        '''
+        if host not in self._host_vars:
+            variables = {}
+            if host in IMPLICIT_LOCALHOST and host not in self.all_hosts():
+                variables.update(ansible_connection='local',
+                                 ansible_python_interpreter=sys.executable)
+            for group in self.host_groups(host):
+                value = self.groups[group]
+                if isinstance(value, dict):
+                    variables.update(value.get('vars', {}))
+            variables.update(self.hostvars.get(host, {}))
+            variables.setdefault('inventory_hostname', host)
+            self._host_vars[host] = variables
+        return self._host_vars[host]
+
+
+def _load_script(source):
+    '''
+        The enyo inventory script as a module, None for any other script
+    '''
+    with open(source, 'r') as f:
+        if 'ENYO_INVENTORY_CONFIG' not in f.read():
+            return None
+    # the script imports its plugins from its own directory
+    script_dir = os.path.dirname(os.path.abspath(source))
+    if script_dir not in sys.path:
+        sys.path.insert(0, script_dir)
+    spec = importlib.util.spec_from_file_location('enyo_inventory_script', source)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _input_files(source, module):
+    '''
+        All the files the inventory built by the script depends on
+    '''
+    script_dir = os.path.dirname(os.path.abspath(source))
+    files = sorted(glob.glob(os.path.join(script_dir, '*.py')))
+    files.append(module.ENYO_INVENTORY_CONFIG)
+    with open(module.ENYO_INVENTORY_CONFIG, 'r') as f:
+        inventory_config = json.load(f)
+    deployment = inventory_config.get('openstack_deployment', {})
+    if 'deployment_map' in deployment:
+        files.append(deployment['deployment_map'])
+    return files
+
+
+def _cache_file(files):
+    digest = hashlib.sha1()
+    for file in files:
+        stat = os.stat(file)
+        digest.update(('%s:%d:%d;' % (os.path.abspath(file), stat.st_mtime_ns, stat.st_size)).encode())
+    cache_dir = config.get_value('inventory_cache_dir') or \
+        os.path.join(config.get_value('log_dir'), 'inventory-cache')
+    return os.path.join(cache_dir, digest.hexdigest() + '.json')
+
+
+def _write_cache(cache_file, inventory_json):
+    cache_dir = os.path.dirname(cache_file)
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    # write to a temporary file first so readers never see a partial cache
+    fd, tmp_file = tempfile.mkstemp(dir=cache_dir)
+    with os.fdopen(fd, 'w') as f:
+        f.write(inventory_json)
+    os.replace(tmp_file, cache_file)
+
+
+def load_inventory(source):
+    '''
+        Load the inventory JSON from a JSON file, from the cache of the enyo
+        inventory script or by running the dynamic inventory script with --list
+    '''
+    if source.endswith('.json'):
+        with open(source, 'r') as f:
+            return json.load(f)
+
+    module = _load_script(source)
+    if module is None:
+        output = subprocess.check_output([source, '--list'])
+        return json.loads(output)
+
+    cache_file = _cache_file(_input_files(source, module))
+    if os.path.exists(cache_file):
+        with open(cache_file, 'r') as f:
+            return json.load(f)
+
+    inventory_json = module.main([source, '--list'])
+    _write_cache(cache_file, inventory_json)
+    return json.loads(inventory_json)
+
+
+def populate(inventory_data, data):
+    '''
+        Fill Ansible's InventoryData from the inventory JSON, the same way
+        Ansible's script inventory plugin does
+    '''
+    hosts = set()
+    for group, value in data.items():
+        if group == '_meta':
+            continue
+        group = inventory_data.add_group(group)
+        if not isinstance(value, dict):
+            value = dict(hosts=value)
+        for host in value.get('hosts', []):
+            hosts.add(host)
+            inventory_data.add_host(host, group)
+        for var, val in value.get('vars', {}).items():
+            inventory_data.set_variable(group, var, val)
+        for child in value.get('children', []):
+            child = inventory_data.add_group(child)
+            inventory_data.add_child(group, child)
+
+    hostvars = data.get('_meta', {}).get('hostvars', {})
+    for host in hosts:
+        for var, val in hostvars.get(host, {}).items():
+            inventory_data.set_variable(host, var, val)
+    inventory_data.reconcile_inventory()
@@ -0,0 +1,121 @@
+'''
+    Follows a growing log file and hands every new line to a callback.
+    Changes are waited for with inotify where the platform has it, other
+    platforms poll the file.
+'''
+import ctypes
+import os
+import select
+from threading import Thread, Event
+
+POLL_INTERVAL = 0.5
+# inotify(7)
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+
+class PollingWatcher(object):
+
+    def __init__(self, path):
+        self.path = path
+
+    def wait(self, timeout):
+        '''
+            Sleep timeout seconds, the file is read again anyway
+        '''
+        select.select([], [], [], timeout)
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(object):
+    '''
+        Waits for changes of a file with inotify through libc
+    '''
+
+    def __init__(self, path):
+        libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        mask = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_DELETE_SELF | IN_MOVE_SELF
+        if libc.inotify_add_watch(self.fd, os.fsencode(path), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, 'inotify_add_watch failed for %s' % path)
+
+    def wait(self, timeout):
+        '''
+            Block until the file changes or timeout seconds passed
+        '''
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if readable:
+            try:
+                # only the wakeup matters, the events themselves are dropped
+                while os.read(self.fd, 4096):
+                    pass
+            except BlockingIOError:
+                pass
+
+    def close(self):
+        os.close(self.fd)
+
+
+def create_watcher(path):
+    try:
+        return InotifyWatcher(path)
+    except (OSError, AttributeError):
+        return PollingWatcher(path)
+
+
+class LogTailer(Thread):
+    '''
+        Reads path from offset on and calls on_line with every complete
+        line, without the line break. A file truncated or replaced by a
+        smaller one is read again from its start. After stop() the lines
+        written until then are still delivered before the thread ends.
+    '''
+
+    def __init__(self, path, on_line, offset=0, poll_interval=POLL_INTERVAL):
+        Thread.__init__(self, name='tail-' + os.path.basename(path), daemon=True)
+        self.path = path
+        self.on_line = on_line
+        self.offset = offset
+        self.poll_interval = poll_interval
+        self.stopped = Event()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        watcher = create_watcher(self.path)
+        try:
+            with open(self.path, 'rb') as f:
+                f.seek(self.offset)
+                self._follow(f, watcher)
+        finally:
+            watcher.close()
+
+    def _follow(self, f, watcher):
+        partial = b''
+        while True:
+            stopping = self.stopped.is_set()
+            if os.fstat(f.fileno()).st_size < f.tell():
+                f.seek(0)
+                partial = b''
+            data = f.read()
+            if data:
+                lines = (partial + data).split(b'\n')
+                partial = lines.pop()
+                for line in lines:
+                    self.on_line(line.rstrip(b'\r').decode('utf-8', 'replace'))
+            if stopping:
+                return
+            if not data:
+                watcher.wait(self.poll_interval)
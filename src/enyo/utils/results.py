@@ -0,0 +1,149 @@
+'''
+    Result records written by the monitors and the injectors. All the
+    execution backends build their records here so the reporters always
+    get the same format.
+
+    Records are written as compact JSON, one record per line, with the time
+    as a float epoch timestamp. Logs written by older versions (indented
+    records and formatted time strings) can still be read, or converted
+    with
+
+        python -m enyo.utils.results <old log> <new log>
+'''
+import argparse
+import json
+import time
+from datetime import datetime
+
+from enyo.utils import tracing
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+LEGACY_TIME_FORMATS = (TIME_FORMAT, '%Y-%m-%d %H:%M:%S')
+
+
+def now():
+    return time.time()
+
+
+def to_epoch(value):
+    '''
+        Epoch timestamp of a record time, which is either already a number
+        or a string formatted like Ansible's module end time
+    '''
+    if isinstance(value, (int, float)):
+        return float(value)
+    for time_format in LEGACY_TIME_FORMATS:
+        try:
+            return datetime.strptime(value, time_format).timestamp()
+        except ValueError:
+            continue
+    raise ValueError('Unknown time format: %s' % value)
+
+
+def ok_record(job_name, time, host, command, return_code, output):
+    return {
+             'job_name': job_name,
+             'time': time,
+             'host': host,
+             'command': command,
+             'return_code': return_code,
+             'output': output,
+             'success': True
+           }
+
+
+def failed_record(job_name, time, host, command, return_code, output, error):
+    return {
+             'job_name': job_name,
+             'time': time,
+             'host': host,
+             'command': command,
+             'return_code': return_code,
+             'output': output,
+             'error': error,
+             'success': False
+           }
+
+
+def unreachable_record(job_name, time, host, error):
+    return {
+             'job_name': job_name,
+             'time': time,
+             'host': host,
+             'output': 'Host unreachable',
+             'error': error,
+             'success': False
+           }
+
+
+# called with every record written, replaced instead of changed in place
+# so writers can iterate it without a lock
+_listeners = ()
+
+
+def add_listener(listener):
+    '''
+        Call listener with every record written from now on, e.g. to follow
+        the monitors while they run
+    '''
+    global _listeners
+    _listeners = _listeners + (listener,)
+
+
+def remove_listener(listener):
+    global _listeners
+    # bound methods are equal, not identical, on every access
+    _listeners = tuple(other for other in _listeners if other != listener)
+
+
+def write_record(logger, record):
+    with tracing.span('write_record', job=record.get('job_name')):
+        logger.info(json.dumps(record, separators=(',', ':')))
+    for listener in _listeners:
+        listener(record)
+
+
+def read_records(file):
+    '''
+        Iterate over the records of a monitor log without loading the whole
+        file. Handles both one record per line and the old indented format.
+    '''
+    with open(file, 'r') as f:
+        buffer = []
+        for line in f:
+            if not buffer:
+                stripped = line.strip()
+                if not stripped:
+                    continue
+                if stripped.startswith('{') and stripped.endswith('}'):
+                    yield json.loads(stripped)
+                    continue
+            buffer.append(line)
+            # indented records close with a brace in the first column
+            if line.rstrip('\r\n') == '}':
+                yield json.loads(''.join(buffer))
+                buffer = []
+        if buffer and ''.join(buffer).strip():
+            raise ValueError('Truncated record at the end of %s' % file)
+
+
+def convert(source, destination):
+    '''
+        Rewrite a monitor log in the compact format
+    '''
+    count = 0
+    with open(destination, 'w') as f:
+        for record in read_records(source):
+            record['time'] = to_epoch(record['time'])
+            f.write(json.dumps(record, separators=(',', ':')))
+            f.write('\n')
+            count += 1
+    return count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert monitor logs to the compact format")
+    parser.add_argument('source', help="Monitor log to convert")
+    parser.add_argument('destination', help="Converted monitor log")
+    args = parser.parse_args()
+    print("Converted %s records" % convert(args.source, args.destination))
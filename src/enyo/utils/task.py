@@ -0,0 +1,13 @@
+class Task():
+    '''
+        A task of a play, as the dictionary the Ansible API loads
+    '''
+    def __init__(self, module_name, module_args, **kwargs):
+        self.module_name = module_name
+        self.module_args = module_args
+        self.kwargs = kwargs
+
+    def get_dict(self):
+        action = dict(action=dict(module=self.module_name, args=self.module_args))
+        action.update(self.kwargs)
+        return action
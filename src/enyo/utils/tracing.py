@@ -0,0 +1,200 @@
+'''
+    Spans timing the phases of a run, exported as a Chrome trace which
+    chrome://tracing or https://ui.perfetto.dev show as a timeline with one
+    row per thread.
+
+        with tracing.span('report.recovery', monitor=name):
+            ...
+
+    While tracing is off span() returns the same do nothing context, so
+    spans can stay in the hot paths. Spans whose name matches one of the
+    profile patterns are also run under cProfile and tracemalloc, the
+    profile is written next to the trace and the memory peak and the top
+    allocations are added to the span.
+'''
+import os
+import json
+import time
+import cProfile
+import threading
+import tracemalloc
+from fnmatch import fnmatch
+
+# allocation sites reported for a profiled span
+TOP_ALLOCATIONS = 10
+
+
+class _NullSpan(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def set(self, **args):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Span(object):
+
+    def __init__(self, tracer, name, category, args):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+        self.started = None
+        self.profiler = None
+
+    def set(self, **args):
+        '''
+            Add arguments to the span, e.g. results only known at its end
+        '''
+        self.args.update(args)
+
+    def __enter__(self):
+        if self.tracer.should_profile(self.name):
+            self.profiler = self.tracer.start_profile(self)
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        finished = time.perf_counter()
+        if self.profiler is not None:
+            self.tracer.stop_profile(self, self.profiler)
+        if exc_type is not None:
+            self.args['error'] = '%s: %s' % (exc_type.__name__, exc_value)
+        self.tracer.add_span(self, finished)
+        return False
+
+
+class Tracer(object):
+    '''
+        Collects the spans of a run. output is the trace file, profiles are
+        written next to it.
+    '''
+
+    def __init__(self, output, profile=()):
+        self.output = output
+        self.profile = list(profile)
+        self.events = []
+        self.started = time.perf_counter()
+        self.started_at = time.time()
+        self.pid = os.getpid()
+        self._threads = {}
+        self._profiles = 0
+        self._profile_lock = threading.Lock()
+        self._profiling = False
+        directory = os.path.dirname(output)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def _timestamp(self, counter):
+        # Chrome traces count microseconds
+        return (counter - self.started) * 1e6
+
+    def _thread_id(self):
+        thread = threading.current_thread()
+        if thread.ident not in self._threads:
+            self._threads[thread.ident] = thread.name
+        return thread.ident
+
+    def add_span(self, span, finished):
+        self.events.append(dict(name=span.name, cat=span.category, ph='X', pid=self.pid,
+                                tid=self._thread_id(), ts=self._timestamp(span.started),
+                                dur=(finished - span.started) * 1e6, args=span.args))
+
+    def should_profile(self, name):
+        return any(fnmatch(name, pattern) for pattern in self.profile)
+
+    def start_profile(self, span):
+        '''
+            cProfile and tracemalloc only profile one span at a time, nested
+            and concurrent profiled spans are only timed
+        '''
+        with self._profile_lock:
+            if self._profiling:
+                return None
+            self._profiling = True
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # another profiler is active in the process
+            with self._profile_lock:
+                self._profiling = False
+            return None
+        started_tracemalloc = not tracemalloc.is_tracing()
+        if started_tracemalloc:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        return profiler, started_tracemalloc
+
+    def stop_profile(self, span, profile):
+        profiler, started_tracemalloc = profile
+        profiler.disable()
+        _, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot()
+        if started_tracemalloc:
+            tracemalloc.stop()
+
+        base = os.path.splitext(self.output)[0]
+        with self._profile_lock:
+            self._profiles += 1
+            profile_file = '%s.%s.%d.prof' % (base, span.name, self._profiles)
+            self._profiling = False
+        profiler.dump_stats(profile_file)
+        top = snapshot.statistics('lineno')[:TOP_ALLOCATIONS]
+        span.set(profile=profile_file, memory_peak=peak,
+                 allocations=['%s: %d bytes' % (statistic.traceback, statistic.size)
+                              for statistic in top])
+
+    def get_dict(self):
+        metadata = [dict(name='thread_name', ph='M', pid=self.pid, tid=ident, args=dict(name=name))
+                    for ident, name in list(self._threads.items())]
+        return dict(traceEvents=metadata + list(self.events), displayTimeUnit='ms',
+                    otherData=dict(started=self.started_at))
+
+    def save(self):
+        with open(self.output, 'w') as f:
+            json.dump(self.get_dict(), f)
+
+
+_tracer = None
+
+
+def start(output, profile=()):
+    '''
+        Start tracing, the trace is written to output by stop(). profile
+        are name patterns of the spans to profile.
+    '''
+    global _tracer
+    _tracer = Tracer(output, profile)
+    return _tracer
+
+
+def stop():
+    '''
+        Stop tracing and write the trace, returns the tracer
+    '''
+    global _tracer
+    tracer = _tracer
+    _tracer = None
+    if tracer is not None:
+        tracer.save()
+    return tracer
+
+
+def enabled():
+    return _tracer is not None
+
+
+def span(name, category='enyo', **args):
+    tracer = _tracer
+    if tracer is None:
+        return _NULL_SPAN
+    return Span(tracer, name, category, args)
+
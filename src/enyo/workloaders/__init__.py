@@ -1,4 +1,8 @@
 import abc
+import time
+
+# task statuses after which a task won't reach running anymore
+FINAL_STATUSES = ("failed", "crashed", "aborted", "finished")
 
 class BaseLoader(object):
 
@@ -13,3 +17,19 @@ class BaseLoader(object):
     @abc.abstractmethod
     def status(self):
         pass
+
+    def wait_for_running(self, timeout):
+        '''
+            Wait until the task is running, at most timeout seconds. Returns
+            the last task status, loaders which can be notified of status
+            changes override this instead of polling.
+        '''
+        deadline = time.monotonic() + timeout
+        status = self.task_status()
+        while status != "running" and status not in FINAL_STATUSES:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            time.sleep(min(1, remaining))
+            status = self.task_status()
+        return status
@@ -1,5 +1,6 @@
 import os
-from threading import Thread
+import copy
+from threading import Thread, Lock
 import logging
 import sys
 
@@ -7,40 +8,123 @@ from rally.cli.commands.task import TaskCommands
 from rally.plugins import load as load_plugins
 from rally.api import API
 from rally.cli.commands.deployment import DeploymentCommands
-from rally.plugins import load as load_plugins
 from rally.exceptions import DBRecordNotFound
+from rally.common import cfg
 
 from enyo.config import Config
 from . import BaseLoader
-from enyo.utils.custom_logger import CustomLogger, DEFAULT_LOG_FORMAT
+from enyo.utils.custom_logger import CustomLogger, DEFAULT_LOG_FORMAT, log_dir_file
 from enyo.reporters.rally import RallyReporter
+from enyo.workloaders.rally_stream import IterationStream
+from enyo.utils import tracing
 
 
 config = Config()
-LOG_FILE = os.path.join(config.get_value('log_dir'), 'loader-rally.log')
-logger = CustomLogger(LOG_FILE, name=__name__)
+logger = CustomLogger(log_dir_file('loader-rally.log'), name=__name__)
+
+# iterations after which Rally writes the raw results to its database
+CHUNK_SIZE = 10
+
+
+def _file_stamp(file):
+    if file is None:
+        return None
+    stat = os.stat(file)
+    return (os.path.abspath(file), stat.st_mtime_ns, stat.st_size)
+
+
+def _modify_logger():
+    '''
+        Modify rally library logger to our requirments
+    '''
+    rally_logger = logging.getLogger("rally")
+    console_handler = logging.StreamHandler(sys.stdout)
+    rally_logger.removeHandler(console_handler)
+    file_handler = logging.FileHandler(os.path.join(config.get_value('log_dir'), 'rally/task.log'))
+    formatter  = logging.Formatter(DEFAULT_LOG_FORMAT)
+    file_handler.setFormatter(formatter)
+    rally_logger.addHandler(file_handler)
+    rally_logger.propagate = False
+
+
+class RallyContext():
+    '''
+        Rally API, plugins and the deployments and task files already
+        checked, shared by every Rally loader of the process. A long lived
+        process, like the daemon, only loads the plugins once and validates
+        a task file again only when it changed.
+    '''
+    _context = None
+    _lock = Lock()
+
+    def __init__(self):
+        self.api = API()
+        self.task_commands = TaskCommands()
+        _modify_logger()
+        load_plugins()
+        self._deployments = set()
+        self._tasks = {}
+
+    @classmethod
+    def get(cls):
+        with cls._lock:
+            if cls._context is None:
+                cls._context = cls()
+            return cls._context
+
+    def use_deployment(self, name):
+        '''
+            Create the deployment from the environment unless it exists
+        '''
+        if name in self._deployments:
+            return
+        try:
+            self.api.deployment.get(name)
+        except DBRecordNotFound:
+            DeploymentCommands().create(self.api, name, fromenv=True)
+        self._deployments.add(name)
+
+    def forget_deployment(self, name):
+        self._deployments.discard(name)
 
-RALLY_LOG_FILE = os.path.join(config.get_value('log_dir'), 'rally/task.log')
+    def forget_deployments(self):
+        self._deployments.clear()
+
+    def load_task(self, task_file, task_args=None, task_args_file=None):
+        '''
+            The validated task config of task_file, kept until the task file
+            or the arguments file change
+        '''
+        key = (_file_stamp(task_file), task_args, _file_stamp(task_args_file))
+        if key not in self._tasks:
+            self._tasks[key] = self.task_commands._load_and_validate_task(
+                self.api, task_file, raw_args=task_args, args_file=task_args_file)
+        # Rally may change the config it runs
+        return copy.deepcopy(self._tasks[key])
 
 
 class Rally(BaseLoader):
 
     def __init__(self, task_file, deployment=None, task_args=None, task_args_file=None, config_file=None):
-        self.rally_api = API()
-        self._modify_logger()
-        self.task = TaskCommands()
+        with tracing.span('rally.context'):
+            self.context = RallyContext.get()
+        self.rally_api = self.context.api
+        self.task = self.context.task_commands
         self.task_init_timeout = 200
         self.deployment_name = deployment
         self.task_file = task_file
 
         self.task_thread = Thread(target=self.run)
 
-        self.create_or_use_deployment()
-        self.input_task = self.task._load_and_validate_task(self.rally_api, self.task_file,
-                                                            raw_args=task_args,
-                                                            args_file=task_args_file)
-        self.task_instance = self.rally_api.task.create(deployment=self.deployment_name)
+        with tracing.span('rally.deployment', deployment=self.deployment_name):
+            self.create_or_use_deployment()
+        with tracing.span('rally.load_task', task_file=self.task_file):
+            self.input_task = self.context.load_task(self.task_file, task_args, task_args_file)
+        with tracing.span('rally.create_task'):
+            self.task_instance = self.rally_api.task.create(deployment=self.deployment_name)
         self.task_id = self.task_instance["uuid"]
+        self._set_chunk_size()
+        self.stream = IterationStream(self.task_id)
 
     def validate(self):
         print(self.task.validate(self.rally_api, self.task_file, self.deployment_name))
@@ -48,6 +132,7 @@ class Rally(BaseLoader):
     def start(self):
         logger.info("Starting thread for rally task")
         self.task_thread.start()
+        self.stream.start()
 
     def run(self):
         self.rally_api.task.start(deployment=self.deployment_name, config=self.input_task,
@@ -67,39 +152,39 @@ class Rally(BaseLoader):
     def wait_to_finish(self):
         logger.info("Waiting for rally thread to join")
         self.task_thread.join()
+        self.stream.stop()
+        self.stream.join()
         logger.info("Finished rally thread")
 
-    def generate_report(self, output_file):
+    def generate_report(self, output_file, injection_times=None):
         logger.info("Generating report")
         output_html = output_file + ".html"
         output_json = output_file + ".json"
-        self.task.report(self.rally_api, self.task_id, out=output_html, out_format="html")
-        self.task.report(self.rally_api, self.task_id, out=output_json, out_format="json")
+        with tracing.span('rally.export'):
+            self.task.report(self.rally_api, self.task_id, out=output_html, out_format="html")
+            self.task.report(self.rally_api, self.task_id, out=output_json, out_format="json")
 
-        report = RallyReporter(output_json)
-        report.generate_report()
+        report = RallyReporter(output_json, injection_times)
+        with tracing.span('report.rally'):
+            report.generate_report()
         logger.info("Report generated")
 
-    def create_or_use_deployment(self):
-        load_plugins()
-
+    def _set_chunk_size(self):
+        '''
+            Rally only writes the results of a workload to its database every
+            raw_result_chunk_size iterations, 1000 by default, a small chunk
+            size lets the stream see them while the task runs
+        '''
+        chunk_size = config.get_value('rally_chunk_size') or CHUNK_SIZE
         try:
-            self.rally_api.deployment.get(self.deployment_name)
-        except DBRecordNotFound:
-            return DeploymentCommands().create(self.rally_api, self.deployment_name, fromenv=True)
+            cfg.CONF.set_override('raw_result_chunk_size', chunk_size)
+        except cfg.NoSuchOptError:
+            logger.warning("Rally has no raw_result_chunk_size option, iterations are only "
+                           "streamed once Rally writes them")
+
+    def create_or_use_deployment(self):
+        self.context.use_deployment(self.deployment_name)
 
     def destroy_deployment(self):
         self.rally_api.deployment.destroy(self.deployment_name)
-
-    def _modify_logger(self):
-        '''
-            Modify rally library logger to our requirments
-        '''
-        rally_logger = logging.getLogger("rally")
-        console_handler = logging.StreamHandler(sys.stdout)
-        rally_logger.removeHandler(console_handler)
-        file_handler = logging.FileHandler(RALLY_LOG_FILE)
-        formatter  = logging.Formatter(DEFAULT_LOG_FORMAT)
-        file_handler.setFormatter(formatter)
-        rally_logger.addHandler(file_handler)
-        rally_logger.propagate = False
+        self.context.forget_deployment(self.deployment_name)
@@ -0,0 +1,134 @@
+'''
+    Streams the iterations of a running Rally task from the Rally database.
+    Rally stores the raw results of a workload in chunks in the workloaddata
+    table while the task runs; every poll reads only the chunks added since
+    the previous one.
+'''
+import json
+import os
+from collections import deque
+from threading import Thread, Event, Lock
+
+import sqlalchemy
+from rally.common import cfg
+
+from enyo.config import Config
+from enyo.utils import results
+from enyo.utils.custom_logger import CustomLogger, log_dir_file
+
+config = Config()
+logger = CustomLogger(log_dir_file('loader-rally.log'), name=__name__)
+POLL_INTERVAL = 5
+BUFFER_SIZE = 10000
+
+NEW_CHUNKS = sqlalchemy.text(
+    'SELECT workloaddata.id, workloads.name, workloads.position, workloaddata.chunk_data '
+    'FROM workloaddata JOIN workloads ON workloads.uuid = workloaddata.workload_uuid '
+    'WHERE workloaddata.task_uuid = :task_uuid AND workloaddata.id > :last_id '
+    'ORDER BY workloaddata.id')
+
+
+def iteration_record(task_id, workload, position, iteration):
+    error = iteration.get('error') or []
+    return {
+             'task': task_id,
+             'workload': workload,
+             'position': position,
+             'timestamp': iteration['timestamp'],
+             'duration': iteration['duration'],
+             'error': len(error) != 0,
+             'error_type': error[0] if error else None
+           }
+
+
+class IterationStream(Thread):
+    '''
+        Polls the Rally database for the iterations a task finished since
+        the last poll. They are kept in a bounded buffer for a live view of
+        the workload and written to the rally-iterations.json sink.
+    '''
+
+    def __init__(self, task_id, poll_interval=None, buffer_size=None):
+        Thread.__init__(self, name='rally-stream', daemon=True)
+        self.task_id = task_id
+        self.poll_interval = poll_interval or config.get_value('rally_poll_interval') or POLL_INTERVAL
+        self.iterations = deque(maxlen=buffer_size or config.get_value('rally_stream_buffer')
+                                or BUFFER_SIZE)
+        self.sink = CustomLogger(log_dir_file('rally-iterations.json'), log_format='%(message)s', name='rally-iterations')
+        self.engine = sqlalchemy.create_engine(cfg.CONF.database.connection)
+        self.last_id = 0
+        self.stopped = Event()
+        self._lock = Lock()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        try:
+            while not self.stopped.wait(self.poll_interval):
+                self._poll_logged()
+            # the chunks written when the task finished
+            self._poll_logged()
+        finally:
+            self.engine.dispose()
+            # a daemon runs many tasks, don't keep the sink of every one open
+            self.sink.close()
+
+    def _poll_logged(self):
+        try:
+            self.poll()
+        except Exception as exception:
+            logger.error("Failed to read rally iterations: %s", exception)
+
+    def poll(self):
+        '''
+            Read the chunks added since the last poll, returns the new
+            iteration records
+        '''
+        with self.engine.connect() as connection:
+            rows = connection.execute(NEW_CHUNKS, dict(task_uuid=self.task_id,
+                                                       last_id=self.last_id)).fetchall()
+        records = []
+        for chunk_id, workload, position, chunk_data in rows:
+            if isinstance(chunk_data, (str, bytes)):
+                chunk_data = json.loads(chunk_data)
+            for iteration in chunk_data.get('raw', []):
+                records.append(iteration_record(self.task_id, workload, position, iteration))
+            self.last_id = chunk_id
+
+        records.sort(key=lambda record: record['timestamp'])
+        with self._lock:
+            self.iterations.extend(records)
+        for record in records:
+            results.write_record(self.sink, record)
+        if records:
+            errors = sum(record['error'] for record in records)
+            logger.info("%s new iterations, mean duration %.3f seconds, %s errors",
+                        len(records), sum(record['duration'] for record in records) / len(records),
+                        errors)
+        return records
+
+    def get_iterations(self, start=None, end=None):
+        '''
+            Buffered iterations which started between start and end (epoch)
+        '''
+        with self._lock:
+            iterations = list(self.iterations)
+        return [record for record in iterations
+                if (start is None or record['timestamp'] >= start)
+                and (end is None or record['timestamp'] < end)]
+
+    def get_stats(self, start=None, end=None):
+        '''
+            Iteration count, mean duration and error rate of the buffered
+            iterations which started between start and end
+        '''
+        iterations = self.get_iterations(start, end)
+        if len(iterations) == 0:
+            return dict(iterations=0)
+        errors = sum(record['error'] for record in iterations)
+        return dict(iterations=len(iterations),
+                    mean_duration=sum(record['duration'] for record in iterations) / len(iterations),
+                    max_duration=max(record['duration'] for record in iterations),
+                    errors=errors,
+                    error_rate=errors / len(iterations))
@@ -1,35 +1,104 @@
+import os
 import subprocess
-import time
+from threading import Thread, Condition
 
+from enyo.config import Config
 from . import BaseLoader
+from enyo.utils.custom_logger import CustomLogger, log_dir_file
+from enyo.utils.log_tailer import LogTailer
+from enyo.utils import tracing
+from enyo.reporters.shaker import ShakerReporter
+
+config = Config()
+logger = CustomLogger(log_dir_file('loader-shaker.log'), name=__name__)
+
+# Currently there is no shaker API which can return status of the task so
+# its log is followed for the line telling the task initialization is
+# completed and the actual workload is ready to run
+TASK_INIT_FINISHED = "Finished processing operation: <shaker.engine.quorum.JoinOperation"
+TASK_ERROR = "ERROR"
+
 
-#TODO Add logger
 class Shaker(BaseLoader):
 
     def __init__(self, server_endpoint, scenario_file, report_file, log_file):
         self.server_endpoint = server_endpoint
         self.scenario_file = scenario_file
         self.report_file = report_file
+        # raw results next to the HTML report, read by the ShakerReporter
+        self.output_file = os.path.splitext(report_file)[0] + '.json'
         self.task_init_timeout = 900
         self._deployment_status = False
         self.shaker_task = None
         self.log_file = log_file
-        self.logger = open(log_file, 'a')
+        self.tailer = None
+        self.task_thread = Thread(target=self.run)
+        self._status = "initializing"
+        self._status_changed = Condition()
 
 
     def start(self):
         self._deployment_status = True
         shaker_cmd = ['shaker', '--server-endpoint', self.server_endpoint,
-                      '--scenario', self.scenario_file, '--report', self.report_file]
-        self.shaker_task = subprocess.Popen(shaker_cmd, stdout=self.logger, stderr=self.logger)
+                      '--scenario', self.scenario_file, '--report', self.report_file,
+                      '--output', self.output_file]
+        with open(self.log_file, 'a') as log:
+            # only the output of this run counts, the log may hold older runs
+            self.tailer = LogTailer(self.log_file, self._parse_line, offset=log.tell())
+            self.shaker_task = subprocess.Popen(shaker_cmd, stdout=log, stderr=log)
+        self.tailer.start()
+        self.task_thread.start()
+
+
+    def run(self):
+        return_code = self.shaker_task.wait()
+        self.tailer.stop()
+        self.tailer.join()
+        logger.info("Shaker exited with %s", return_code)
+        if return_code == 0:
+            self._set_status("finished")
+        else:
+            self._set_status("failed")
+
+
+    def _parse_line(self, line):
+        if self._status != "initializing":
+            return
+        if TASK_INIT_FINISHED in line:
+            self._set_status("running")
+        elif TASK_ERROR in line:
+            logger.error("Shaker task failed: %s", line)
+            self._set_status("failed")
+
+
+    def _set_status(self, status):
+        with self._status_changed:
+            if self._status != status and self._status != "failed":
+                logger.info("Shaker task status: %s", status)
+                self._status = status
+            self._status_changed.notify_all()
+
+
+    def wait_for_running(self, timeout):
+        with self._status_changed:
+            self._status_changed.wait_for(lambda: self._status != "initializing", timeout)
+            return self._status
 
 
     def wait_to_finish(self):
-        self.shaker_task.wait()
+        self.task_thread.join()
 
 
-    def generate_report(self, output_file):
-        pass
+    def generate_report(self, output_file, injection_times=None):
+        '''
+            output_file: the HTML report, which Shaker writes itself
+            injection_times: name and epoch time of every injection
+        '''
+        logger.info("Generating report")
+        report = ShakerReporter(self.output_file, injection_times)
+        with tracing.span('report.shaker'):
+            report.generate_report()
+        logger.info("Report generated")
 
 
     def stop(self):
@@ -40,31 +109,9 @@ class Shaker(BaseLoader):
         return self._deployment_status
 
 
-    def _follow_file(self, filename):
-        filename.seek(0,2)
-        while True:
-            line = filename.readline()
-            yield line
-
     def task_status(self):
-        '''
-            Currently there is no shaker API which can return status of the task
-            so checking the log file for specific string to know if the task
-            initialization is completed and actual workload is ready to run
-        '''
-        task_init_finished = "Finished processing operation: <shaker.engine.quorum.JoinOperation"
-        logfile = open(self.log_file,"r")
-        loglines = self._follow_file(logfile)
-        for line in loglines:
-            if not line:
-                time.sleep(0.1)
-                continue
-            elif(task_init_finished in line):
-                return "running"
-            elif("ERROR" in line):
-                return "failed"
+        return self._status
 
 
     def status(self):
         return self.shaker_task.poll()
-
@@ -0,0 +1,230 @@
+'''
+    Incremental and full syncs of the cache shards of the OpenStack
+    inventory script and the concurrent listing of all clouds, against a
+    stubbed openstacksdk. Runs without OpenStack or openstacksdk:
+
+    python tests/test_openstack_inventory.py
+'''
+import os
+import sys
+import time
+import types
+import shutil
+import tempfile
+import unittest
+import importlib.util
+from unittest import mock
+from datetime import datetime
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'inventory',
+                      'openstack_inventory.py')
+
+
+class OpenStackCloudException(Exception):
+    pass
+
+
+def add_server_interfaces(cloud, server):
+    server = dict(server)
+    server['interface_ip'] = server.get('address')
+    return server
+
+
+def get_hostvars_from_server(cloud, server):
+    server = add_server_interfaces(cloud, server)
+    server['expanded'] = True
+    return server
+
+
+def stub_sdk():
+    '''
+        The parts of openstacksdk the inventory script imports
+    '''
+    sdk = types.ModuleType('openstack')
+    sdk.version = types.SimpleNamespace(__version__='1.0.0')
+    sdk.exceptions = types.SimpleNamespace(OpenStackCloudException=OpenStackCloudException)
+    sdk.enable_logging = lambda debug=False: None
+    cloud = types.ModuleType('openstack.cloud')
+    inventory = types.ModuleType('openstack.cloud.inventory')
+    meta = types.ModuleType('openstack.cloud.meta')
+    meta.add_server_interfaces = add_server_interfaces
+    meta.get_hostvars_from_server = get_hostvars_from_server
+    config = types.ModuleType('openstack.config')
+    loader = types.ModuleType('openstack.config.loader')
+    loader.CONFIG_FILES = []
+    sdk.cloud, cloud.inventory, cloud.meta = cloud, inventory, meta
+    sdk.config, config.loader = config, loader
+    return {'openstack': sdk, 'openstack.cloud': cloud, 'openstack.cloud.inventory': inventory,
+            'openstack.cloud.meta': meta, 'openstack.config': config,
+            'openstack.config.loader': loader}
+
+
+def load_script():
+    spec = importlib.util.spec_from_file_location('openstack_inventory', SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class FakeCompute(object):
+
+    def __init__(self, cloud):
+        self.cloud = cloud
+
+    def servers(self, changes_since=None, all_projects=False):
+        self.cloud.calls.append(('servers', changes_since))
+        if self.cloud.error:
+            raise self.cloud.error
+        since = datetime.strptime(changes_since, '%Y-%m-%dT%H:%M:%SZ')
+        return [dict(server) for server in self.cloud.servers.values()
+                if datetime.utcfromtimestamp(server['updated']) >= since]
+
+
+class FakeCloud(object):
+    '''
+        A cloud whose servers carry the time they last changed in updated
+    '''
+
+    def __init__(self, name, region):
+        self.name = name
+        self.config = types.SimpleNamespace(region_name=region)
+        self.servers = {}
+        self.calls = []
+        self.compute = FakeCompute(self)
+        # raised by every call once set, like a cloud which went away
+        self.error = None
+
+    def add(self, server_id, status='ACTIVE', updated=None):
+        self.servers[server_id] = dict(id=server_id, name=server_id, status=status,
+                                       address='10.0.0.%d' % (len(self.servers) + 1),
+                                       updated=time.time() if updated is None else updated)
+
+    def list_servers(self, detailed=False, all_projects=False):
+        self.calls.append(('list_servers', detailed))
+        if self.error:
+            raise self.error
+        return [get_hostvars_from_server(self, server) if detailed
+                else add_server_interfaces(self, server)
+                for server in self.servers.values() if server['status'] not in ('DELETED',)]
+
+
+class InventoryScriptTest(unittest.TestCase):
+    '''
+        Loads the script with the stubbed openstacksdk, which is only in
+        sys.modules while the test runs
+    '''
+
+    def setUp(self):
+        self.sdk_modules = mock.patch.dict(sys.modules, stub_sdk())
+        self.sdk_modules.start()
+        self.script = load_script()
+        self.cache_path = tempfile.mkdtemp(prefix='enyo-inventory-')
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_path, True)
+        self.sdk_modules.stop()
+
+
+class ShardSyncTest(InventoryScriptTest):
+
+    def setUp(self):
+        super(ShardSyncTest, self).setUp()
+        self.cloud = FakeCloud('lab', 'RegionOne')
+        self.cloud.add('a', updated=time.time() - 7200)
+        self.cloud.add('b', updated=time.time() - 7200)
+
+    def sync(self, expiration, refresh=False):
+        servers = self.script.sync_shard(self.cloud, self.cache_path, expiration,
+                                         refresh=refresh)
+        return dict((server['id'], server) for server in servers)
+
+    def shard(self):
+        return self.script.read_shard(self.script.get_shard_file(self.cache_path, self.cloud))
+
+    def test_first_sync_lists_all_servers(self):
+        servers = self.sync(3600)
+        self.assertEqual(sorted(servers), ['a', 'b'])
+        self.assertEqual(self.cloud.calls, [('list_servers', True)])
+        self.assertTrue(servers['a']['expanded'])
+        self.assertEqual(sorted(self.shard()['servers']), ['a', 'b'])
+
+    def test_fresh_shard_is_not_synced(self):
+        self.sync(3600)
+        self.cloud.add('c')
+        self.assertEqual(sorted(self.sync(3600)), ['a', 'b'])
+        self.assertEqual(len(self.cloud.calls), 1)
+
+    def test_stale_shard_is_synced_incrementally(self):
+        self.sync(3600)
+        synced_at = self.shard()['synced_at']
+        self.cloud.add('c')
+        self.cloud.servers['a'].update(status='DELETED', updated=time.time())
+        self.cloud.servers['b'].update(name='b-renamed', updated=time.time())
+
+        servers = self.sync(0)
+        self.assertEqual(sorted(servers), ['b', 'c'])
+        self.assertEqual(servers['b']['name'], 'b-renamed')
+        # changed servers get the same variables as the ones listed
+        self.assertTrue(servers['c']['expanded'])
+        self.assertEqual(servers['c']['interface_ip'], '10.0.0.3')
+        call, changes_since = self.cloud.calls[-1]
+        self.assertEqual(call, 'servers')
+        self.assertEqual(changes_since, datetime.utcfromtimestamp(
+            synced_at - self.script.SYNC_MARGIN).strftime('%Y-%m-%dT%H:%M:%SZ'))
+        self.assertNotIn(('list_servers', True), self.cloud.calls[1:])
+
+    def test_full_sync_drops_purged_servers(self):
+        self.sync(3600)
+        shard = self.shard()
+        shard['full_sync_at'] -= self.script.FULL_SYNC_INTERVAL + 1
+        self.script.write_shard(self.script.get_shard_file(self.cache_path, self.cloud), shard)
+        # purged from the database, an incremental sync never sees it
+        del self.cloud.servers['a']
+
+        self.assertEqual(sorted(self.sync(0)), ['b'])
+        self.assertEqual(self.cloud.calls[-1], ('list_servers', True))
+
+    def test_refresh_lists_all_servers(self):
+        self.sync(3600)
+        del self.cloud.servers['b']
+        self.assertEqual(sorted(self.sync(3600, refresh=True)), ['a'])
+        self.assertEqual(self.cloud.calls[-1], ('list_servers', True))
+
+
+class GetServersTest(InventoryScriptTest):
+
+    def setUp(self):
+        super(GetServersTest, self).setUp()
+        self.good = FakeCloud('lab', 'RegionOne')
+        self.good.add('a')
+        self.bad = FakeCloud('lab', 'RegionTwo')
+        self.bad.add('b')
+        self.inventory = types.SimpleNamespace(clouds=[self.good, self.bad])
+
+    def get_servers(self, fail_on_errors, expiration=3600):
+        self.inventory.extra_config = dict(use_hostnames=False, expand_hostvars=True,
+                                           fail_on_errors=fail_on_errors)
+        servers = self.script.get_servers(self.inventory, self.cache_path, expiration)
+        return sorted(server['id'] for server in servers)
+
+    def test_lists_every_cloud(self):
+        self.assertEqual(self.get_servers(True), ['a', 'b'])
+
+    def test_failing_cloud_without_shard_has_no_servers(self):
+        self.bad.error = OpenStackCloudException('cloud is gone')
+        self.assertEqual(self.get_servers(False), ['a'])
+
+    def test_failing_cloud_keeps_its_last_shard(self):
+        self.get_servers(False)
+        self.bad.error = OpenStackCloudException('cloud is gone')
+        self.good.add('c')
+        self.assertEqual(self.get_servers(False, expiration=0), ['a', 'b', 'c'])
+
+    def test_failing_cloud_fails_with_fail_on_errors(self):
+        self.bad.error = OpenStackCloudException('cloud is gone')
+        with self.assertRaises(OpenStackCloudException):
+            self.get_servers(True)
+
+
+if __name__ == '__main__':
+    unittest.main()